@@ -49,9 +49,18 @@ parser.add_argument(
     **env_or_required_arg('S3_DEST_BUCKET'))
 parser.add_argument(
     '--prefix',
-    help="Prefix to list objects from and to sync to. "
+    help="Prefix to list objects from and to sync to. Multiple prefixes "
+         "are separated by commas. "
          "(env: PREFIX)",
     **env_or_required_arg('PREFIX', required=False))
+parser.add_argument(
+    '--shard',
+    metavar='I/N',
+    help="Processes only shard I of N, from 0 to N - 1. Keys are assigned "
+         "to shards by their checksum, so N runs with the same N and "
+         "different I process a bucket without overlap. "
+         "(env: SHARD)",
+    **env_or_required_arg('SHARD', required=False))
 parser.add_argument(
     '-a',
     '--all',
@@ -106,3 +115,159 @@ parser.add_argument(
     help="[DEBUGGING] Number of objects to copy. "
          "(env: S3_OBJECTS_COUNT)",
     **env_or_required_arg('S3_OBJECTS_COUNT', required=False))
+parser.add_argument(
+    '--listing-processes',
+    type=int,
+    metavar='N',
+    help="Number of processes listing partitions of a bucket in parallel. "
+         "(env: LISTING_PROCESSES)",
+    **env_or_required_arg('LISTING_PROCESSES', required=False))
+parser.add_argument(
+    '--listing-threads',
+    type=int,
+    metavar='N',
+    help="Number of threads listing partitions in each listing process. "
+         "(env: LISTING_THREADS)",
+    **env_or_required_arg('LISTING_THREADS', required=False))
+parser.add_argument(
+    '--pipeline',
+    action='store_true',
+    help="Starts all workers before listing and feeds them page by page "
+         "while the buckets are still listed. "
+         "(env: PIPELINE)",
+    **env_or_required_arg('PIPELINE', required=False))
+parser.add_argument(
+    '--queue-size',
+    type=int,
+    metavar='N',
+    help="Maximum number of keys in each queue in pipeline mode. "
+         "(env: QUEUE_SIZE, default: 100000)",
+    **env_or_required_arg('QUEUE_SIZE', default=100000))
+parser.add_argument(
+    '--compact-listing',
+    action='store_true',
+    help="Holds listings front coded in contiguous buffers, which needs a "
+         "fraction of the memory for very large buckets. "
+         "(env: COMPACT_LISTING)",
+    **env_or_required_arg('COMPACT_LISTING', required=False))
+parser.add_argument(
+    '--listing-checkpoint-dir',
+    metavar='PATH',
+    help="Directory to checkpoint listings in. An interrupted listing is "
+         "resumed by the next run instead of starting over. "
+         "(env: LISTING_CHECKPOINT_DIR)",
+    **env_or_required_arg('LISTING_CHECKPOINT_DIR', required=False))
+parser.add_argument(
+    '--multipart-journal',
+    metavar='PATH',
+    help="File to journal multipart copies of large objects in. Copies of "
+         "an interrupted run are resumed by the next run, only missing "
+         "parts are copied. (env: MULTIPART_JOURNAL)",
+    **env_or_required_arg('MULTIPART_JOURNAL', required=False))
+parser.add_argument(
+    '--multipart-max-age',
+    type=int,
+    metavar='HOURS',
+    help="Aborts multipart uploads of the journal older than this which "
+         "were not resumed. Uploads which are not in the journal, e.g. of "
+         "other writers, are never aborted. "
+         "(env: MULTIPART_MAX_AGE, default: 168)",
+    **env_or_required_arg('MULTIPART_MAX_AGE', default=168))
+parser.add_argument(
+    '--metrics-sink',
+    choices=('cloudwatch', 'prometheus', 'jsonl', 'null'),
+    help="Where to publish metrics to. Worker processes forward their "
+         "metrics to the main process which publishes them. "
+         "(env: METRICS_SINK, default: cloudwatch)",
+    **env_or_required_arg('METRICS_SINK', default='cloudwatch'))
+parser.add_argument(
+    '--metrics-port',
+    type=int,
+    metavar='PORT',
+    help="Port to serve metrics on with the prometheus sink. "
+         "(env: METRICS_PORT, default: 9108)",
+    **env_or_required_arg('METRICS_PORT', default=9108))
+parser.add_argument(
+    '--metrics-file',
+    metavar='PATH',
+    help="File to append metrics to with the jsonl sink. "
+         "(env: METRICS_FILE)",
+    **env_or_required_arg('METRICS_FILE', required=False))
+parser.add_argument(
+    '--manifest-dir',
+    metavar='PATH',
+    help="Directory to keep local manifests of bucket listings in. "
+         "(env: MANIFEST_DIR)",
+    **env_or_required_arg('MANIFEST_DIR', required=False))
+parser.add_argument(
+    '--source-refresh',
+    choices=('full', 'verify', 'trust', 'tail'),
+    help="How to refresh the manifest of the source bucket. "
+         "(env: SOURCE_REFRESH, default: full)",
+    **env_or_required_arg('SOURCE_REFRESH', default='full'))
+parser.add_argument(
+    '--destination-refresh',
+    choices=('full', 'verify', 'trust', 'tail'),
+    help="How to refresh the manifest of the destination bucket. "
+         "(env: DESTINATION_REFRESH, default: full)",
+    **env_or_required_arg('DESTINATION_REFRESH', default='full'))
+parser.add_argument(
+    '--source-inventory',
+    metavar='MANIFEST',
+    help="Path or s3:// URL of the manifest.json of an S3 Inventory report "
+         "of the source bucket, which is read instead of listing it. "
+         "(env: SOURCE_INVENTORY)",
+    **env_or_required_arg('SOURCE_INVENTORY', required=False))
+parser.add_argument(
+    '--destination-inventory',
+    metavar='MANIFEST',
+    help="Path or s3:// URL of the manifest.json of an S3 Inventory report "
+         "of the destination bucket, which is read instead of listing it. "
+         "(env: DESTINATION_INVENTORY)",
+    **env_or_required_arg('DESTINATION_INVENTORY', required=False))
+parser.add_argument(
+    '--manifest-max-age',
+    type=int,
+    metavar='N',
+    help="Hours a trusted manifest is used before listing the bucket "
+         "completely again. "
+         "(env: MANIFEST_MAX_AGE)",
+    **env_or_required_arg('MANIFEST_MAX_AGE', required=False))
+parser.add_argument(
+    '--engine',
+    choices=('threads', 'asyncio'),
+    help="Copies with threads or with coroutines of asyncio, which keep "
+         "far more requests in flight per process and need aiobotocore. "
+         "(env: ENGINE, default: threads)",
+    **env_or_required_arg('ENGINE', default='threads'))
+parser.add_argument(
+    '--concurrency',
+    type=int,
+    metavar='N',
+    help="Number of requests in flight per process with the asyncio engine. "
+         "(env: CONCURRENCY, default: 1000)",
+    **env_or_required_arg('CONCURRENCY', default=1000))
+parser.add_argument(
+    '--max-request-rate',
+    type=int,
+    metavar='N',
+    help="Highest number of copies per second to one key prefix of the "
+         "destination bucket, shared by all processes. The rate adapts to "
+         "SlowDowns of S3 below it. "
+         "(env: MAX_REQUEST_RATE, default: 3500)",
+    **env_or_required_arg('MAX_REQUEST_RATE', default=3500))
+parser.add_argument(
+    '--dead-letter-file',
+    metavar='PATH',
+    help="File keys are written to which failed after their last attempt, "
+         "one JSON object per line. "
+         "(env: DEAD_LETTER_FILE, default: dead-letters.jsonl)",
+    **env_or_required_arg('DEAD_LETTER_FILE', default='dead-letters.jsonl'))
+parser.add_argument(
+    '--retry-failed',
+    action='store_true',
+    help="Processes only the keys of the dead letter file instead of "
+         "listing the buckets. Keys failing again are written to a new "
+         "file, the old one is kept with the suffix .old. "
+         "(env: RETRY_FAILED)",
+    **env_or_required_arg('RETRY_FAILED', required=False))
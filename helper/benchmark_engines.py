@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+# This script copies the same objects with the threads and the asyncio
+# engine and prints the objects per second of each. Run it from the root
+# of the repository, the destination bucket should be a scratch bucket.
+
+import argparse
+import itertools
+import multiprocessing as mp
+import time
+
+import s3backuprestore as s3br
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    '-p',
+    '--profile',
+    help='AWS Profile'
+)
+parser.add_argument(
+    '--source-bucket',
+    required=True,
+    help='Bucket to copy from.'
+)
+parser.add_argument(
+    '--destination-bucket',
+    required=True,
+    help='Bucket to copy to.'
+)
+parser.add_argument(
+    '--region',
+    default='eu-central-1',
+    help='AWS region of both buckets.'
+)
+parser.add_argument(
+    '--object-count',
+    help='Number of objects to copy with each engine.',
+    default=10000,
+    metavar='N',
+    type=int
+)
+parser.add_argument(
+    '--processes',
+    help='Number of processes of each engine.',
+    default=mp.cpu_count(),
+    metavar='N',
+    type=int
+)
+parser.add_argument(
+    '--thread-count',
+    help='Number of threads per process of the threads engine.',
+    default=25,
+    metavar='N',
+    type=int
+)
+parser.add_argument(
+    '--concurrency',
+    help='Number of coroutines per process of the asyncio engine.',
+    default=1000,
+    metavar='N',
+    type=int
+)
+args = parser.parse_args()
+
+PROFILE = args.profile
+SRC_BUCKET = args.source_bucket
+DST_BUCKET = args.destination_bucket
+REGION = args.region
+OBJECT_COUNT = args.object_count
+PROCESSES = args.processes
+THREAD_COUNT = args.thread_count
+CONCURRENCY = args.concurrency
+
+
+def run_engine(process_class, workers, objects, config, manager):
+    """Copies objects with processes of an engine.
+
+    Returns:
+        [float]: Seconds until all processes finished.
+    """
+
+    copy_queue = manager.Queue()
+    for obj in objects:
+        copy_queue.put(obj)
+
+    start = time.time()
+    proc_lst = [process_class(config, copy_queue, thread_count=workers)
+                for _ in range(PROCESSES)]
+    for proc in proc_lst:
+        proc.start()
+    for proc in proc_lst:
+        proc.join()
+    return time.time() - start
+
+
+if __name__ == '__main__':
+    config = s3br.Config(
+        SRC_BUCKET,
+        DST_BUCKET,
+        profile_name=PROFILE,
+        region=REGION,
+        max_pool_connections=THREAD_COUNT,
+        s3_transfer_manager_conf={'max_concurrency': THREAD_COUNT})
+    objects = list(itertools.chain.from_iterable(s3br.iter_objects(
+        SRC_BUCKET,
+        config=config,
+        objects_count=OBJECT_COUNT,
+        with_metadata=True)))
+    print("Copying {} objects with each engine.".format(len(objects)))
+
+    with mp.Manager() as manager:
+        for name, process_class, workers in (
+                ('threads', s3br.MpBackup, THREAD_COUNT),
+                ('asyncio', s3br.MpAsyncBackup, CONCURRENCY)):
+            seconds = run_engine(
+                process_class, workers, objects, config, manager)
+            print("{:8} {:6} processes x {:5} workers: {:8.1f}s, "
+                  "{:10.1f} objects/s".format(
+                      name, PROCESSES, workers, seconds,
+                      len(objects) / seconds))
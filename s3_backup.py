@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import itertools
 import logging
 import multiprocessing as mp
 import os
@@ -35,21 +37,57 @@ parser.add_argument(
          'but still present in backup bucket. '
          '(env: TAG_DELETED)',
     **cmd_args.env_or_required_arg('TAG_DELETED', required=False))
+parser.add_argument(
+    '--compare-etag',
+    action='store_true',
+    help='Copy objects whose ETag differs between source and '
+         'destination bucket as well. Copies keep the part layout and '
+         'so the ETag of the source, unless SSE-KMS is used. '
+         '(env: COMPARE_ETAG)',
+    **cmd_args.env_or_required_arg('COMPARE_ETAG', required=False))
 cmd_args = parser.parse_args()
 
 ALL = cmd_args.all
+COMPACT_LISTING = cmd_args.compact_listing
+CONCURRENCY = cmd_args.concurrency
 CPU_COUNT = mp.cpu_count()
 DST_BUCKET = cmd_args.destination_bucket
+DST_INVENTORY = cmd_args.destination_inventory
+DST_REFRESH = cmd_args.destination_refresh
+ENGINE = cmd_args.engine
 LAST_MODIFIED_SINCE = cmd_args.last_modified_since
+LISTING_CHECKPOINT_DIR = cmd_args.listing_checkpoint_dir
+LISTING_PROCESSES = cmd_args.listing_processes
+LISTING_THREADS = cmd_args.listing_threads
+MANIFEST_DIR = cmd_args.manifest_dir
+MULTIPART_JOURNAL = cmd_args.multipart_journal
+MULTIPART_MAX_AGE = cmd_args.multipart_max_age
+MANIFEST_MAX_AGE = cmd_args.manifest_max_age
+MAX_REQUEST_RATE = cmd_args.max_request_rate
+METRICS_FILE = cmd_args.metrics_file
+METRICS_PORT = cmd_args.metrics_port
+METRICS_SINK = cmd_args.metrics_sink
 OBJECTS_COUNT = cmd_args.objects_count
+PIPELINE = cmd_args.pipeline
+PREFIXES = s3br.normalize_prefixes(cmd_args.prefix)
 PROFILE = cmd_args.profile
+QUEUE_SIZE = cmd_args.queue_size
 REGION = cmd_args.region
+try:
+    SHARD = s3br.parse_shard(cmd_args.shard)
+except ValueError as exc:
+    parser.error(str(exc))
 SRC_BUCKET = cmd_args.source_bucket
+SRC_INVENTORY = cmd_args.source_inventory
+SRC_REFRESH = cmd_args.source_refresh
 TAG_DELETED = cmd_args.tag_deleted
 THREAD_COUNT = cmd_args.thread_count_per_proc
 TIMEOUT = cmd_args.timeout
 VERBOSE = cmd_args.verbose
 CW_DIMENSION_NAME = cmd_args.cloudwatch_dimension_name
+COMPARE_ETAG = cmd_args.compare_etag
+DEAD_LETTER_FILE = cmd_args.dead_letter_file
+RETRY_FAILED = cmd_args.retry_failed
 
 if VERBOSE and VERBOSE == 1:
     logger.setLevel(logging.WARNING)
@@ -64,9 +102,178 @@ elif VERBOSE and VERBOSE >= 3:
 if not PROFILE:
     PROFILE = os.getenv('AWS_PROFILE', None)
 
+# Copy processes of the engine and their threads or coroutines
+if ENGINE == 'asyncio':
+    BACKUP_PROCESS = s3br.MpAsyncBackup
+    BACKUP_WORKERS = CONCURRENCY
+else:
+    BACKUP_PROCESS = s3br.MpBackup
+    BACKUP_WORKERS = 25
+
+
+def join_processes(proc_lst, q, cw_metric_name, config):
+    """Waits for processes and publishes the queue size every 60s."""
+    for proc in proc_lst:
+        try:
+            while proc.is_alive():
+                logger.debug("{} still alive waiting 60s.".format(proc.name))
+                proc.join(60)
+                s3br.put_metric(cw_metric_name, q.qsize(), config=config)
+        except KeyboardInterrupt:
+            logger.warning("Exiting...")
+            sys.exit(127)
+        else:
+            logger.debug("{} finished.".format(proc.name))
+    s3br.put_metric(cw_metric_name, 0, config=config)
+
+
+def run_pipeline(config, manager):
+    """Lists, compares, copies and tags objects at the same time.
+
+    All workers are started before the buckets are listed. Both listings
+    are streamed page by page and joined by key, so no listing is held in
+    memory. Objects to copy and objects to tag as deleted are put into
+    bounded queues right away and each stage is told by an event that its
+    input is complete.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+        manager (multiprocessing.Manager): Manager to create queues and
+        events with.
+    """
+
+    cp_q = manager.Queue(QUEUE_SIZE)
+    tag_q = manager.Queue(QUEUE_SIZE)
+    listing_done = manager.Event()
+    tag_deleted = TAG_DELETED and not ALL
+    # Large objects are copied in parts by all backup processes.
+    coordinator = s3br.coordinate_multipart(
+        config, journal=MULTIPART_JOURNAL, max_age=MULTIPART_MAX_AGE)
+
+    start = time.time()
+    logger.info("Starting {} backup processes.".format(CPU_COUNT))
+    cp_proc_lst = list()
+    for p in range(CPU_COUNT):
+        cp_proc_lst.append(BACKUP_PROCESS(
+            config=config,
+            copy_queue=cp_q,
+            thread_count=BACKUP_WORKERS,
+            input_done=listing_done
+        ))
+        cp_proc_lst[p].start()
+
+    tag_proc_lst = list()
+    if tag_deleted:
+        logger.info("Starting {} tagging processes.".format(CPU_COUNT))
+        for p in range(CPU_COUNT):
+            tag_proc_lst.append(s3br.MpTagDeletedObjects(
+                config=config,
+                tag_queue=tag_q,
+                input_done=listing_done
+            ))
+            tag_proc_lst[p].start()
+
+    logger.info("List S3 Keys from {} and {}"
+                .format(SRC_BUCKET, DST_BUCKET))
+    if SRC_INVENTORY:
+        src_obj = itertools.islice(s3br.Inventory(
+            SRC_INVENTORY, config=config).records(
+                LISTING_PROCESSES, PREFIXES, SHARD), OBJECTS_COUNT)
+    else:
+        src_obj = itertools.chain.from_iterable(s3br.iter_objects(
+            SRC_BUCKET, config=config, objects_count=OBJECTS_COUNT,
+            with_metadata=True, prefixes=PREFIXES, shard=SHARD))
+    if ALL:
+        dst_obj = iter(())
+    elif DST_INVENTORY:
+        dst_obj = s3br.Inventory(
+            DST_INVENTORY, config=config).records(
+                LISTING_PROCESSES, PREFIXES, SHARD)
+    else:
+        dst_obj = itertools.chain.from_iterable(s3br.iter_objects(
+            DST_BUCKET, config=config, with_metadata=True,
+            prefixes=PREFIXES, shard=SHARD))
+
+    # Sorted keys are put into the queues alternating between prefixes.
+    cp_scheduler = s3br.PrefixScheduler(cp_q)
+    tag_scheduler = s3br.PrefixScheduler(tag_q)
+    stats = collections.Counter()
+    for reason, src, dst in s3br.diff_listings(
+            src_obj,
+            dst_obj,
+            last_modified=LAST_MODIFIED_SINCE,
+            compare_etag=COMPARE_ETAG):
+        stats[reason] += 1
+        if reason != 'deleted':
+            for item in coordinator.split(src):
+                cp_scheduler.put(item)
+        elif tag_deleted:
+            tag_scheduler.put(dst)
+    cp_scheduler.flush()
+    tag_scheduler.flush()
+    listing_done.set()
+    logger.info("Listing and comparing finished: {}".format(dict(stats)))
+
+    join_processes(cp_proc_lst, cp_q, 'ObjectsToBackup', config)
+    coordinator.stop()
+    logger.info("All backup processes are finished.")
+    join_processes(tag_proc_lst, tag_q, 'ObjectsToTagAsDeleted', config)
+    logger.info("All tagging processes are finished.")
+    logger.info("Pipeline took {} seconds.".format(time.time() - start))
+
+
+def run_failed(config, manager, dead_letters):
+    """Copies and tags only the keys given up by an earlier run.
+
+    The buckets are not listed. Keys failing again are added to the dead
+    letters of config.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+        manager (multiprocessing.Manager): Manager to create queues and
+        events with.
+        dead_letters (s3backuprestore.retry.DeadLetters): Keys given up by
+        the earlier run.
+    """
+
+    cp_q = manager.Queue()
+    tag_q = manager.Queue()
+    cp_obj = dead_letters.read('copy') + dead_letters.read('compare')
+    tag_obj = dead_letters.read('tag') if TAG_DELETED else []
+    logger.info("{} objects to copy and {} to tag from {}.".format(
+        len(cp_obj), len(tag_obj), dead_letters.path))
+    coordinator = s3br.coordinate_multipart(
+        config, journal=MULTIPART_JOURNAL, max_age=MULTIPART_MAX_AGE)
+    s3br.schedule(tag_q, tag_obj)
+
+    start = time.time()
+    # The workers copy while large objects are split into parts.
+    scheduled = manager.Event()
+    cp_proc_lst = [BACKUP_PROCESS(
+        config=config,
+        copy_queue=cp_q,
+        thread_count=BACKUP_WORKERS,
+        input_done=scheduled
+    ) for _ in range(min(len(cp_obj), CPU_COUNT))]
+    for proc in cp_proc_lst:
+        proc.start()
+    s3br.schedule(cp_q, (i for o in cp_obj for i in coordinator.split(o)))
+    scheduled.set()
+    join_processes(cp_proc_lst, cp_q, 'ObjectsToBackup', config)
+    coordinator.stop()
+    tag_proc_lst = [s3br.MpTagDeletedObjects(
+        config=config,
+        tag_queue=tag_q
+    ) for _ in range(min(tag_q.qsize(), CPU_COUNT))]
+    for proc in tag_proc_lst:
+        proc.start()
+    join_processes(tag_proc_lst, tag_q, 'ObjectsToTagAsDeleted', config)
+    logger.info("Retrying failed keys took {} seconds."
+                .format(time.time() - start))
+
+
 if __name__ == '__main__':
     manager = mp.Manager()
-    cmp_q = manager.Queue()
     cp_q = manager.Queue()
     tag_q = manager.Queue()
 
@@ -83,6 +290,8 @@ if __name__ == '__main__':
         'multipart_threshold': 52428800,
         'multipart_chunksize': 26214400,
         'num_download_attempts': 10,
+        # Requests in flight of all copies of a process together
+        'max_concurrency': 50,
     }
 
     extra_args = {
@@ -101,109 +310,176 @@ if __name__ == '__main__':
         region=REGION,
         s3_transfer_manager_conf=trans_conf)
 
+    # Worker processes forward their metrics to this process which
+    # publishes them to the sink.
+    try:
+        metrics_sink = s3br.create_sink(
+            METRICS_SINK,
+            config=backup_config,
+            port=METRICS_PORT,
+            path=METRICS_FILE)
+    except ValueError as exc:
+        parser.error(str(exc))
+    s3br.set_sink(metrics_sink)
+    backup_config.metrics_queue = manager.Queue()
+    backup_config.multipart_queue = manager.Queue()
+    metrics_collector = s3br.collect_metrics(
+        backup_config.metrics_queue, metrics_sink)
+    # Counters the workers update in shared memory for progress and ETA
+    backup_config.stats = s3br.SharedStats()
+    # Request rates per prefix shared by all workers, adapted to SlowDowns
+    backup_config.rate_limiter = s3br.RateLimiter(
+        initial_rate=min(500, MAX_REQUEST_RATE),
+        max_rate=MAX_REQUEST_RATE)
+    # Keys failing after their last attempt
+    backup_config.dead_letters = s3br.DeadLetters(DEAD_LETTER_FILE)
+
+    if RETRY_FAILED:
+        failed = backup_config.dead_letters.take()
+        if failed:
+            progress = s3br.report_progress(
+                backup_config.stats, config=backup_config)
+            run_failed(backup_config, manager, failed)
+            progress.stop()
+            # Keys failing again are in the new file.
+            failed.remove()
+        else:
+            logger.info("No failed keys in {}.".format(DEAD_LETTER_FILE))
+        metrics_collector.stop()
+        metrics_sink.report()
+        sys.exit(0)
+
+    if PIPELINE:
+        progress = s3br.report_progress(
+            backup_config.stats, config=backup_config)
+        run_pipeline(backup_config, manager)
+        progress.stop()
+        metrics_collector.stop()
+        metrics_sink.report()
+        sys.exit(0)
+
+    # Local manifests of both buckets to refresh instead of listing them
+    src_manifest = None
+    dst_manifest = None
+    if MANIFEST_DIR:
+        src_manifest = s3br.Manifest(
+            MANIFEST_DIR, SRC_BUCKET, max_age=MANIFEST_MAX_AGE,
+            prefixes=PREFIXES, shard=SHARD)
+        dst_manifest = s3br.Manifest(
+            MANIFEST_DIR, DST_BUCKET, max_age=MANIFEST_MAX_AGE,
+            prefixes=PREFIXES, shard=SHARD)
+        # Workers report copied objects, only those go into the manifest.
+        backup_config.copied_queue = manager.Queue()
+
+    # S3 Inventory reports to read instead of listing the buckets
+    src_inventory = None
+    dst_inventory = None
+    if SRC_INVENTORY:
+        src_inventory = s3br.Inventory(SRC_INVENTORY, config=backup_config)
+    if DST_INVENTORY:
+        dst_inventory = s3br.Inventory(DST_INVENTORY, config=backup_config)
+
+    # Checkpoints to resume interrupted listings of both buckets
+    src_checkpoint = None
+    dst_checkpoint = None
+    if LISTING_CHECKPOINT_DIR:
+        src_checkpoint = s3br.ListingCheckpoint(
+            LISTING_CHECKPOINT_DIR, SRC_BUCKET)
+        dst_checkpoint = s3br.ListingCheckpoint(
+            LISTING_CHECKPOINT_DIR, DST_BUCKET)
+
     # Getting S3 objects from source bucket
     logger.info("List S3 Keys from {}".format(SRC_BUCKET))
     src_obj = s3br.get_objects(
         SRC_BUCKET,
         config=backup_config,
-        objects_count=OBJECTS_COUNT)
+        objects_count=OBJECTS_COUNT,
+        processes=LISTING_PROCESSES,
+        thread_count=LISTING_THREADS,
+        with_metadata=True,
+        compact=COMPACT_LISTING,
+        manifest=src_manifest,
+        refresh=SRC_REFRESH,
+        inventory=src_inventory,
+        prefixes=PREFIXES,
+        shard=SHARD,
+        checkpoint=src_checkpoint)
     logger.info("{} objects in {}.".format(len(src_obj), SRC_BUCKET))
 
+    # Large objects are copied in parts by all backup processes.
+    coordinator = s3br.coordinate_multipart(
+        backup_config, journal=MULTIPART_JOURNAL, max_age=MULTIPART_MAX_AGE)
     if ALL:
         # Getting objects not in destination bucket
-        [cp_q.put(o) for o in src_obj]
-        logger.info("{} objects to copy bucket.".format(cp_q.qsize()))
+        cp_obj = src_obj
     else:
         # Getting S3 keys from destiantion bucket
         logger.debug("List S3 Keys from {}".format(DST_BUCKET))
         dst_obj = s3br.get_objects(
             DST_BUCKET,
-            config=backup_config)
+            config=backup_config,
+            processes=LISTING_PROCESSES,
+            thread_count=LISTING_THREADS,
+            with_metadata=True,
+            compact=COMPACT_LISTING,
+            manifest=dst_manifest,
+            refresh=DST_REFRESH,
+            inventory=dst_inventory,
+            prefixes=PREFIXES,
+            shard=SHARD,
+            checkpoint=dst_checkpoint)
         logger.info("{} in {}.".format(len(dst_obj), DST_BUCKET))
 
-        # Getting objects not in destination bucket
-        cp_obj = set(src_obj) - set(dst_obj)
-        [cp_q.put(o) for o in cp_obj]
+        # Comparing both listings in memory, no request to S3 is needed.
+        start = time.time()
+        cp_obj, cmp_stats = s3br.compare_listings(
+            src_obj,
+            dst_obj,
+            last_modified=LAST_MODIFIED_SINCE,
+            compare_etag=COMPARE_ETAG)
         logger.info("{} objects not in destination bucket."
-                    .format(cp_q.qsize()))
-
-        # Getting objects to compare between source and destination
-        cmp_obj = set(src_obj) & set(dst_obj)
-        [cmp_q.put(o) for o in cmp_obj]
-        cmp_q_size = cmp_q.qsize()
-        logger.info("{} objects to compare.".format(cmp_q_size))
-
-        # Puting metric how many objects to compare
-        s3br.put_metric(
-            'ObjectsToCompare',
-            cmp_q_size,
-            config=backup_config)
-
-        # Check if there are any objects to compare.
-        if cmp_q_size:
-            start = time.time()
-            processes = min(cmp_q_size, CPU_COUNT)
-            # Starting compare processes
-            proc_lst = list()
-            logger.info("Starting {} compare processes.".format(processes))
-            for p in range(processes):
-                proc_lst.append(s3br.MpCompare(
-                    config=backup_config,
-                    compare_queue=cmp_q,
-                    copy_queue=cp_q,
-                ))
-                proc_lst[p].start()
-            logger.info("{} compare processes are started.".format(processes))
-
-            logger.info("Waiting for compare proccesses to be finished.")
-            for p in range(processes):
-                try:
-                    while proc_lst[p].is_alive():
-                        logger.debug("{} still alive waiting 60s."
-                                     .format(proc_lst[p].name))
-                        time.sleep(60)
-                        qs = cmp_q.qsize()
-                        logger.debug("Compare queue size {}".format(qs))
-                        s3br.put_metric(
-                            'ObjectsToCompare', qs, config=backup_config)
-                except KeyboardInterrupt:
-                    logger.warning("Exiting...")
-                    sys.exit(127)
-                else:
-                    logger.debug("Joining process {}."
-                                 .format(proc_lst[p].name))
-                    proc_lst[p].join(backup_config.timeout)
-                    logger.debug("{} finished.".format(proc_lst[p].name))
-            logger.info("All compare processes are finished.")
-            logger.info("Comparing objects took {} seconds."
-                        .format(time.time() - start))
-            s3br.put_metric('ObjectsToCompare', 0, config=backup_config)
-        else:
-            logger.info("No objects to compare.")
+                    .format(cmp_stats['missing']))
+        logger.info("{} objects differ in size, {} in ETag, {} modified "
+                    "within last {}h.".format(
+                        cmp_stats['size_differs'],
+                        cmp_stats['etag_differs'],
+                        cmp_stats['modified'],
+                        LAST_MODIFIED_SINCE))
+        logger.info("Comparing objects took {} seconds."
+                    .format(time.time() - start))
 
     # Get total number of objects to backup to destination bucket.
-    cp_q_size = cp_q.qsize()
+    cp_obj_count = len(cp_obj)
     # Puting metric how many objects to backup
     s3br.put_metric(
         'ObjectsToBackup',
-        cp_q_size,
+        cp_obj_count,
         config=backup_config)
     logger.info("{} objects to backup to destination bucket."
-                .format(cp_q_size))
-    if cp_q_size:
+                .format(cp_obj_count))
+    if cp_obj_count:
         start = time.time()
         # Starting compare process
-        processes = min(cp_q_size, CPU_COUNT)
+        processes = min(cp_obj_count, CPU_COUNT)
         proc_lst = list()
+        # Splitting a large object costs requests to S3, so the workers are
+        # started first and copy while the queue is filled.
+        scheduled = manager.Event()
+        progress = s3br.report_progress(
+            backup_config.stats, total=cp_obj_count, config=backup_config)
         logger.info("Starting {} backup processes.".format(processes))
         for p in range(processes):
-            proc_lst.append(s3br.MpBackup(
+            proc_lst.append(BACKUP_PROCESS(
                 config=backup_config,
                 copy_queue=cp_q,
-                thread_count=25
+                thread_count=BACKUP_WORKERS,
+                input_done=scheduled
             ))
             proc_lst[p].start()
         logger.info("{} backup processes are started.".format(processes))
+        # Large objects are put into the queue as parts.
+        s3br.schedule(cp_q, (i for o in cp_obj for i in coordinator.split(o)))
+        scheduled.set()
 
         logger.info("Waiting for backup proccesses to be finished.")
         for p in range(processes):
@@ -212,7 +488,7 @@ if __name__ == '__main__':
                     logger.debug("{} still alive waiting 60s."
                                  .format(proc_lst[p].name))
                     time.sleep(60)
-                    qs = cp_q.qsize()
+                    qs = max(cp_obj_count - progress.delta()['objects'], 0)
                     s3br.put_metric(
                         'ObjectsToBackup', qs, config=backup_config)
             except KeyboardInterrupt:
@@ -221,17 +497,33 @@ if __name__ == '__main__':
             else:
                 proc_lst[p].join(backup_config.timeout)
                 logger.debug("{} finished.".format(proc_lst[p].name))
+        coordinator.stop()
+        progress.stop()
         logger.info("All backup processes are finished.")
         s3br.put_metric('ObjectsToBackup', 0, config=backup_config)
         logger.info("Backup objects took {} seconds."
                     .format(time.time() - start))
+
+        # The destination manifest can be trusted on later runs if it holds
+        # all objects copied by this run. Objects which failed are left
+        # out, so they are copied by the next run.
+        if dst_manifest:
+            copied = set(s3br.drain(backup_config.copied_queue))
+            logger.info("{} of {} objects copied.".format(
+                len(copied), cp_obj_count))
+            copied_at = time.time()
+            dst_manifest.update(o._replace(
+                last_modified=copied_at,
+                storage_class=extra_args['StorageClass'])
+                for o in cp_obj if o.key in copied)
     else:
         logger.info("No objects to backup.")
 
     if TAG_DELETED and not ALL:
-        # Getting objects to compare between source and destination
-        tag_obj = set(dst_obj) - set(src_obj)
-        [tag_q.put(o) for o in tag_obj]
+        # Getting objects only in destination bucket
+        tag_obj = [d.key for side, _, d in s3br.merge_join(src_obj, dst_obj)
+                   if side == s3br.ONLY_DST]
+        s3br.schedule(tag_q, tag_obj)
         tag_q_size = tag_q.qsize()
         logger.info("{} objects to tag as deleted".format(tag_q_size))
         logger.debug("Objects: {}".format(tag_obj))
@@ -277,3 +569,7 @@ if __name__ == '__main__':
             s3br.put_metric('ObjectsToTagAsDeleted', 0, config=backup_config)
         else:
             logger.info("No objects to to tag.")
+
+    # Totals, rates and request latencies of the run
+    metrics_collector.stop()
+    metrics_sink.report()
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import itertools
 import logging
 import multiprocessing as mp
 import os
@@ -33,13 +34,36 @@ cmd_args = parser.parse_args()
 
 ALL = cmd_args.all
 CHECK_DELETED_TAG = cmd_args.check_deleted_tag
+COMPACT_LISTING = cmd_args.compact_listing
+CONCURRENCY = cmd_args.concurrency
 CPU_COUNT = mp.cpu_count()
 CW_DIMENSION_NAME = cmd_args.cloudwatch_dimension_name
+DEAD_LETTER_FILE = cmd_args.dead_letter_file
 DST_BUCKET = cmd_args.destination_bucket
+ENGINE = cmd_args.engine
+LISTING_CHECKPOINT_DIR = cmd_args.listing_checkpoint_dir
+LISTING_PROCESSES = cmd_args.listing_processes
+LISTING_THREADS = cmd_args.listing_threads
+MANIFEST_DIR = cmd_args.manifest_dir
+MANIFEST_MAX_AGE = cmd_args.manifest_max_age
+MAX_REQUEST_RATE = cmd_args.max_request_rate
+METRICS_FILE = cmd_args.metrics_file
+METRICS_PORT = cmd_args.metrics_port
+METRICS_SINK = cmd_args.metrics_sink
 OBJECTS_COUNT = cmd_args.objects_count
+PIPELINE = cmd_args.pipeline
+PREFIXES = s3br.normalize_prefixes(cmd_args.prefix)
 PROFILE = cmd_args.profile
+QUEUE_SIZE = cmd_args.queue_size
 REGION = cmd_args.region
+RETRY_FAILED = cmd_args.retry_failed
+try:
+    SHARD = s3br.parse_shard(cmd_args.shard)
+except ValueError as exc:
+    parser.error(str(exc))
 SRC_BUCKET = cmd_args.source_bucket
+SRC_INVENTORY = cmd_args.source_inventory
+SRC_REFRESH = cmd_args.source_refresh
 THREAD_COUNT = cmd_args.thread_count_per_proc
 TIMEOUT = cmd_args.timeout
 VERBOSE = cmd_args.verbose
@@ -57,6 +81,14 @@ elif VERBOSE and VERBOSE >= 3:
 if not PROFILE:
     PROFILE = os.getenv('AWS_PROFILE', None)
 
+# Copy processes of the engine and their threads or coroutines
+if ENGINE == 'asyncio':
+    RESTORE_PROCESS = s3br.MpAsyncRestore
+    RESTORE_WORKERS = CONCURRENCY
+else:
+    RESTORE_PROCESS = s3br.MpRestore
+    RESTORE_WORKERS = 25
+
 
 def check_create_s3_bucket():
     count = 60
@@ -88,6 +120,141 @@ def check_create_s3_bucket():
             break
 
 
+def join_processes(proc_lst, q, cw_metric_name, config):
+    """Waits for processes and publishes the queue size every 60s."""
+    for proc in proc_lst:
+        try:
+            while proc.is_alive():
+                logger.debug("{} still alive waiting 60s.".format(proc.name))
+                proc.join(60)
+                s3br.put_metric(cw_metric_name, q.qsize(), config=config)
+        except KeyboardInterrupt:
+            logger.warning("Exiting...")
+            sys.exit(127)
+        else:
+            logger.debug("{} finished.".format(proc.name))
+    s3br.put_metric(cw_metric_name, 0, config=config)
+
+
+def run_pipeline(config, manager):
+    """Lists, checks and restores objects at the same time.
+
+    All workers are started before the source bucket is listed. Each page of
+    the listing is put into bounded queues right away, so workers do not
+    wait for the complete listing and memory usage stays flat.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+        manager (multiprocessing.Manager): Manager to create queues and
+        events with.
+    """
+
+    check_deleted_q = manager.Queue(QUEUE_SIZE)
+    restore_queue = manager.Queue(QUEUE_SIZE)
+    listing_done = manager.Event()
+    check_done = manager.Event()
+    check_deleted = CHECK_DELETED_TAG and not ALL
+
+    start = time.time()
+    check_proc_lst = list()
+    if check_deleted:
+        logger.info("Starting {} check for deleted tag processes."
+                    .format(CPU_COUNT))
+        for p in range(CPU_COUNT):
+            check_proc_lst.append(s3br.MpCheckDeletedTag(
+                config=config,
+                check_deleted_tag_queue=check_deleted_q,
+                restore_queue=restore_queue,
+                thread_count=25,
+                input_done=listing_done
+            ))
+            check_proc_lst[p].start()
+
+    logger.info("Starting {} restore processes.".format(CPU_COUNT))
+    rst_proc_lst = list()
+    for p in range(CPU_COUNT):
+        rst_proc_lst.append(RESTORE_PROCESS(
+            config=config,
+            restore_queue=restore_queue,
+            thread_count=RESTORE_WORKERS,
+            input_done=check_done if check_deleted else listing_done
+        ))
+        rst_proc_lst[p].start()
+
+    logger.info("List S3 Keys from {}".format(SRC_BUCKET))
+    src_count = 0
+    q = check_deleted_q if check_deleted else restore_queue
+    if SRC_INVENTORY:
+        src_obj = itertools.islice(s3br.Inventory(
+            SRC_INVENTORY, config=config).records(
+                LISTING_PROCESSES, PREFIXES, SHARD), OBJECTS_COUNT)
+    else:
+        src_obj = itertools.chain.from_iterable(s3br.iter_objects(
+            SRC_BUCKET, config=config, objects_count=OBJECTS_COUNT,
+            with_metadata=True, prefixes=PREFIXES, shard=SHARD))
+    # Sorted keys are put into the queue alternating between prefixes.
+    scheduler = s3br.PrefixScheduler(q)
+    for obj in src_obj:
+        scheduler.put(obj)
+        src_count += 1
+    scheduler.flush()
+    listing_done.set()
+    logger.info("{} objects in {}.".format(src_count, SRC_BUCKET))
+
+    join_processes(check_proc_lst, check_deleted_q,
+                   'ObjectsToCheckForDeletedTag', config)
+    check_done.set()
+    join_processes(rst_proc_lst, restore_queue, 'ObjectsToRestore', config)
+    logger.info("All restore processes are finished.")
+    logger.info("Pipeline took {} seconds.".format(time.time() - start))
+
+
+def run_failed(config, manager, dead_letters):
+    """Checks and restores only the keys given up by an earlier run.
+
+    The source bucket is not listed. Keys failing again are added to the
+    dead letters of config.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+        manager (multiprocessing.Manager): Manager to create queues and
+        events with.
+        dead_letters (s3backuprestore.retry.DeadLetters): Keys given up by
+        the earlier run.
+    """
+
+    check_deleted_q = manager.Queue()
+    restore_queue = manager.Queue()
+    check_obj = dead_letters.read('check')
+    rst_obj = dead_letters.read('restore')
+    logger.info("{} objects to check and {} to restore from {}.".format(
+        len(check_obj), len(rst_obj), dead_letters.path))
+    s3br.schedule(check_deleted_q, check_obj)
+    s3br.schedule(restore_queue, rst_obj)
+
+    start = time.time()
+    check_proc_lst = [s3br.MpCheckDeletedTag(
+        config=config,
+        check_deleted_tag_queue=check_deleted_q,
+        restore_queue=restore_queue,
+        thread_count=25
+    ) for _ in range(min(check_deleted_q.qsize(), CPU_COUNT))]
+    for proc in check_proc_lst:
+        proc.start()
+    join_processes(check_proc_lst, check_deleted_q,
+                   'ObjectsToCheckForDeletedTag', config)
+    rst_proc_lst = [RESTORE_PROCESS(
+        config=config,
+        restore_queue=restore_queue,
+        thread_count=RESTORE_WORKERS
+    ) for _ in range(min(restore_queue.qsize(), CPU_COUNT))]
+    for proc in rst_proc_lst:
+        proc.start()
+    join_processes(rst_proc_lst, restore_queue, 'ObjectsToRestore', config)
+    logger.info("Retrying failed keys took {} seconds."
+                .format(time.time() - start))
+
+
 if __name__ == '__main__':
     manager = mp.Manager()
     restore_queue = manager.Queue()
@@ -109,6 +276,8 @@ if __name__ == '__main__':
         'multipart_threshold': 52428800,
         'multipart_chunksize': 26214400,
         'num_download_attempts': 10,
+        # Requests in flight of all copies of a process together
+        'max_concurrency': 50,
     }
 
     # Getting configuration object for restore processes.
@@ -121,28 +290,101 @@ if __name__ == '__main__':
         region=REGION,
         s3_transfer_manager_conf=trans_conf)
 
+    # Worker processes forward their metrics to this process which
+    # publishes them to the sink.
+    try:
+        metrics_sink = s3br.create_sink(
+            METRICS_SINK,
+            config=restore_config,
+            port=METRICS_PORT,
+            path=METRICS_FILE)
+    except ValueError as exc:
+        parser.error(str(exc))
+    s3br.set_sink(metrics_sink)
+    restore_config.metrics_queue = manager.Queue()
+    metrics_collector = s3br.collect_metrics(
+        restore_config.metrics_queue, metrics_sink)
+    # Counters the workers update in shared memory for progress and ETA
+    restore_config.stats = s3br.SharedStats()
+    # Request rates per prefix shared by all workers, adapted to SlowDowns
+    restore_config.rate_limiter = s3br.RateLimiter(
+        initial_rate=min(500, MAX_REQUEST_RATE),
+        max_rate=MAX_REQUEST_RATE)
+
+    # Keys failing after their last attempt
+    restore_config.dead_letters = s3br.DeadLetters(DEAD_LETTER_FILE)
+
     # Check if destination bucket exists, if not exit the program
     check_create_s3_bucket()
 
+    if RETRY_FAILED:
+        failed = restore_config.dead_letters.take()
+        if failed:
+            progress = s3br.report_progress(
+                restore_config.stats, config=restore_config)
+            run_failed(restore_config, manager, failed)
+            progress.stop()
+            # Keys failing again are in the new file.
+            failed.remove()
+        else:
+            logger.info("No failed keys in {}.".format(DEAD_LETTER_FILE))
+        metrics_collector.stop()
+        metrics_sink.report()
+        sys.exit(0)
+
+    if PIPELINE:
+        progress = s3br.report_progress(
+            restore_config.stats, config=restore_config)
+        run_pipeline(restore_config, manager)
+        progress.stop()
+        metrics_collector.stop()
+        metrics_sink.report()
+        sys.exit(0)
+
+    src_inventory = None
+    if SRC_INVENTORY:
+        src_inventory = s3br.Inventory(SRC_INVENTORY, config=restore_config)
+
+    src_manifest = None
+    if MANIFEST_DIR:
+        src_manifest = s3br.Manifest(
+            MANIFEST_DIR, SRC_BUCKET, max_age=MANIFEST_MAX_AGE,
+            prefixes=PREFIXES, shard=SHARD)
+
+    src_checkpoint = None
+    if LISTING_CHECKPOINT_DIR:
+        src_checkpoint = s3br.ListingCheckpoint(
+            LISTING_CHECKPOINT_DIR, SRC_BUCKET)
+
     # Getting S3 objects from source bucket
     logger.info("List S3 Keys from {}".format(SRC_BUCKET))
     src_obj = s3br.get_objects(
         SRC_BUCKET,
         config=restore_config,
-        objects_count=OBJECTS_COUNT)
+        objects_count=OBJECTS_COUNT,
+        processes=LISTING_PROCESSES,
+        thread_count=LISTING_THREADS,
+        with_metadata=True,
+        compact=COMPACT_LISTING,
+        manifest=src_manifest,
+        refresh=SRC_REFRESH,
+        inventory=src_inventory,
+        prefixes=PREFIXES,
+        shard=SHARD,
+        checkpoint=src_checkpoint)
     logger.info("{} objects in {}.".format(len(src_obj), SRC_BUCKET))
 
     # If either --all is set or --check-deleted-tag is not set.
     # All objects will be copied from source bucket to destination bucket.
     # No checks like checking if object is tagged as deleted will happen.
     if ALL or not CHECK_DELETED_TAG:
-        [restore_queue.put(o) for o in src_obj]
+        s3br.schedule(restore_queue, src_obj)
         logger.info("{} objects to restore".format(restore_queue.qsize()))
     # If --check-deleted-tag is set, script will check if S3 object has
     # TagSet Key: Deleted, Value: True set. Only those who are not tagged as
     # mentioned will be put to restore queue and will be copied.
     elif CHECK_DELETED_TAG:
-        [check_deleted_q.put(o) for o in src_obj]
+        s3br.schedule(check_deleted_q, src_obj)
         check_deleted_q_size = check_deleted_q.qsize()
         logger.info("{} objects to check for 'Deleted' tag."
                     .format(check_deleted_q_size))
@@ -214,12 +456,14 @@ if __name__ == '__main__':
         # Starting compare process
         processes = min(rst_q_size, CPU_COUNT)
         proc_lst = list()
+        progress = s3br.report_progress(
+            restore_config.stats, total=rst_q_size, config=restore_config)
         logger.info("Starting {} retore processes.".format(processes))
         for p in range(processes):
-            proc_lst.append(s3br.MpRestore(
+            proc_lst.append(RESTORE_PROCESS(
                 config=restore_config,
                 restore_queue=restore_queue,
-                thread_count=25
+                thread_count=RESTORE_WORKERS
             ))
             proc_lst[p].start()
         logger.info("{} restore processes are started.".format(CPU_COUNT))
@@ -231,7 +475,7 @@ if __name__ == '__main__':
                     logger.debug("{} still alive waiting 60s."
                                  .format(proc_lst[p].name))
                     time.sleep(60)
-                    qs = restore_queue.qsize()
+                    qs = max(rst_q_size - progress.delta()['objects'], 0)
                     s3br.put_metric(
                         'ObjectsToRestore', qs, config=restore_config)
             except KeyboardInterrupt:
@@ -240,9 +484,14 @@ if __name__ == '__main__':
             else:
                 proc_lst[p].join(restore_config.timeout)
                 logger.debug("{} finished.".format(proc_lst[p].name))
+        progress.stop()
         logger.info("All restore processes are finished.")
         s3br.put_metric('ObjectsToRestore', 0, config=restore_config)
         logger.info("Restoring objects took {} seconds."
                     .format(time.time() - start))
     else:
         logger.info("No objects to restore.")
+
+    # Totals, rates and request latencies of the run
+    metrics_collector.stop()
+    metrics_sink.report()
@@ -1,6 +1,25 @@
-from .objects import get_objects, delete_objects
+from .config import Config
+from .objects import get_objects, iter_objects, delete_objects
+from .objects import S3Object, key_of
+from .objects import normalize_prefixes, parse_shard, in_shard
+from .keystore import KeyStore
+from .manifest import Manifest
+from .checkpoint import ListingCheckpoint
+from .inventory import Inventory
 from .backup import MpBackup
 from .restore import MpRestore
+from .aio import MpAsyncBackup, MpAsyncRestore
 from .tagging import MpTagDeletedObjects, MpCheckDeletedTag
-from .compare import MpCompare
-from .cw import put_metric
+from .compare import MpCompare, compare_listings, diff_listings
+from .compare import merge_join, ONLY_SRC, BOTH, ONLY_DST
+from .cw import put_metric, flush_metrics, set_sink, record_latency
+from .metrics import create_sink, collect_metrics, SINKS
+from .metrics import LatencyHistogram
+from .stats import SharedStats, report_progress
+from .ratelimit import RateLimiter, PrefixScheduler, key_prefix, schedule
+from .retry import Backoff, DelayQueue, DeadLetters
+from .retry import error_class, MAX_ATTEMPTS, RestorePending
+from .queues import drain, report_copied
+from .transfer import copy_object, submit_copy
+from .multipart import PartCopy, MultipartCoordinator, MultipartJournal
+from .multipart import coordinate_multipart, part_count, source_part_ranges
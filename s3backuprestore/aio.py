@@ -0,0 +1,352 @@
+"""Copies with asyncio, thousands of requests in flight per process."""
+
+import asyncio
+import multiprocessing
+import queue
+import sys
+from botocore.exceptions import ClientError, EndpointConnectionError
+
+try:
+    from aiobotocore.config import AioConfig
+except ImportError:
+    AioConfig = None
+
+from .cw import put_metric
+from .log import logger
+from .multipart import (MAX_COPY_SIZE, PartCopy, part_copy_args, part_count,
+                        part_done, skip_part)
+from .objects import S3Object, key_of
+from .queues import drained, report_copied
+from .ratelimit import get_limiter
+from .retry import DelayQueue, RestorePending
+from .stats import (OBJECTS, BYTES, RETRIES, SLOWDOWNS, IN_FLIGHT,
+                    stats_slot)
+from .transfer import copy_object
+
+
+class _MpAsync(multiprocessing.Process):
+    # Metrics of successful copies
+    objects_metric = 'ObjectsCopied'
+    bytes_metric = 'BytesCopied'
+    # Kind of work recorded in the dead letters
+    kind = 'copy'
+
+    def __init__(self, config, work_queue, thread_count=1000,
+                 cw_metric_name='BackupObjectsErrors', input_done=None,
+                 max_wait=300):
+        """Process copying the objects of a queue with coroutines.
+
+        One event loop runs thread_count coroutines sharing a single
+        aiobotocore client, so a process keeps thousands of requests in
+        flight without a thread each. Items of the shared queue are fetched
+        by one coroutine and handed to the others through an asyncio queue.
+        Failed items are put back into it by timers of the event loop after
+        their backoff, items without attempts left are given up, see
+        s3backuprestore.retry.DelayQueue.
+
+        Args:
+            config (s3backuprestore.config.Config): Configuration object
+            for this class.
+            work_queue (Queue): A consumable queue, like Queue.queue().
+            thread_count (int, optional): Defaults to 1000. Number of
+            coroutines, i.e. requests in flight of this process.
+            cw_metric_name (str, optional): Defaults to
+            'BackupObjectsErrors'. Cloudwatch metric name where errors are
+            pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the queue.
+            max_wait (int, optional): Defaults to 300. Longest waiting time
+            of a failed key before its retry.
+        """
+
+        multiprocessing.Process.__init__(self)
+        self.config = config
+        self.work_queue = work_queue
+        self.timeout = self.config.timeout
+        self.thread_count = thread_count
+        self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
+        self.max_wait = max_wait
+
+    def run(self):
+        if AioConfig is None:
+            logger.error("The asyncio engine requires aiobotocore.")
+            put_metric(self.cw_metric_name, 1, self.config)
+            sys.exit(127)
+
+        queue_size = self.work_queue.qsize()
+        logger.debug("{} queue size {}".format(self.name, queue_size))
+        if not queue_size and not self.input_done:
+            logger.warning("No objects to copy for {}!".format(self.name))
+            return
+        if self.input_done:
+            concurrency = self.thread_count
+        else:
+            concurrency = min(self.thread_count, queue_size)
+
+        # Coroutines share one slot, they all run in the same thread.
+        self._stats = stats_slot(self.config)
+        # Only counts attempts, the timers of the event loop keep the
+        # items waiting for their retry.
+        self._retries = DelayQueue(cap=self.max_wait, kind=self.kind,
+                                   dead_letters=self.config.dead_letters)
+        self._limiter = get_limiter(self.config)
+        try:
+            asyncio.run(self._main(concurrency))
+        except KeyboardInterrupt:
+            logger.info("Exiting...")
+            sys.exit(127)
+        logger.info("{} all copy coroutines finished.".format(self.name))
+
+    async def _main(self, concurrency):
+        loop = asyncio.get_running_loop()
+        session = self.config.aio_session()
+        async with session.create_client(
+                's3',
+                region_name=self.config.region,
+                config=AioConfig(max_pool_connections=concurrency)) as client:
+            pending = asyncio.Queue()
+            # Limits the items taken from the shared queue, so other
+            # processes get their share.
+            slots = asyncio.Semaphore(2 * concurrency)
+            logger.info("{} starting {} coroutines."
+                        .format(self.name, concurrency))
+            workers = [asyncio.ensure_future(
+                self._worker(client, pending, slots))
+                for _ in range(concurrency)]
+
+            while not await loop.run_in_executor(
+                    None, drained, self.work_queue, self.input_done):
+                await slots.acquire()
+                try:
+                    obj = await loop.run_in_executor(
+                        None, self.work_queue.get, True, self.timeout)
+                except queue.Empty:
+                    slots.release()
+                    logger.warning("Queue seems empty. Checking again.")
+                    continue
+                pending.put_nowait(obj)
+
+            await pending.join()
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _worker(self, client, pending, slots):
+        while True:
+            obj = await pending.get()
+            key = key_of(obj)
+            if not self._limiter.try_start(self.config.dst_bucket, key):
+                # The prefix is at its cap, other prefixes go first.
+                self._retry_later(pending, obj, self._retries.deferral(obj))
+                continue
+            delay = None
+            # Waits for a token of the prefix shared by all processes.
+            wait = self._limiter.reserve(self.config.dst_bucket, key)
+            if wait:
+                await asyncio.sleep(wait)
+            self._stats.add(IN_FLIGHT)
+            try:
+                logger.info("{} copying {}".format(self.name, key))
+                objects, size = await self._copy(client, obj)
+            except RestorePending as exc:
+                # Checks count as attempts of their own class.
+                delay = None
+                if self._retries.should_retry(obj, exc):
+                    delay = self._retries.backoff.failed(obj)
+                    logger.info("Request is ongoing for {}. Checking again "
+                                "in {:.0f}s.".format(key, delay))
+                else:
+                    put_metric('ObjectsFailed', 1, self.config)
+            except ClientError as exc:
+                error_code = exc.response.get('Error', {}).get('Code', '')
+                if 'SlowDown' in error_code:
+                    logger.warning("SlowDown occurs for {}.".format(key))
+                    put_metric('SlowDown', 1, self.config)
+                    self._stats.add(SLOWDOWNS)
+                    self._limiter.slowdown(self.config.dst_bucket, key)
+                else:
+                    logger.error("{}\n Key {}".format(exc.response, key))
+                    put_metric(self.cw_metric_name, 1, self.config)
+                delay = self._failed(obj, exc)
+            except (ConnectionRefusedError, EndpointConnectionError) as exc:
+                logger.warning("Connection failed for {}.".format(key))
+                put_metric(self.cw_metric_name, 1, self.config)
+                delay = self._failed(obj, exc)
+            except Exception as exc:
+                logger.exception("Unhandeld exception occured for {}."
+                                 .format(key))
+                put_metric(self.cw_metric_name, 1, self.config)
+                delay = self._failed(obj, exc)
+            else:
+                logger.info("{} copied {}".format(self.name, key))
+                self._limiter.success(self.config.dst_bucket, key)
+                self._retries.done(obj)
+                if objects:
+                    put_metric(self.objects_metric, objects, self.config)
+                    self._stats.add(OBJECTS, objects)
+                    await asyncio.get_running_loop().run_in_executor(
+                        None, report_copied, self.config, key)
+                if size:
+                    put_metric(self.bytes_metric, size, self.config)
+                    self._stats.add(BYTES, size)
+            finally:
+                self._stats.add(IN_FLIGHT, -1)
+                self._limiter.done(self.config.dst_bucket, key)
+
+            if delay is None:
+                slots.release()
+                pending.task_done()
+            else:
+                # The coroutine goes on with other keys meanwhile.
+                self._retry_later(pending, obj, delay)
+
+    def _failed(self, obj, exc):
+        """Counts a failed attempt and returns the time until its retry.
+
+        Returns:
+            [float]: Seconds until the retry, None if obj was given up.
+        """
+
+        if not self._retries.should_retry(obj, exc):
+            put_metric('ObjectsFailed', 1, self.config)
+            return None
+        delay = self._retries.backoff.failed(obj)
+        self._stats.add(RETRIES)
+        logger.info("Retrying {} in {:.0f}s, attempt {}.".format(
+            key_of(obj), delay, self._retries.attempts(obj) + 1))
+        return delay
+
+    def _retry_later(self, pending, obj, delay):
+        def requeue():
+            pending.put_nowait(obj)
+            # Only now the item is done, pending.join() waits for retries.
+            pending.task_done()
+        asyncio.get_running_loop().call_later(delay, requeue)
+
+    async def _copy(self, client, obj, extra_args=None):
+        """Copies an object or a part.
+
+        Returns:
+            [tuple]: Number of objects and bytes copied.
+        """
+
+        loop = asyncio.get_running_loop()
+        if isinstance(obj, PartCopy):
+            try:
+                response = await client.upload_part_copy(
+                    **part_copy_args(self.config, obj))
+            except ClientError as exc:
+                if await loop.run_in_executor(
+                        None, skip_part, self.config, obj, exc):
+                    return 0, 0
+                raise
+            await loop.run_in_executor(None, self.config.multipart_queue.put,
+                                       part_done(obj, response))
+            # The coordinator counts the object when it is complete.
+            return 0, obj.last_byte - obj.first_byte + 1
+
+        if not self._single_request(obj):
+            # Keys of unknown size and objects which have to be copied in
+            # parts go to the transfer manager of this process.
+            await loop.run_in_executor(
+                None, copy_object, self.config.transfer_manager(),
+                self.config.src_bucket, self.config.dst_bucket, obj,
+                extra_args)
+            return 1, getattr(obj, 'size', None) or 0
+
+        await client.copy_object(
+            CopySource={'Bucket': self.config.src_bucket, 'Key': obj.key},
+            Bucket=self.config.dst_bucket,
+            Key=obj.key,
+            **(extra_args or {}))
+        return 1, obj.size
+
+    def _multipart_threshold(self):
+        return self.config.s3_transfer_manager().multipart_threshold
+
+    def _single_request(self, obj):
+        """Returns True if obj is copied with a single CopyObject."""
+        if not isinstance(obj, S3Object) or obj.size is None:
+            return False
+        if obj.size > MAX_COPY_SIZE:
+            return False
+        if obj.size < self._multipart_threshold():
+            return True
+        # Objects uploaded at once keep their ETag with CopyObject.
+        return part_count(obj.etag) is None
+
+
+class MpAsyncBackup(_MpAsync):
+    def __init__(self, config, copy_queue, thread_count=1000,
+                 cw_metric_name='BackupObjectsErrors', input_done=None):
+        """Backs up the objects of a queue with coroutines.
+
+        Drop-in replacement of s3backuprestore.backup.MpBackup, see
+        _MpAsync. thread_count is the number of coroutines.
+
+        Args:
+            config (s3backuprestore.config.Config): Configuration object
+            for this class.
+            copy_queue (Queue): A consumable queue, like Queue.queue().
+            thread_count (int, optional): Defaults to 1000. Number of
+            coroutines of this process.
+            cw_metric_name (str, optional): Defaults to
+            'BackupObjectsErrors'. Cloudwatch metric name where errors are
+            pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the copy queue.
+        """
+
+        _MpAsync.__init__(self, config, copy_queue, thread_count,
+                          cw_metric_name, input_done)
+
+    async def _copy(self, client, obj):
+        return await _MpAsync._copy(self, client, obj,
+                                    extra_args=self.config.extra_args)
+
+
+class MpAsyncRestore(_MpAsync):
+    objects_metric = 'ObjectsRestored'
+    bytes_metric = 'BytesRestored'
+    kind = 'restore'
+
+    def __init__(self, config, restore_queue, thread_count=1000,
+                 cw_metric_name='RestoreObjectsErrors', input_done=None):
+        """Restores the objects of a queue with coroutines.
+
+        Drop-in replacement of s3backuprestore.restore.MpRestore, see
+        _MpAsync. Objects in GLACIER are retried until their restore is
+        finished.
+
+        Args:
+            config (s3backuprestore.config.Config): Configuration object
+            for this class.
+            restore_queue (Queue): A consumable queue, like Queue.queue().
+            thread_count (int, optional): Defaults to 1000. Number of
+            coroutines of this process.
+            cw_metric_name (str, optional): Defaults to
+            'RestoreObjectsErrors'. Cloudwatch metric name where errors are
+            pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the restore queue.
+        """
+
+        _MpAsync.__init__(self, config, restore_queue, thread_count,
+                          cw_metric_name, input_done)
+
+    async def _copy(self, client, obj):
+        # Records from listing already know their storage class, only
+        # objects in GLACIER need a request for their restore status.
+        if isinstance(obj, S3Object) and obj.storage_class:
+            if 'GLACIER' not in obj.storage_class:
+                return await _MpAsync._copy(self, client, obj)
+
+        response = await client.head_object(
+            Bucket=self.config.src_bucket, Key=key_of(obj))
+        storage_class = response.get('StorageClass') or ''
+        ongoing_req = response.get('Restore') or ''
+        restored = 'ongoing-request="false"' in ongoing_req
+        if 'GLACIER' in storage_class and not restored:
+            raise RestorePending(key_of(obj))
+        return await _MpAsync._copy(self, client, obj)
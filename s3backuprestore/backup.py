@@ -3,16 +3,24 @@ import queue
 import sys
 import threading
 import time
-from random import randint
 from botocore.exceptions import ClientError, EndpointConnectionError
 
 from .cw import put_metric
 from .log import logger
+from .multipart import PartCopy, copy_part
+from .objects import S3Object, key_of
+from .queues import drained, report_copied
+from .ratelimit import get_limiter
+from .retry import DelayQueue
+from .stats import (OBJECTS, BYTES, RETRIES, SLOWDOWNS, IN_FLIGHT,
+                    stats_slot)
+from .transfer import copy_object
 
 
 class _Backup(threading.Thread):
     def __init__(self, config, copy_queue, max_wait=300,
-                 cw_metric_name='BackupObjectsErrors'):
+                 cw_metric_name='BackupObjectsErrors', input_done=None,
+                 retries=None):
         """Class which will copy objects from source bucket to
         destination bucket using boto3s copy method.
 
@@ -22,17 +30,23 @@ class _Backup(threading.Thread):
 
         You have to provide a configuration object provided by
         s3backuprestore.config.Config() and a consumable queue filled
-        with S3 keys.
+        with S3 keys or s3backuprestore.objects.S3Object records.
 
         Args:
             config (s3backuprestore.config.Config()): Configuration object
             for this class.
             copy_queue (Queue): A consumable queue like Queue.queue()
-            max_wait (int, optional): Defaults to 300. Waiting time if there
-            are any errors, holds the thread and starts it after a range
-            between 1 and max_wait.
+            max_wait (int, optional): Defaults to 300. Longest waiting time
+            of a failed key before its retry.
             cw_metric_name (str, optional): Defaults to 'BackupObjectsErrors'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the copy queue. Until then the
+            thread keeps waiting for keys even if the queue is empty.
+            retries (s3backuprestore.retry.DelayQueue, optional): Defaults
+            to None. Delay queue failed keys wait in, shared by the threads
+            of a process. Defaults to one of the thread's own. Keys failing
+            too often are given up, see DelayQueue.fail().
         """
         threading.Thread.__init__(self)
         self.config = config
@@ -44,122 +58,135 @@ class _Backup(threading.Thread):
         self.extra_args = self.config.extra_args
         self.cw_metric_name = cw_metric_name
         self.copy_queue = copy_queue
+        self.input_done = input_done
         self.max_wait = max_wait
+        if retries is None:
+            retries = DelayQueue(cap=max_wait, kind='copy',
+                                 dead_letters=self.config.dead_letters)
+        self.retries = retries
         # Sets the thred in daemon mode. See:
         # https://docs.python.org/3/library/threading.html#threading.Thread.daemon
         self.daemon = True
-        self._session = self.config.boto3_session()
-        self._transfer_mgr = self.config.s3_transfer_manager()
+        self._stats = stats_slot(self.config)
+        self._limiter = get_limiter(self.config)
 
     def run(self):
-        waiter = 1
         try:
-            s3 = self._session.resource('s3')
+            s3 = self.config.client('s3')
+            transfer_manager = self.config.transfer_manager()
+            copy_slots = self.config.copy_slots()
         except:
             logger.exception("")
             put_metric(self.cw_metric_name, 1, self.config)
             sys.exit(127)
 
-        while not self.copy_queue.empty():
-            logger.debug("Copy queue size: {} keys"
-                         .format(self.copy_queue.qsize()))
+        while self.retries or not drained(self.copy_queue, self.input_done):
+            logger.debug("Copy queue size: {} keys, {} retries pending."
+                         .format(self.copy_queue.qsize(), len(self.retries)))
             try:
-                key = self.copy_queue.get(timeout=self.timeout)
+                # Keys due for a retry go first.
+                obj = self.retries.get(self.copy_queue, self.timeout)
+                key = key_of(obj)
                 logger.info("Got key {} from copy queue.".format(key))
             except queue.Empty as exc:
-                logger.warning("Copy queue seems empty. Checking again.")
+                if not len(self.retries):
+                    logger.warning("Copy queue seems empty. Checking again.")
                 continue
 
-            # Preparing copy task
-            dst_obj = s3.Object(self.dst_bucket, key)
-            cp_src = {'Bucket': self.src_bucket, 'Key': key}
+            if not self._limiter.try_start(self.dst_bucket, key):
+                # The prefix is at its cap, other prefixes go first.
+                self.retries.defer(obj)
+                continue
+            # Waits for a token of the prefix shared by all processes.
+            self._limiter.acquire(self.dst_bucket, key)
+            self._stats.add(IN_FLIGHT)
             try:
                 logger.info("{} copying {}".format(self.name, key))
-                dst_obj.copy(
-                    cp_src,
-                    ExtraArgs=self.extra_args,
-                    Config=self._transfer_mgr)
+                # Copies of all threads share the limit of the process.
+                with copy_slots:
+                    if isinstance(obj, PartCopy):
+                        # Part of a large object, see MultipartCoordinator.
+                        part_size = copy_part(s3, self.config, obj)
+                    else:
+                        copy_object(
+                            transfer_manager,
+                            self.src_bucket,
+                            self.dst_bucket,
+                            obj,
+                            extra_args=self.extra_args)
             except ClientError as exc:
                 try:
                     error_code = exc.response['Error']['Code']
                     if 'SlowDown' in error_code:
-                        logger.warning("SlowDown occurs. Waiting for {:.0f}s"
-                                       .format(waiter))
+                        logger.warning("SlowDown occurs for {}.".format(key))
                         logger.debug("{}\n Key {}".format(exc.response, key))
                         put_metric('SlowDown', 1, self.config)
+                        self._stats.add(SLOWDOWNS)
+                        self._limiter.slowdown(self.dst_bucket, key)
                     elif 'InternalError' in error_code:
-                        logger.warning("InternalError occurs. Waiting for "
-                                       "{:.0f}s".format(waiter))
+                        logger.warning("InternalError occurs for {}."
+                                       .format(key))
                         put_metric(self.cw_metric_name, 1, self.config)
                         logger.debug("{}\n Key {}".format(exc.response, key))
                     else:
                         logger.error("{}\n Key {}".format(exc.response, key))
                         put_metric(self.cw_metric_name, 1, self.config)
-                except KeyError as exc:
-                    if "reached max retries" in str(exc.__context__):
+                except KeyError:
+                    if "reached max retries" in str(exc):
                         logger.warning("Max retries reached.")
-                        logger.debug(exc.__context__)
+                        logger.debug(exc)
                     else:
                         logger.exception("No Errcode in exception response.")
-                        logger.debug(exc.__context__)
-                    self.copy_queue.put(key, timeout=self.timeout)
+                        logger.debug(exc)
                     put_metric(self.cw_metric_name, 1, self.config)
-                    logger.debug("Error occured sleeping for {}s."
-                                 .format(waiter))
-                    time.sleep(waiter)
-                    # Increase maximum of waiting time
-                    waiter = randint(1, min(self.max_wait, waiter * 4))
-                    logger.debug("Next waiting time {}s.".format(waiter))
-                else:
-                    logger.error("Put {} back to queue.".format(key))
-                    self.copy_queue.put(key, timeout=self.timeout)
-                    logger.debug("Error occured sleeping for {}s."
-                                 .format(waiter))
-                    time.sleep(waiter)
-                    # Increase maximum of waiting time
-                    waiter = randint(1, min(self.max_wait, waiter * 4))
-                    logger.debug("Next waiting time {}s.".format(waiter))
+                self._retry(obj, exc)
             except ConnectionRefusedError as exc:
-                logger.exception("Waiting for {:.0f}s.\n"
-                                 "Put {} back to queue.\n"
-                                 "Maybe to many connections?"
-                                 .format(waiter, key))
+                logger.exception("Connection refused for {}.\n"
+                                 "Maybe to many connections?".format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.copy_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
+                self._retry(obj, exc)
             except EndpointConnectionError as exc:
-                logger.warning("EndpointConnectionError.\n"
-                               "Waiting for {:.0f}s.\n"
-                               "Put {} back to queue.\n"
-                               .format(waiter, key))
+                logger.warning("EndpointConnectionError for {}.".format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.copy_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
-            except:
-                logger.exception("Unhandeld exception occured.\n \
-                                 Put {} back to queue.".format(key))
+                self._retry(obj, exc)
+            except Exception as exc:
+                logger.exception("Unhandeld exception occured for {}."
+                                 .format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.copy_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
+                self._retry(obj, exc)
             else:
                 logger.info("{} copied {}".format(self.name, key))
-                # Reduce waiting time
-                waiter = max(round(waiter * 0.8), 1)
-                logger.debug("Reduced waiting time to {}s.".format(waiter))
+                self._limiter.success(self.dst_bucket, key)
+                self.retries.done(obj)
+                if isinstance(obj, PartCopy):
+                    # The coordinator counts the object when it is complete.
+                    put_metric('BytesCopied', part_size, self.config)
+                    self._stats.add(BYTES, part_size)
+                else:
+                    put_metric('ObjectsCopied', 1, self.config)
+                    self._stats.add(OBJECTS)
+                    report_copied(self.config, key)
+                    if isinstance(obj, S3Object):
+                        put_metric('BytesCopied', obj.size, self.config)
+                        self._stats.add(BYTES, obj.size)
+            finally:
+                self._stats.add(IN_FLIGHT, -1)
+                self._limiter.done(self.dst_bucket, key)
+
+    def _retry(self, obj, exc):
+        """Puts a failed key into the delay queue of the process."""
+        delay = self.retries.fail(obj, exc)
+        if delay is None:
+            put_metric('ObjectsFailed', 1, self.config)
+            return
+        self._stats.add(RETRIES)
+        logger.info("Retrying {} in {:.0f}s, attempt {}.".format(
+            key_of(obj), delay, self.retries.attempts(obj) + 1))
 
 
 class MpBackup(multiprocessing.Process):
     def __init__(self, config, copy_queue, thread_count=10,
-                 cw_metric_name='ObjectsToCopy'):
+                 cw_metric_name='ObjectsToCopy', input_done=None):
         """Class which will start _Backup() threads.
 
         This class will start processes with _Backup() threads so that they can
@@ -174,6 +201,9 @@ class MpBackup(multiprocessing.Process):
             which will be spawned in each process.
             cw_metric_name (str, optional): Defaults to 'ObjectsToCopy'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the copy queue. If it is
+            given the threads are started even if the queue is still empty.
         """
 
         multiprocessing.Process.__init__(self)
@@ -182,24 +212,35 @@ class MpBackup(multiprocessing.Process):
         self.timeout = self.config.timeout
         self.thread_count = thread_count
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
 
     def run(self):
         copy_queue_size = self.copy_queue.qsize()
         logger.debug("{} copy queue size {}"
                      .format(self.name, copy_queue_size))
-        if copy_queue_size:
-            thread_count = min(self.thread_count, copy_queue_size)
+        if copy_queue_size or self.input_done:
+            if self.input_done:
+                thread_count = self.thread_count
+            else:
+                thread_count = min(self.thread_count, copy_queue_size)
 
             # Start copying S3 objects from
             # source bucket to destiantion bucket
             # Consume copy_queue until it is empty
             th_lst = list()
+            # Failed keys wait for their retry in a queue of this process.
+            retries = DelayQueue(kind='copy',
+                                 dead_letters=self.config.dead_letters)
+            # All threads share the client of this process.
+            self.config.warm_up(thread_count)
             logger.info("{} starting {} threads."
                         .format(self.name, thread_count))
             for t in range(thread_count):
                 th_lst.append(_Backup(
                     self.config,
-                    self.copy_queue))
+                    self.copy_queue,
+                    input_done=self.input_done,
+                    retries=retries))
                 logger.debug("{} {} generated."
                              .format(self.name, th_lst[t].name))
                 th_lst[t].start()
@@ -208,7 +249,7 @@ class MpBackup(multiprocessing.Process):
 
             try:
                 logger.debug("Checking copy queue size if empty.")
-                while not self.copy_queue.empty():
+                while not drained(self.copy_queue, self.input_done):
                     logger.info("Copy queue not empty {} keys. \
                                 Waiting for 60s."
                                 .format(self.copy_queue.qsize()))
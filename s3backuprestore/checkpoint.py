@@ -0,0 +1,127 @@
+"""Checkpoints of running listings to resume them after a crash."""
+
+import csv
+import gzip
+import json
+import os
+import shutil
+import time
+import zlib
+
+from .log import logger
+from .objects import S3Object
+
+
+class ListingCheckpoint(object):
+    def __init__(self, directory, bucket, interval=60):
+        """Checkpoints of the partitions of a bucket listing.
+
+        Every partition of a listing, see _discover_partitions(), has its own
+        gzipped CSV file with the records received so far and a state file
+        with the last listed key. The records are appended every interval
+        seconds and the state is replaced afterwards, so a state never
+        points behind its records. A restarted listing continues each
+        partition with StartAfter set to its last key, finished partitions
+        are not listed again.
+
+        The checkpoint is removed by get_objects() after the listing is
+        complete, otherwise a later run would resume an outdated listing.
+
+        Args:
+            directory (str): Directory to store the checkpoints in.
+            bucket (str): S3 bucket.
+            interval (int, optional): Defaults to 60. Seconds between
+            checkpoints of a partition.
+        """
+
+        self.directory = os.path.join(directory, bucket)
+        self.bucket = bucket
+        self.interval = interval
+
+    def _paths(self, partition, shard=None):
+        name = "{:08x}".format(
+            zlib.crc32(repr((partition, shard)).encode('utf-8')))
+        path = os.path.join(self.directory, name)
+        return "{}.csv.gz".format(path), "{}.json".format(path)
+
+    def load(self, partition, shard=None):
+        """Returns the checkpoint of a partition.
+
+        Records appended after the last state was written are dropped and
+        the records file is rewritten without them.
+
+        Args:
+            partition (tuple): (prefix, start_after, end_before)
+            shard (tuple, optional): Defaults to None. Shard of the listing.
+
+        Returns:
+            [tuple]: (records, last_key, done) records is a list of
+            S3Object, last_key is None if there is no checkpoint.
+        """
+
+        path, state_path = self._paths(partition, shard)
+        try:
+            with open(state_path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            # Records saved without a state would be appended to twice.
+            if os.path.isfile(path):
+                os.remove(path)
+            return list(), None, False
+
+        records = list()
+        try:
+            with gzip.open(path, 'rt', newline='') as f:
+                for row in csv.reader(f):
+                    if row[0] > state['last_key']:
+                        break
+                    records.append(S3Object(
+                        row[0], int(row[1]), row[2], float(row[3]), row[4]))
+        except (OSError, EOFError, ValueError, IndexError, zlib.error):
+            # A checkpoint was interrupted while appending records.
+            pass
+        self._write(path, records, 'wt')
+        logger.info("Resuming partition {} of {} after {} with {} objects."
+                    .format(partition, self.bucket, state['last_key'],
+                            len(records)))
+        return records, state['last_key'], state['done']
+
+    def save(self, partition, records, last_key, done=False, shard=None):
+        """Appends records to the checkpoint of a partition.
+
+        Args:
+            partition (tuple): (prefix, start_after, end_before)
+            records (list): S3Object records received since the last save.
+            last_key (str): Last key listed, the listing resumes after it.
+            done (bool, optional): Defaults to False. Marks the partition as
+            completely listed.
+            shard (tuple, optional): Defaults to None. Shard of the listing.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        path, state_path = self._paths(partition, shard)
+        # Each save appends a gzip member, together they are one gzip file.
+        self._write(path, records, 'at')
+
+        tmp_path = "{}.tmp".format(state_path)
+        with open(tmp_path, 'w') as f:
+            json.dump({
+                'partition': partition,
+                'last_key': last_key,
+                'done': done,
+                'saved': time.time(),
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, state_path)
+
+    def clear(self):
+        """Removes all checkpoints of the bucket."""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    @staticmethod
+    def _write(path, records, mode):
+        with gzip.open(path, mode, newline='') as f:
+            csv.writer(f).writerows(records)
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
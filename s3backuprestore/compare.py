@@ -3,20 +3,27 @@ import threading
 import queue
 import multiprocessing
 import time
-from random import randint
 from datetime import datetime, timedelta, timezone
 
 from .cw import put_metric
 from .log import logger
+from .objects import key_of
+from .queues import drained
+from .retry import DelayQueue
+from .stats import OBJECTS, RETRIES, IN_FLIGHT, stats_slot
 
 
 class _Compare(threading.Thread):
     def __init__(self, config, compare_queue, copy_queue, max_wait=300,
-                 cw_metric_name='CompareObjectsErrors'):
+                 cw_metric_name='CompareObjectsErrors', input_done=None,
+                 retries=None):
         """Class that compares objects and check if they are unequal.
 
         This class consumes compare_queue and compares objects between
-        source bucket and destiantion bucket if they are unequal. If objects
+        source bucket and destiantion bucket if they are unequal.
+        The queue holds either S3 keys or pairs of source and destination
+        s3backuprestore.objects.S3Object records, pairs are compared
+        without requesting S3. If objects
         exists and are unequal they will be put into the copy queue and will
         be consumed elswehre.
         There are two kinds of parameters that will be checked.
@@ -30,11 +37,16 @@ class _Compare(threading.Thread):
             for this class.
             compare_queue (Queue): A consumable queue like Queue.queue()
             copy_queue (Queue): A consumable queue like Queue.queue()
-            max_wait (int, optional): Defaults to 300. If something went wrong
-            and will be catched by an exception. We will wait for a particular
-            time range. The range is between 1 and max_wait.
+            max_wait (int, optional): Defaults to 300. Longest waiting time
+            of a failed key before its retry.
             cw_metric_name (str, optional): Defaults to 'CompareObjectsErrors'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the compare queue. Until then
+            the thread keeps waiting for keys even if the queue is empty.
+            retries (s3backuprestore.retry.DelayQueue, optional): Defaults
+            to None. Delay queue failed keys wait in, shared by the threads
+            of a process. Defaults to one of the thread's own.
         """
 
         threading.Thread.__init__(self)
@@ -50,66 +62,69 @@ class _Compare(threading.Thread):
         self.cw_metric_name = cw_metric_name
         self.compare_queue = compare_queue
         self.copy_queue = copy_queue
+        self.input_done = input_done
         self.max_wait = max_wait
+        if retries is None:
+            retries = DelayQueue(cap=max_wait, kind='compare',
+                                 dead_letters=self.config.dead_letters)
+        self.retries = retries
         # Sets the thred in daemon mode. See:
         # https://docs.python.org/3/library/threading.html#threading.Thread.daemon
         self.daemon = True
-        self._session = config.boto3_session()
+        self._stats = stats_slot(self.config)
 
     def run(self):
-        waiter = 1
         try:
-            s3 = self._session.resource('s3')
+            s3 = self.config.client('s3')
         except:
             logger.exception("")
             put_metric(self.cw_metric_name, 1, self.config)
             sys.exit(127)
 
-        while not self.compare_queue.empty():
-            logger.debug("Compare queue size: {} keys"
-                         .format(self.compare_queue.qsize()))
+        while self.retries or not drained(self.compare_queue, self.input_done):
+            logger.debug("Compare queue size: {} keys, {} retries pending."
+                         .format(self.compare_queue.qsize(),
+                                 len(self.retries)))
             try:
-                key = self.compare_queue.get(timeout=self.timeout)
-                logger.info("Got key {} from compare queue.".format(key))
+                # Keys due for a retry go first.
+                key = self.retries.get(self.compare_queue, self.timeout)
             except queue.Empty:
-                logger.warning("Compare queue seems empty. Checking again.")
+                if not len(self.retries):
+                    logger.warning("Compare queue seems empty. "
+                                   "Checking again.")
                 continue
 
+            # A pair of source and destination records from listing can be
+            # compared without requesting the objects metadata.
+            if not isinstance(key, str):
+                self._compare_records(*key)
+                continue
+            logger.info("Got key {} from compare queue.".format(key))
+
+            self._stats.add(IN_FLIGHT)
             try:
-                src_lm = s3.Object(self.src_bucket, key).last_modified
+                src_head = s3.head_object(Bucket=self.src_bucket, Key=key)
+                src_lm = src_head['LastModified']
                 logger.info("\n{}\nLastModified {}".format(key, src_lm))
 
-                src_cl = s3.Object(self.src_bucket, key).content_length
-                dst_cl = s3.Object(self.dst_bucket, key).content_length
+                src_cl = src_head['ContentLength']
+                dst_cl = s3.head_object(
+                    Bucket=self.dst_bucket, Key=key)['ContentLength']
                 logger.info("\n{}\nSource ContentLength: \t{}\n"
                             "Destination ContentLength: \t{}"
                             .format(key, src_cl, dst_cl))
-
-                waiter = max(round(waiter * 0.8), 1)
-                logger.debug("Reduced waiting time to {}s.".format(waiter))
             except ConnectionRefusedError as exc:
-                logger.error("Put {} back to queue.".format(key))
+                logger.error("Connection refused for {}.".format(key))
                 logger.debug("", exc_info=True)
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.compare_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-
-                # Set next waiting time
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
-            except:
-                logger.exception("Unhandeld exception occured.\n \
-                                 Put {} back to compare queue.".format(key))
+                self._retry(key, exc)
+            except Exception as exc:
+                logger.exception("Unhandeld exception occured for {}."
+                                 .format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.compare_queue.put(key, timeout=self.timeout)
-
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-                # Increase waiting time
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
+                self._retry(key, exc)
             else:
+                self.retries.done(key)
                 if src_cl != dst_cl:
                     logger.info("Content length is unequal between"
                                 "source and destination object.\n"
@@ -121,11 +136,52 @@ class _Compare(threading.Thread):
                                 .format(self.last_modified, key))
                     self.copy_queue.put(key, timeout=self.timeout)
                 logger.debug("Comparing for {} done.".format(key))
+                put_metric('ObjectsCompared', 1, self.config)
+                self._stats.add(OBJECTS)
+            finally:
+                self._stats.add(IN_FLIGHT, -1)
+
+    def _retry(self, key, exc):
+        """Puts a failed key into the delay queue of the process."""
+        delay = self.retries.fail(key, exc)
+        if delay is None:
+            put_metric('ObjectsFailed', 1, self.config)
+            return
+        self._stats.add(RETRIES)
+        logger.info("Retrying {} in {:.0f}s, attempt {}.".format(
+            key, delay, self.retries.attempts(key) + 1))
+
+    def _compare_records(self, src_obj, dst_obj):
+        """Compares records of source and destination object.
+
+        Same checks as in run() but based on the metadata received while
+        listing both buckets, so no request to S3 is needed.
+
+        Args:
+            src_obj (s3backuprestore.objects.S3Object): Source record.
+            dst_obj (s3backuprestore.objects.S3Object): Destination record.
+        """
+
+        logger.info("Got records for {} from compare queue."
+                    .format(src_obj.key))
+        if src_obj.size != dst_obj.size:
+            logger.info("Content length is unequal between"
+                        "source and destination object.\n"
+                        "Adding {} to copy queue.".format(src_obj.key))
+            self.copy_queue.put(src_obj, timeout=self.timeout)
+        elif src_obj.last_modified > self.timedelta.timestamp():
+            logger.info("Object modified within last {}h.\n"
+                        "Adding {} to queue."
+                        .format(self.last_modified, src_obj.key))
+            self.copy_queue.put(src_obj, timeout=self.timeout)
+        logger.debug("Comparing for {} done.".format(src_obj.key))
+        put_metric('ObjectsCompared', 1, self.config)
+        self._stats.add(OBJECTS)
 
 
 class MpCompare(multiprocessing.Process):
     def __init__(self, config, compare_queue, copy_queue, thread_count=5,
-                 cw_metric_name='ObjectsToCompare'):
+                 cw_metric_name='ObjectsToCompare', input_done=None):
         """Class which will start _Compare
 
         [description]
@@ -138,6 +194,9 @@ class MpCompare(multiprocessing.Process):
             thread_count (int, optional): Defaults to 5.
             cw_metric_name (str, optional): Defaults to 'ObjectsToCompare'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the compare queue. If it is
+            given the threads are started even if the queue is still empty.
         """
 
         multiprocessing.Process.__init__(self)
@@ -147,20 +206,29 @@ class MpCompare(multiprocessing.Process):
         self.timeout = self.config.timeout
         self.thread_count = thread_count
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
 
     def run(self):
         compare_queue_size = self.compare_queue.qsize()
         logger.debug("{} compare queue size {}"
                      .format(self.name, compare_queue_size))
 
-        if compare_queue_size:
-            thread_count = min(self.thread_count, compare_queue_size)
+        if compare_queue_size or self.input_done:
+            if self.input_done:
+                thread_count = self.thread_count
+            else:
+                thread_count = min(self.thread_count, compare_queue_size)
 
             # Start comparing S3 keys
             # Consume compare_queue until it is empty
             # Put all keys to copy_queue if they are different
             # between source bucket and destination bucket.
             th_lst = list()
+            # Failed keys wait for their retry in a queue of this process.
+            retries = DelayQueue(kind='compare',
+                                 dead_letters=self.config.dead_letters)
+            # All threads share the client of this process.
+            self.config.warm_up(thread_count)
             logger.info("{} starting {} threads."
                         .format(self.name, thread_count))
 
@@ -169,7 +237,9 @@ class MpCompare(multiprocessing.Process):
                 th_lst.append(_Compare(
                     self.config,
                     self.compare_queue,
-                    self.copy_queue))
+                    self.copy_queue,
+                    input_done=self.input_done,
+                    retries=retries))
                 logger.debug("{} {} generated."
                              .format(self.name, th_lst[t].name))
                 th_lst[t].start()
@@ -181,7 +251,7 @@ class MpCompare(multiprocessing.Process):
             try:
                 logger.debug("{} checking compare queue size if empty."
                              .format(self.name))
-                while not self.compare_queue.empty():
+                while not drained(self.compare_queue, self.input_done):
                     logger.info("{} compare queue not empty {} keys."
                                 "Waiting for 60s."
                                 .format(self.name, self.compare_queue.qsize()))
@@ -218,3 +288,133 @@ class MpCompare(multiprocessing.Process):
             logger.info("{} all compare threads finished.".format(self.name))
         else:
             logger.warning("No objects to compare for {}!".format(self.name))
+
+
+# Sides of merge_join()
+ONLY_SRC = 'only_src'
+BOTH = 'both'
+ONLY_DST = 'only_dst'
+
+
+def merge_join(src_obj, dst_obj):
+    """Joins two key sorted listings in a single pass.
+
+    S3 lists keys in lexicographic order of their UTF-8 bytes, which is the
+    order of Python strings as well. Both listings are consumed lazily and
+    only one element of each is held at a time, so they can be generators
+    like the pages of iter_objects() chained together.
+
+    Args:
+        src_obj (iterable): Keys or S3Object records of source bucket.
+        dst_obj (iterable): Keys or S3Object records of destination bucket.
+
+    Raises:
+        ValueError: If one of the listings is not sorted.
+
+    Yields:
+        [tuple]: (side, src, dst) side is ONLY_SRC, BOTH or ONLY_DST, src
+        and dst are the elements of both listings or None.
+    """
+
+    def sorted_iter(listing):
+        last = None
+        for obj in listing:
+            key = key_of(obj)
+            if last is not None and key <= last:
+                raise ValueError("Listing is not sorted at key {}."
+                                 .format(key))
+            last = key
+            yield key, obj
+
+    src_it = sorted_iter(src_obj)
+    dst_it = sorted_iter(dst_obj)
+    src = next(src_it, None)
+    dst = next(dst_it, None)
+    while src is not None or dst is not None:
+        if dst is None or (src is not None and src[0] < dst[0]):
+            yield ONLY_SRC, src[1], None
+            src = next(src_it, None)
+        elif src is None or src[0] > dst[0]:
+            yield ONLY_DST, None, dst[1]
+            dst = next(dst_it, None)
+        else:
+            yield BOTH, src[1], dst[1]
+            src = next(src_it, None)
+            dst = next(dst_it, None)
+
+
+def _same_etag(src_etag, dst_etag):
+    # Hex digits of ETags are compared regardless of their case.
+    return (src_etag or '').lower() == (dst_etag or '').lower()
+
+
+def diff_listings(src_obj, dst_obj, last_modified=48, compare_etag=False):
+    """Streams the differences of source and destination listing.
+
+    Both listings are joined by merge_join() and have to hold
+    s3backuprestore.objects.S3Object records. An object has to be copied if
+    it is missing in destination bucket, if its size or (if compare_etag is
+    set) its ETag differs or if it was modified within last_modified hours.
+    Objects only in destination bucket are deleted in source bucket.
+    Equal objects are skipped. No request to S3 is needed.
+
+    Args:
+        src_obj (iterable): Key sorted S3Object records of source bucket.
+        dst_obj (iterable): Key sorted S3Object records of destination
+        bucket.
+        last_modified (int, optional): Defaults to 48. Hours since now
+        back to the past to check objects if they are where modified.
+        compare_etag (bool, optional): Defaults to False. Compare ETags as
+        well, only reliable if copies keep the part layout of the source.
+
+    Yields:
+        [tuple]: (reason, src, dst) reason is one of 'missing',
+        'size_differs', 'etag_differs', 'modified' or 'deleted'.
+    """
+
+    since = (datetime.now(timezone.utc) - timedelta(
+        hours=last_modified)).timestamp()
+    for side, src, dst in merge_join(src_obj, dst_obj):
+        if side == ONLY_SRC:
+            yield 'missing', src, dst
+        elif side == ONLY_DST:
+            yield 'deleted', src, dst
+        elif src.size != dst.size:
+            yield 'size_differs', src, dst
+        elif compare_etag and not _same_etag(src.etag, dst.etag):
+            yield 'etag_differs', src, dst
+        elif src.last_modified > since:
+            yield 'modified', src, dst
+
+
+def compare_listings(src_obj, dst_obj, last_modified=48, compare_etag=False):
+    """Compares listings of source and destination bucket in memory.
+
+    Replaces _Compare threads if both listings hold
+    s3backuprestore.objects.S3Object records, see diff_listings().
+
+    Args:
+        src_obj (iterable): Key sorted S3Object records of source bucket.
+        dst_obj (iterable): Key sorted S3Object records of destination
+        bucket.
+        last_modified (int, optional): Defaults to 48. Hours since now
+        back to the past to check objects if they are where modified.
+        compare_etag (bool, optional): Defaults to False. Compare ETags as
+        well, only reliable if copies keep the part layout of the source.
+
+    Returns:
+        [tuple]: (copy_obj, stats) copy_obj is the list of source records to
+        copy, stats counts them by reason.
+    """
+
+    stats = dict.fromkeys(
+        ('missing', 'size_differs', 'etag_differs', 'modified'), 0)
+    copy_obj = list()
+    for reason, src, dst in diff_listings(
+            src_obj, dst_obj, last_modified, compare_etag):
+        if reason != 'deleted':
+            stats[reason] += 1
+            copy_obj.append(src)
+
+    logger.info("{} objects to copy: {}".format(len(copy_obj), stats))
+    return copy_obj, stats
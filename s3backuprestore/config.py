@@ -1,5 +1,21 @@
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import boto3
 from boto3.s3.transfer import TransferConfig
+from botocore.config import Config as BotocoreConfig
+from s3transfer.manager import TransferManager
+
+try:
+    from aiobotocore.session import get_session as get_aio_session
+except ImportError:
+    get_aio_session = None
+
+from .cw import instrument_session
+from .log import logger
 
 
 class Config(object):
@@ -7,7 +23,10 @@ class Config(object):
                  secret_key=None, token=None, timeout=120, last_modified=48,
                  extra_args=None, cw_namespace='BackupRecovery',
                  cw_dimension_name='Dev', profile_name=None,
-                 region='eu-central-1', s3_transfer_manager_conf=None):
+                 region='eu-central-1', s3_transfer_manager_conf=None,
+                 metrics_queue=None, stats=None, max_pool_connections=50,
+                 multipart_queue=None, rate_limiter=None,
+                 dead_letters=None, copied_queue=None):
         """This class provides an easy to use configuration interface.
         This object is used by all classes of this module.
 
@@ -46,6 +65,27 @@ class Config(object):
             optional): Defaults to None. Configuraion object for
             boto3.s3.copy() method. See: http://boto3.readthedocs.io/en/latest/
             reference/customizations/s3.html#boto3.s3.transfer.TransferConfig
+            metrics_queue (multiprocessing.Queue, optional): Defaults to None.
+            Queue processes forward their metrics to instead of publishing
+            them, see s3backuprestore.metrics.collect_metrics().
+            stats (s3backuprestore.stats.SharedStats, optional): Defaults to
+            None. Counters in shared memory the workers update, see
+            s3backuprestore.stats.report_progress().
+            max_pool_connections (int, optional): Defaults to 50. Size of
+            the connection pool of each client, at least the number of
+            threads per process sharing it.
+            multipart_queue (multiprocessing.Queue, optional): Defaults to
+            None. Queue workers report copied parts of large objects to,
+            see s3backuprestore.multipart.coordinate_multipart().
+            rate_limiter (s3backuprestore.ratelimit.RateLimiter, optional):
+            Defaults to None. Request rates shared by the workers of all
+            processes, adapted to SlowDowns of S3.
+            dead_letters (s3backuprestore.retry.DeadLetters, optional):
+            Defaults to None. Store of keys given up after their last
+            attempt.
+            copied_queue (multiprocessing.Queue, optional): Defaults to
+            None. Queue the keys of completely copied objects are put
+            into, see s3backuprestore.queues.report_copied().
         """
 
         self._access_key = access_key
@@ -61,30 +101,62 @@ class Config(object):
         self._profile_name = profile_name
         self.region = region
         self._s3_transfer_manager_conf = s3_transfer_manager_conf
+        self.metrics_queue = metrics_queue
+        self.stats = stats
+        self.max_pool_connections = max_pool_connections
+        self.multipart_queue = multipart_queue
+        self.rate_limiter = rate_limiter
+        self.dead_letters = dead_letters
+        self.copied_queue = copied_queue
+        self._init_cache()
+
+    def _init_cache(self):
+        # Session and clients of the process which created them
+        self._pid = os.getpid()
+        self._session = None
+        self._clients = dict()
+        self._transfer_manager = None
+        self._copy_slots = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # Sessions, clients and locks are not pickable, every process
+        # creates its own.
+        for name in ('_pid', '_session', '_clients', '_transfer_manager',
+                     '_copy_slots', '_lock'):
+            del state[name]
+        # Shared memory can only be passed to processes while starting them,
+        # other copies, e.g. for pools, go without stats and rate limits.
+        if multiprocessing.context.get_spawning_popen() is None:
+            state['stats'] = None
+            state['rate_limiter'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._init_cache()
 
     @property
     def access_key(self):
         if self._access_key:
             return self._access_key
         else:
-            self.get_credentials()
-            return self._access_key
+            return self.get_credentials().access_key
 
     @property
     def secret_key(self):
         if self._secret_key:
             return self._secret_key
         else:
-            self.get_credentials()
-            return self._secret_key
+            return self.get_credentials().secret_key
 
     @property
     def token(self):
         if self._token:
             return self._token
         else:
-            self.get_credentials()
-            return self._token
+            return self.get_credentials().token
 
     @property
     def profile_name(self):
@@ -96,6 +168,7 @@ class Config(object):
         self._access_key = None
         self._secret_key = None
         self._token = None
+        self._init_cache()
 
     @property
     def extra_args(self):
@@ -125,11 +198,36 @@ class Config(object):
     # are not pickable, therefore we need a functionality that provides
     # a reusable session.
     def boto3_session(self):
-        if self._access_key and self._secret_key and self._token:
+        """Returns the session of this process.
+
+        The session is created once per process and shared by its threads.
+        Only keys given to the config are static, otherwise the session
+        resolves the credentials itself, so temporary credentials of
+        instance profiles or assumed roles are refreshed before they expire.
+
+        Returns:
+            [boto3.session.Session]: Session of this process.
+        """
+
+        with self._lock:
+            return self._get_session()
+
+    def _get_session(self):
+        # A forked process must not share the connections of its parent.
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._session = None
+            self._clients = dict()
+            self._transfer_manager = None
+        if self._session is not None:
+            return self._session
+
+        if self._access_key and self._secret_key:
             session = boto3.session.Session(
                 aws_access_key_id=self._access_key,
                 aws_secret_access_key=self._secret_key,
-                aws_session_token=self._token)
+                aws_session_token=self._token,
+                region_name=self.region)
         elif self._profile_name:
             session = boto3.session.Session(
                 profile_name=self._profile_name,
@@ -137,17 +235,143 @@ class Config(object):
         else:
             session = boto3.session.Session(region_name=self.region)
 
-        creds = session.get_credentials()
-        self._access_key = creds.access_key
-        self._secret_key = creds.secret_key
-        self._token = creds.token
+        # Latencies of all S3 requests are published as metrics.
+        self._session = instrument_session(session, self)
+        return self._session
+
+    def client(self, service_name='s3', region_name=None):
+        """Returns the client of this process for a service.
+
+        Clients are created once per process and are shared by all its
+        threads, which is safe for botocore clients. Their connection pools
+        hold max_pool_connections connections kept alive between requests.
+
+        Args:
+            service_name (str, optional): Defaults to 's3'. AWS service.
+            region_name (str, optional): Defaults to None. AWS region,
+            defaults to the region of the config.
+
+        Returns:
+            [botocore.client.BaseClient]: Client shared by the process.
+        """
+
+        region_name = region_name or self.region
+        with self._lock:
+            session = self._get_session()
+            key = (service_name, region_name)
+            client = self._clients.get(key)
+            if client is None:
+                client = session.client(
+                    service_name,
+                    region_name=region_name,
+                    config=BotocoreConfig(
+                        max_pool_connections=self.max_pool_connections))
+                self._clients[key] = client
+        return client
+
+    def aio_session(self):
+        """Returns a new aiobotocore session for the asyncio engine.
+
+        Unlike boto3_session() the session is not cached, its clients belong
+        to the event loop they are created in.
 
-        return session
+        Raises:
+            ImportError: If aiobotocore is not installed.
+
+        Returns:
+            [aiobotocore.session.AioSession]: Session with the credentials
+            and region of the config.
+        """
+
+        if get_aio_session is None:
+            raise ImportError("The asyncio engine requires aiobotocore.")
+        session = get_aio_session()
+        if self._access_key and self._secret_key:
+            session.set_credentials(
+                self._access_key, self._secret_key, self._token)
+        elif self._profile_name:
+            session.set_config_variable('profile', self._profile_name)
+        session.set_config_variable('region', self.region)
+        return instrument_session(session, self)
+
+    def transfer_manager(self):
+        """Returns the transfer manager of this process.
+
+        Threads of the process submit copies of keys of unknown size and
+        of objects it splits into parts to it. Its thread pools live as
+        long as the process, and max_concurrency of the transfer config
+        limits the requests of these copies. Parts split by the multipart
+        coordinator are sent with the client directly, see copy_slots(). It
+        should not exceed max_pool_connections.
+
+        Returns:
+            [s3transfer.manager.TransferManager]: Manager shared by the
+            process.
+        """
+
+        client = self.client('s3')
+        with self._lock:
+            if self._transfer_manager is None:
+                manager = TransferManager(
+                    client, config=self.s3_transfer_manager())
+                # Waits for pending copies when the process exits.
+                multiprocessing.util.Finalize(
+                    manager, manager.shutdown, exitpriority=15)
+                self._transfer_manager = manager
+        return self._transfer_manager
+
+    def copy_slots(self):
+        """Returns the semaphore limiting the copies of this process.
+
+        It has max_concurrency slots of the transfer config. Backup workers
+        hold a slot for each copy, a part split by the multipart coordinator
+        or a copy submitted to the transfer manager, so the copies in flight
+        of all threads of the process stay within max_concurrency.
+
+        Returns:
+            [threading.BoundedSemaphore]: Semaphore shared by the threads
+            of the process.
+        """
+
+        with self._lock:
+            if self._copy_slots is None:
+                self._copy_slots = threading.BoundedSemaphore(
+                    self.s3_transfer_manager().max_concurrency)
+        return self._copy_slots
+
+    def warm_up(self, connections=None, bucket=None):
+        """Opens connections of the S3 client of this process.
+
+        Sends concurrent HeadBucket requests, so the connections are
+        established and kept alive before the workers start.
+
+        Args:
+            connections (int, optional): Defaults to None. Number of
+            connections to open, defaults to max_pool_connections.
+            bucket (str, optional): Defaults to None. Bucket to request,
+            defaults to the source bucket.
+        """
+
+        connections = min(connections or self.max_pool_connections,
+                          self.max_pool_connections)
+        bucket = bucket or self.src_bucket
+        client = self.client('s3')
+
+        def head_bucket(_):
+            try:
+                client.head_bucket(Bucket=bucket)
+            except Exception as exc:
+                logger.debug("Warming up connection failed: {}".format(exc))
+
+        with ThreadPoolExecutor(max_workers=connections) as executor:
+            list(executor.map(head_bucket, range(connections)))
 
     def get_credentials(self):
-        session = self.boto3_session()
-        creds = session.get_credentials()
-        self._access_key = creds.access_key
-        self._secret_key = creds.secret_key
-        self._token = creds.token
-        return creds
+        """Returns the current credentials of the session.
+
+        Returns:
+            [botocore.credentials.ReadOnlyCredentials]: Access key, secret
+            key and token valid at the time of the call.
+        """
+
+        return self.boto3_session().get_credentials().get_frozen_credentials()
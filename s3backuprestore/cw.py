@@ -1,16 +1,147 @@
+import os
 import sys as sys
+import threading
+import time
 
-from .config import Config
 from .log import logger
+from .metrics import CloudWatchSink, QueueSink
+
+# Sinks of this process by (pid, namespace, dimension name, region)
+_sinks = dict()
+_sinks_lock = threading.Lock()
+# Sink set by set_sink() and the pid of the process which set it
+_sink = None
+
+
+def set_sink(sink):
+    """Sets the sink of all metrics put by this process.
+
+    Worker processes do not inherit it, they forward metrics to the parent
+    if their Config has a metrics_queue, see collect_metrics().
+
+    Args:
+        sink (s3backuprestore.metrics.MetricsSink): The sink, None restores
+        the default.
+    """
+
+    global _sink
+    _sink = (os.getpid(), sink) if sink is not None else None
+
+
+def get_sink(config=None, cw_dimension_name=None, cw_namespace=None,
+             region=None):
+    """Returns the sink of this process for a namespace and dimension.
+
+    This is the sink set by set_sink(). Otherwise if config has a
+    metrics_queue it is a QueueSink forwarding to the parent process,
+    else a CloudWatchSink.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object, its
+        namespace, dimension name and region take precedence.
+        cw_dimension_name (str, optional): Defaults to None. Cloudwatch
+        dimension name.
+        cw_namespace (str, optional): Defaults to None. Cloudwatch namespace.
+        region (str, optional): Defaults to None. AWS region.
+
+    Returns:
+        [s3backuprestore.metrics.MetricsSink]: Sink shared by all threads of
+        the process.
+    """
+
+    if _sink is not None and _sink[0] == os.getpid():
+        return _sink[1]
+    if config:
+        cw_dimension_name = config.cw_dimension_name
+        cw_namespace = config.cw_namespace
+        region = config.region
+    metrics_queue = getattr(config, 'metrics_queue', None)
+    # The pid is part of the key, a forked process needs its own thread.
+    key = (os.getpid(), cw_namespace, cw_dimension_name, region,
+           metrics_queue is not None)
+    with _sinks_lock:
+        sink = _sinks.get(key)
+        if sink is None:
+            if metrics_queue is not None:
+                sink = QueueSink(metrics_queue)
+            else:
+                sink = CloudWatchSink(
+                    config=config,
+                    cw_dimension_name=cw_dimension_name,
+                    cw_namespace=cw_namespace,
+                    region=region)
+            _sinks[key] = sink
+    return sink
+
+
+def flush_metrics():
+    """Sends pending metrics of all sinks of this process."""
+    sinks = [s for k, s in list(_sinks.items()) if k[0] == os.getpid()]
+    if _sink is not None and _sink[0] == os.getpid():
+        sinks.append(_sink[1])
+    for sink in sinks:
+        sink.flush()
+
+
+def record_latency(operation, seconds, config=None):
+    """Counts the latency of a request in the sink of this process.
+
+    Args:
+        operation (str): Name of the operation, e.g. HeadObject.
+        seconds (float): Latency of the request.
+        config (s3backuprestore.config.Config, optional): Defaults to None.
+        Configuration object to find the sink with, see get_sink().
+    """
+
+    try:
+        sink = get_sink(config)
+    except:
+        logger.exception("")
+        return
+    sink.record(operation, seconds)
+
+
+def instrument_session(session, config=None):
+    """Records the latency of all S3 requests made with a session.
+
+    The handlers are registered to the events of the session, so they are
+    copied to every client and resource created from it afterwards. The
+    latency of a request includes the retries of botocore.
+
+    Args:
+        session (boto3.session.Session): Session to instrument, botocore
+        and aiobotocore sessions work as well.
+        config (s3backuprestore.config.Config, optional): Defaults to None.
+        Configuration object to find the sink with, see get_sink().
+
+    Returns:
+        [boto3.session.Session]: The session.
+    """
+
+    def before_call(context, **kwargs):
+        context['s3br_started'] = time.perf_counter()
+
+    def after_call(context, event_name, **kwargs):
+        started = context.pop('s3br_started', None)
+        if started is not None:
+            record_latency(event_name.rsplit('.', 1)[-1],
+                           time.perf_counter() - started, config)
+
+    # boto3 sessions wrap the events of their botocore session.
+    events = getattr(session, 'events', session)
+    events.register('before-call.s3', before_call)
+    events.register('after-call.s3', after_call)
+    events.register('after-call-error.s3', after_call)
+    return session
 
 
 def put_metric(cw_metric_name, statistic_value, config=None,
                cw_dimension_name=None, cw_namespace=None):
     """Function that will put metrics to cloudwatch.
 
-    This function puts metrics to cloudwatch.
-    If statistic_value is 0 it will be converted to 0.1 it is not possible
-    to 0 to cloudwatch.
+    The value is aggregated by the sink of this process and sent with the
+    next batch, see get_sink(). This function does not block on the
+    network.
 
     Args:
         cw_metric_name (str): Name of the cloudwatch metric.
@@ -25,53 +156,22 @@ def put_metric(cw_metric_name, statistic_value, config=None,
         ValueError: If statistic_value is not convertible to float.
     """
 
-    try:
-        if config:
-            session = config.boto3_session()
-            cw_dimension_name = config.cw_dimension_name
-            cw_namespace = config.cw_namespace
-            region = config.region
-        else:
-            session = Config.boto3_session()
-    except:
-        logger.exception("")
-        sys.exit(127)
+    if config:
+        cw_dimension_name = config.cw_dimension_name
 
     if not cw_dimension_name or not cw_metric_name:
         raise ValueError("You have to specify at least\
                          cw_dimension_name or config parameter")
 
-    cw = session.resource('cloudwatch', region_name=region)
     try:
-        float(statistic_value)
+        statistic_value = float(statistic_value)
     except ValueError:
         logger.error("Statistic value not convertible to float.")
         return False
 
     try:
-        if statistic_value == 0:
-            statistic_value = 0.1
-
-        cw.Metric(cw_namespace, cw_metric_name).put_data(
-            MetricData=[
-                {
-                    'MetricName': cw_metric_name,
-                    'Dimensions': [
-                        {
-                            'Name': cw_dimension_name,
-                            'Value': cw_metric_name
-                        }
-                    ],
-                    'StatisticValues': {
-                        'SampleCount': statistic_value,
-                        'Sum': statistic_value,
-                        'Minimum': statistic_value,
-                        'Maximum': statistic_value
-                    },
-                    'Unit': 'Count',
-                    'StorageResolution': 1
-                }
-            ]
-        )
+        sink = get_sink(config, cw_dimension_name, cw_namespace)
     except:
         logger.exception("")
+        sys.exit(127)
+    sink.put(cw_metric_name, statistic_value)
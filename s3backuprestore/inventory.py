@@ -0,0 +1,255 @@
+"""S3 Inventory reports as listing source."""
+
+import csv
+import gzip
+import heapq
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from datetime import datetime, timezone
+from urllib.parse import unquote_plus, urlparse
+
+from .keystore import KeyStore
+from .log import logger
+from .objects import S3Object, _s3_client, in_shard
+from .objects import normalize_prefixes
+
+try:
+    import pyarrow.orc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+# Column names of ORC and Parquet data files and their names in the
+# fileSchema of CSV reports, which _to_record() reads
+_COLUMNAR_NAMES = {
+    'bucket': 'Bucket',
+    'key': 'Key',
+    'version_id': 'VersionId',
+    'is_latest': 'IsLatest',
+    'is_delete_marker': 'IsDeleteMarker',
+    'size': 'Size',
+    'last_modified_date': 'LastModifiedDate',
+    'e_tag': 'ETag',
+    'storage_class': 'StorageClass',
+}
+
+
+def _read_location(location, config=None):
+    """Returns the content of a local file or of an s3:// URL as bytes."""
+    url = urlparse(location)
+    if url.scheme == 's3':
+        client = _s3_client(config)
+        response = client.get_object(
+            Bucket=url.netloc, Key=url.path.lstrip('/'))
+        return response['Body'].read()
+    with open(location, 'rb') as f:
+        return f.read()
+
+
+def _to_timestamp(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=timezone.utc)
+        return value.timestamp()
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%fZ').replace(
+        tzinfo=timezone.utc).timestamp()
+
+
+def _to_record(row):
+    """Converts a row of an inventory data file to S3Object or None.
+
+    Rows of noncurrent versions and delete markers are skipped.
+    """
+
+    if str(row.get('IsLatest', 'true')).lower() != 'true':
+        return None
+    if str(row.get('IsDeleteMarker', 'false')).lower() == 'true':
+        return None
+    size = row.get('Size')
+    last_modified = row.get('LastModifiedDate')
+    return S3Object(
+        row['Key'],
+        int(size) if size not in (None, '') else 0,
+        (row.get('ETag') or '').strip('"'),
+        _to_timestamp(last_modified) if last_modified else 0.0,
+        row.get('StorageClass') or 'STANDARD')
+
+
+def _read_data_file(args):
+    """Reads one data file of an inventory report into a sorted run.
+
+    Data files are not sorted. The records of one file are sorted in
+    memory and written to a gzipped CSV file, so the caller merges the
+    runs of all files from disk, see _read_run().
+
+    This function is executed inside of a worker process, it has to be
+    defined on module level to be pickable.
+
+    Args:
+        args (tuple): (location, file_format, schema, config, prefixes,
+        shard, run_path)
+
+    Returns:
+        [str]: Path of the run holding the key sorted S3Object records of
+        the data file.
+    """
+
+    location, file_format, schema, config, prefixes, shard, run_path = args
+    start = time.time()
+    data = _read_location(location, config)
+    if file_format == 'CSV':
+        text = io.TextIOWrapper(
+            io.BytesIO(gzip.decompress(data)), encoding='utf-8', newline='')
+        # Keys in CSV reports are URL encoded, spaces as +
+        key_index = schema.index('Key')
+        rows = ({**dict(zip(schema, row)),
+                 'Key': unquote_plus(row[key_index])}
+                for row in csv.reader(text))
+    else:
+        if pyarrow is None:
+            raise ImportError("Reading {} inventory reports requires "
+                              "pyarrow.".format(file_format))
+        if file_format == 'ORC':
+            table = pyarrow.orc.ORCFile(io.BytesIO(data)).read()
+        else:
+            table = pyarrow.parquet.read_table(io.BytesIO(data))
+        table = table.rename_columns(
+            [_COLUMNAR_NAMES.get(n, n) for n in table.column_names])
+        rows = table.to_pylist()
+
+    prefixes = tuple(prefixes)
+    records = [r for r in map(_to_record, rows) if r is not None]
+    records = [r for r in records
+               if r.key.startswith(prefixes) and in_shard(r.key, shard)]
+    records.sort()
+    with gzip.open(run_path, 'wt', newline='') as f:
+        csv.writer(f).writerows(records)
+    logger.info("Read {} objects from {} in {:.0f}s."
+                .format(len(records), location, time.time() - start))
+    return run_path
+
+
+def _read_run(path):
+    """Yields the records of a run written by _read_data_file()."""
+    with gzip.open(path, 'rt', newline='') as f:
+        for row in csv.reader(f):
+            yield S3Object(
+                row[0], int(row[1]), row[2], float(row[3]), row[4])
+
+
+class Inventory(object):
+    def __init__(self, location, config=None, data_dir=None):
+        """S3 Inventory report of a bucket.
+
+        An inventory report consists of a manifest.json which lists the data
+        files (CSV, ORC or Parquet) holding the objects of a bucket. Reading
+        the report costs a few file reads instead of one LIST request per
+        1000 objects. Its records are the same as listing the bucket with
+        metadata, but the report is only as recent as its creation.
+
+        Args:
+            location (str): Path or s3:// URL of the manifest.json.
+            config (Config, optional): Defaults to None. Configuration
+            object, used to read reports stored in S3.
+            data_dir (str, optional): Defaults to None. Directory holding
+            the data files of a local report. By default they are looked
+            up next to the manifest.json and in its data/ subdirectory.
+        """
+
+        self.location = location
+        self.config = config
+        self.data_dir = data_dir
+        self._manifest = None
+
+    def manifest(self):
+        """Returns the parsed manifest.json."""
+        if self._manifest is None:
+            self._manifest = json.loads(
+                _read_location(self.location, self.config))
+        return self._manifest
+
+    def schema(self):
+        """Returns the column names of CSV data files."""
+        manifest = self.manifest()
+        if manifest['fileFormat'] != 'CSV':
+            # Columnar formats carry their schema within the data files.
+            return list()
+        return [f.strip() for f in manifest['fileSchema'].split(',')]
+
+    def data_files(self):
+        """Returns the locations of all data files of the report."""
+        manifest = self.manifest()
+        if urlparse(self.location).scheme == 's3':
+            bucket = manifest['destinationBucket'].split(':::')[-1]
+            return ["s3://{}/{}".format(bucket, f['key'])
+                    for f in manifest['files']]
+
+        locations = list()
+        base = os.path.dirname(os.path.abspath(self.location))
+        for f in manifest['files']:
+            name = os.path.basename(f['key'])
+            candidates = [os.path.join(base, 'data', name),
+                          os.path.join(base, name)]
+            if self.data_dir:
+                candidates.insert(0, os.path.join(self.data_dir, name))
+            locations.append(next(
+                (c for c in candidates if os.path.isfile(c)), candidates[0]))
+        return locations
+
+    def records(self, processes=None, prefixes=None, shard=None):
+        """Yields the key sorted S3Object records of the report.
+
+        Data files are read in parallel by a pool of processes. Each data
+        file is sorted and spilled to a temporary file, the runs are merged
+        from disk while they are yielded. Only one data file per process is
+        held in memory, not the whole report.
+
+        Args:
+            processes (int, optional): Defaults to None. Number of processes
+            reading data files, by default one per CPU.
+            prefixes (str, list, optional): Defaults to None. Only objects
+            beginning with one of these prefixes are yielded.
+            shard (tuple, optional): Defaults to None. Only objects of this
+            shard are yielded.
+
+        Yields:
+            [S3Object]: Records in key order.
+        """
+
+        manifest = self.manifest()
+        files = self.data_files()
+        logger.info("Reading {} data files of inventory report of {}."
+                    .format(len(files), manifest.get('sourceBucket')))
+        with tempfile.TemporaryDirectory(prefix='inventory-') as run_dir:
+            args = [(f, manifest['fileFormat'], self.schema(), self.config,
+                     normalize_prefixes(prefixes), shard,
+                     os.path.join(run_dir, "{}.csv.gz".format(number)))
+                    for number, f in enumerate(files)]
+            with multiprocessing.Pool(processes) as pool:
+                runs = list(pool.imap_unordered(_read_data_file, args))
+            yield from heapq.merge(*map(_read_run, runs))
+
+    def listing(self, objects_count=None, processes=None, with_metadata=True,
+                compact=False, prefixes=None, shard=None, **kwargs):
+        """Returns the report like get_objects() returns a listing.
+
+        This method is called by get_objects() if an inventory is given, all
+        arguments have the same meaning there. Arguments only meaningful for
+        listing a bucket are ignored.
+
+        Returns:
+            [list]: List or KeyStore of S3 keys or S3Object records.
+        """
+
+        objects = itertools.islice(
+            self.records(processes, prefixes, shard), objects_count)
+        if not with_metadata:
+            objects = (o.key for o in objects)
+        if compact:
+            return KeyStore(objects, with_metadata=with_metadata)
+        return list(objects)
@@ -0,0 +1,253 @@
+"""Compact storage for key sorted listings of very large buckets."""
+
+from array import array
+
+from .objects import S3Object, key_of
+
+
+def _write_varint(buf, value):
+    while value > 0x7f:
+        buf.append((value & 0x7f) | 0x80)
+        value >>= 7
+    buf.append(value)
+
+
+def _read_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def _pack_etag(etag):
+    """Returns digest and part count of an ETag or None.
+
+    Part counts are stored plus one, 0 stands for an ETag without part
+    count. ETags which would not be unpacked to the same string, e.g. with
+    upper case hex digits, return None.
+    """
+
+    digest, dash, parts = etag.partition('-')
+    try:
+        raw = bytes.fromhex(digest)
+        count = int(parts) + 1 if dash else 0
+    except ValueError:
+        return None
+    if raw.hex() != digest or len(raw) != 16:
+        return None
+    if dash and str(count - 1) != parts:
+        return None
+    if count > 0xffff:
+        return None
+    return raw, count
+
+
+class KeyStore(object):
+    def __init__(self, objects=None, with_metadata=True, block_size=16):
+        """Array backed store of a key sorted listing.
+
+        Holding every key as a separate str costs around 100 bytes per key.
+        This class front codes the keys instead: each key is stored as the
+        length of the prefix it shares with the previous key followed by the
+        remaining UTF-8 bytes, all in one contiguous buffer. Every
+        block_size keys a block starts with a complete key, the offsets of
+        those blocks allow binary search and random access.
+        Size, last modified, ETag and storage class of each object are kept
+        in fixed width arrays.
+
+        Keys have to be appended in ascending order like S3 lists them.
+        Iterating the store yields S3Object records or, if with_metadata is
+        False, keys. The store is pickable so it can be passed to processes.
+
+        Args:
+            objects (iterable, optional): Defaults to None. Key sorted S3
+            keys or S3Object records to store.
+            with_metadata (bool, optional): Defaults to True. Stores
+            metadata of S3Object records as well.
+            block_size (int, optional): Defaults to 16. Number of keys
+            sharing prefixes in a block.
+        """
+
+        self.with_metadata = with_metadata
+        self.block_size = block_size
+        self._len = 0
+        self._last = None
+        self._data = bytearray()
+        self._blocks = array('Q')
+        self._sizes = array('q')
+        self._mtimes = array('d')
+        self._etags = bytearray()
+        self._parts = array('H')
+        self._classes = array('B')
+        self._class_names = list()
+        # ETags which are not a lower case MD5 hex digest with optional
+        # part count, stored as they are
+        self._odd_etags = dict()
+        if objects is not None:
+            self.extend(objects)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        return self._iter_range(0, self._len)
+
+    def __contains__(self, key):
+        return self.index(key_of(key)) >= 0
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                raise ValueError("KeyStore slices do not support steps.")
+            return KeyStore(
+                self._iter_range(start, stop),
+                with_metadata=self.with_metadata,
+                block_size=self.block_size)
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError("KeyStore index out of range.")
+        return next(self._iter_range(index, index + 1))
+
+    def append(self, obj):
+        """Appends a key or S3Object record.
+
+        Args:
+            obj (str, S3Object): Key or record to append.
+
+        Raises:
+            ValueError: If the key is not greater than the last key.
+        """
+
+        key = key_of(obj).encode('utf-8')
+        if self._last is not None and key <= self._last:
+            raise ValueError("Keys have to be appended in ascending order, "
+                             "got {}.".format(key_of(obj)))
+
+        if self._len % self.block_size == 0:
+            self._blocks.append(len(self._data))
+            shared = 0
+        else:
+            shared = 0
+            limit = min(len(key), len(self._last))
+            while shared < limit and key[shared] == self._last[shared]:
+                shared += 1
+        _write_varint(self._data, shared)
+        _write_varint(self._data, len(key) - shared)
+        self._data += key[shared:]
+        self._last = key
+
+        if self.with_metadata:
+            self._append_metadata(obj)
+        self._len += 1
+
+    def extend(self, objects):
+        for obj in objects:
+            self.append(obj)
+
+    def keys(self):
+        """Yields all keys of the store."""
+        for key, _ in self._iter_keys(0, self._len):
+            yield key
+
+    def index(self, key):
+        """Returns the index of key by binary search or -1."""
+        key = key.encode('utf-8')
+        lo = 0
+        hi = len(self._blocks)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._block_head(mid) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == 0:
+            return -1
+
+        start = (lo - 1) * self.block_size
+        stop = min(start + self.block_size, self._len)
+        for index, (stored, _) in enumerate(
+                self._iter_keys(start, stop, encoded=True), start):
+            if stored == key:
+                return index
+            if stored > key:
+                break
+        return -1
+
+    def chunks(self, size):
+        """Yields consecutive KeyStore slices with size keys each.
+
+        Args:
+            size (int): Number of keys in each chunk.
+        """
+
+        for start in range(0, self._len, size):
+            yield self[start:start + size]
+
+    def nbytes(self):
+        """Returns the number of bytes used by the buffers and arrays."""
+        arrays = (self._blocks, self._sizes, self._mtimes, self._parts,
+                  self._classes)
+        return len(self._data) + len(self._etags) + sum(
+            a.itemsize * len(a) for a in arrays)
+
+    def _append_metadata(self, obj):
+        self._sizes.append(obj.size)
+        self._mtimes.append(obj.last_modified)
+
+        packed = _pack_etag(obj.etag or '')
+        if packed is None:
+            packed = bytes(16), 0
+            self._odd_etags[self._len] = obj.etag
+        self._etags += packed[0]
+        self._parts.append(packed[1])
+
+        if obj.storage_class not in self._class_names:
+            self._class_names.append(obj.storage_class)
+        self._classes.append(self._class_names.index(obj.storage_class))
+
+    def _block_head(self, block):
+        pos = self._blocks[block]
+        _, pos = _read_varint(self._data, pos)
+        length, pos = _read_varint(self._data, pos)
+        return bytes(self._data[pos:pos + length])
+
+    def _iter_keys(self, start, stop, encoded=False):
+        """Yields (key, index) decoding from the block holding start."""
+        if start >= stop:
+            return
+        block = start // self.block_size
+        pos = self._blocks[block]
+        key = b''
+        for index in range(block * self.block_size, stop):
+            shared, pos = _read_varint(self._data, pos)
+            length, pos = _read_varint(self._data, pos)
+            key = key[:shared] + bytes(self._data[pos:pos + length])
+            pos += length
+            if index >= start:
+                yield (key if encoded else key.decode('utf-8')), index
+
+    def _iter_range(self, start, stop):
+        for key, index in self._iter_keys(start, stop):
+            if not self.with_metadata:
+                yield key
+                continue
+
+            if index in self._odd_etags:
+                etag = self._odd_etags[index]
+            else:
+                etag = self._etags[index * 16:index * 16 + 16].hex()
+                if self._parts[index]:
+                    etag = "{}-{}".format(etag, self._parts[index] - 1)
+            yield S3Object(
+                key,
+                self._sizes[index],
+                etag,
+                self._mtimes[index],
+                self._class_names[self._classes[index]])
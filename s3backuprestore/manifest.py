@@ -0,0 +1,270 @@
+"""Local manifests of bucket listings which are refreshed incrementally."""
+
+import csv
+import gzip
+import itertools
+import json
+import os
+import time
+import zlib
+
+from .compare import merge_join, BOTH, ONLY_SRC
+from .keystore import KeyStore
+from .log import logger
+from .objects import S3Object, get_objects, iter_objects, key_of
+from .objects import normalize_prefixes
+
+REFRESH_MODES = ('full', 'verify', 'trust', 'tail')
+
+
+class Manifest(object):
+    def __init__(self, directory, bucket, max_age=None, prefixes=None,
+                 shard=None):
+        """Local manifest of a bucket listing.
+
+        The manifest holds key, size, ETag, last modified and storage class
+        of all objects of a bucket in key order as gzipped CSV file. A state
+        file next to it records when the bucket was listed completely.
+
+        Instead of listing the complete bucket on every run the manifest can
+        be refreshed in one of the following modes:
+            full: Lists the complete bucket and replaces the manifest.
+            verify: Like full but logs how much the manifest differed from
+            the bucket. Use it to invalidate a manifest regularly.
+            trust: Uses the manifest without listing the bucket if it is
+            younger than max_age hours. Meant for the destination bucket
+            whose manifest is updated with every copied object.
+            tail: Lists only keys greater than the last key of the manifest
+            with StartAfter. Fits buckets whose new keys are sorted to the
+            end, e.g. keys beginning with a date.
+        All modes fall back to full if there is no manifest yet.
+
+        A manifest of prefixes or a shard only holds the objects of that
+        scope and is stored under its own name.
+
+        Args:
+            directory (str): Directory to store the manifest in.
+            bucket (str): S3 bucket.
+            max_age (int, optional): Defaults to None. Hours after the last
+            complete listing a manifest is trusted. None trusts it forever.
+            prefixes (str, list, optional): Defaults to None. Prefixes the
+            listing is scoped to.
+            shard (tuple, optional): Defaults to None. Shard the listing is
+            scoped to.
+        """
+
+        self.directory = directory
+        self.bucket = bucket
+        self.max_age = max_age
+        self.prefixes = normalize_prefixes(prefixes)
+        self.shard = shard
+        name = bucket
+        if self.prefixes != [''] or shard is not None:
+            scope = repr((self.prefixes, shard)).encode('utf-8')
+            name = "{}.{:08x}".format(bucket, zlib.crc32(scope))
+        self.path = os.path.join(directory, "{}.csv.gz".format(name))
+        self.state_path = os.path.join(directory, "{}.json".format(name))
+
+    def exists(self):
+        return os.path.isfile(self.path) and os.path.isfile(self.state_path)
+
+    def state(self):
+        """Returns the state of the manifest or an empty dict."""
+        try:
+            with open(self.state_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return dict()
+
+    def is_fresh(self):
+        """Checks if the manifest may be trusted without listing."""
+        listed = self.state().get('listed')
+        if not self.exists() or listed is None:
+            return False
+        if self.max_age is None:
+            return True
+        return time.time() - listed < self.max_age * 3600
+
+    def load(self):
+        """Yields the S3Object records of the manifest in key order."""
+        with gzip.open(self.path, 'rt', newline='') as f:
+            for row in csv.reader(f):
+                yield S3Object(
+                    row[0], int(row[1]), row[2], float(row[3]), row[4])
+
+    def save(self, objects, listed=None):
+        """Replaces the manifest with the key sorted records of objects.
+
+        The manifest is written to a temporary file first, so it is never
+        left incomplete.
+
+        Args:
+            objects (iterable): Key sorted S3Object records.
+            listed (float, optional): Defaults to None. Time of the complete
+            listing the records are based on. None keeps the current one.
+
+        Returns:
+            [int]: Number of records written.
+        """
+
+        os.makedirs(self.directory, exist_ok=True)
+        state = self.state()
+        count = 0
+        last_key = None
+        tmp_path = "{}.tmp".format(self.path)
+        with gzip.open(tmp_path, 'wt', newline='') as f:
+            writer = csv.writer(f)
+            for obj in objects:
+                writer.writerow(obj)
+                count += 1
+                last_key = obj.key
+        os.replace(tmp_path, self.path)
+
+        state.update({
+            'bucket': self.bucket,
+            'prefixes': self.prefixes,
+            'shard': self.shard,
+            'saved': time.time(),
+            'count': count,
+            'last_key': last_key,
+        })
+        if listed is not None:
+            state['listed'] = listed
+        tmp_path = "{}.tmp".format(self.state_path)
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+        logger.info("Saved manifest of {} with {} objects."
+                    .format(self.bucket, count))
+        return count
+
+    def update(self, objects):
+        """Merges records into the manifest, replacing records of same key.
+
+        Args:
+            objects (iterable): S3Object records, e.g. of copied objects.
+        """
+
+        if not self.exists():
+            logger.warning("No manifest of {} to update.".format(self.bucket))
+            return
+        objects = sorted(objects, key=key_of)
+        self.save(src if src is not None else dst
+                  for _, src, dst in merge_join(objects, self.load()))
+
+    def invalidate(self):
+        """Removes the manifest, the next refresh lists the bucket."""
+        for path in (self.path, self.state_path):
+            if os.path.isfile(path):
+                os.remove(path)
+
+    def verify(self, objects):
+        """Logs the differences between a fresh listing and the manifest.
+
+        Args:
+            objects (iterable): Key sorted S3Object records of the bucket.
+
+        Returns:
+            [dict]: Number of objects only in bucket, only in manifest and
+            changed.
+        """
+
+        stats = dict.fromkeys(('new', 'deleted', 'changed'), 0)
+        for side, listed, stored in merge_join(objects, self.load()):
+            if side == ONLY_SRC:
+                stats['new'] += 1
+            elif side == BOTH:
+                if listed != stored:
+                    stats['changed'] += 1
+            else:
+                stats['deleted'] += 1
+        logger.warning("Manifest of {} differed from bucket: {}"
+                       .format(self.bucket, stats))
+        return stats
+
+    def listing(self, config=None, refresh='full', objects_count=None,
+                processes=None, thread_count=None, with_metadata=True,
+                compact=False, checkpoint=None):
+        """Returns the listing of the bucket refreshed as requested.
+
+        This method is called by get_objects() if a manifest is given, all
+        arguments but refresh have the same meaning there.
+
+        Args:
+            config (Config, optional): Defaults to None. Configuration object.
+            refresh (str, optional): Defaults to 'full'. One of
+            REFRESH_MODES, see Manifest.
+            objects_count (int, optional): Defaults to None. Amount of keys
+            to return. The manifest is not saved if the listing is cut.
+            processes (int, optional): Defaults to None. Number of listing
+            processes.
+            thread_count (int, optional): Defaults to None. Number of
+            listing threads in each process.
+            with_metadata (bool, optional): Defaults to True. Returns
+            S3Object records instead of keys.
+            compact (bool, optional): Defaults to False. Returns a KeyStore
+            instead of a list.
+            checkpoint (ListingCheckpoint, optional): Defaults to None.
+            Checkpoint of a complete listing.
+
+        Raises:
+            ValueError: If refresh is not one of REFRESH_MODES.
+
+        Returns:
+            [list]: List or KeyStore of S3 keys or S3Object records.
+        """
+
+        if refresh not in REFRESH_MODES:
+            raise ValueError("Refresh mode has to be one of {}."
+                             .format(", ".join(REFRESH_MODES)))
+        if not self.exists() and refresh != 'full':
+            logger.info("No manifest of {}, listing it completely."
+                        .format(self.bucket))
+            refresh = 'full'
+        start = time.time()
+
+        if refresh == 'trust' and self.is_fresh():
+            logger.info("Trusting manifest of {}.".format(self.bucket))
+        elif refresh == 'tail' and self.state().get('last_key'):
+            last_key = self.state()['last_key']
+            logger.info("Listing {} after {}.".format(self.bucket, last_key))
+            tail = itertools.chain.from_iterable(iter_objects(
+                self.bucket,
+                config=config,
+                with_metadata=True,
+                start_after=last_key,
+                prefixes=self.prefixes,
+                shard=self.shard))
+            self.save(itertools.chain(self.load(), tail))
+        else:
+            if refresh == 'trust':
+                logger.info("Manifest of {} is outdated, listing it "
+                            "completely.".format(self.bucket))
+            objects = get_objects(
+                self.bucket,
+                config=config,
+                objects_count=objects_count,
+                processes=processes,
+                thread_count=thread_count,
+                with_metadata=True,
+                compact=compact,
+                prefixes=self.prefixes,
+                shard=self.shard,
+                checkpoint=checkpoint)
+            if refresh == 'verify':
+                self.verify(objects)
+            if not objects_count:
+                self.save(objects, listed=start)
+            if with_metadata:
+                return objects
+            if compact:
+                return KeyStore((o.key for o in objects),
+                                with_metadata=False)
+            return [o.key for o in objects]
+
+        objects = itertools.islice(self.load(), objects_count)
+        if not with_metadata:
+            objects = (o.key for o in objects)
+        if compact:
+            return KeyStore(objects, with_metadata=with_metadata)
+        return list(objects)
@@ -0,0 +1,606 @@
+"""Sinks metrics are published to."""
+
+import json
+import queue
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import util
+
+import boto3
+
+from .log import logger
+
+SINKS = ('cloudwatch', 'prometheus', 'jsonl', 'null')
+
+# Maximum number of metrics in one PutMetricData request
+_MAX_DATUMS = 1000
+
+
+# Percentiles reported for latencies
+PERCENTILES = (50, 90, 99)
+
+# Maximum number of values of a CloudWatch datum
+_MAX_VALUES = 150
+
+
+def _merge(stats, other):
+    """Merges statistic set other into stats in place."""
+    stats[0] += other[0]
+    stats[1] += other[1]
+    stats[2] = min(stats[2], other[2])
+    stats[3] = max(stats[3], other[3])
+
+
+class LatencyHistogram(object):
+    def __init__(self, significant_bits=8):
+        """Histogram of latencies with a bounded relative error.
+
+        Like a HDR histogram latencies are counted in buckets which grow
+        with the value: microseconds below 2^significant_bits are exact,
+        above the value keeps its significant_bits highest bits. With the
+        default of 8 bits a bucket is at most 0.8% wide relative to its
+        values. Only used buckets are stored, so histograms are small
+        enough to be sent between processes, and they are merged by adding
+        their counts.
+
+        Args:
+            significant_bits (int, optional): Defaults to 8. Precision of
+            the buckets.
+        """
+
+        self.significant_bits = significant_bits
+        self.counts = dict()
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def _index(self, micros):
+        shift = max(micros.bit_length() - self.significant_bits, 0)
+        if not shift:
+            return micros
+        half = 1 << (self.significant_bits - 1)
+        return shift * half + (micros >> shift)
+
+    def _value(self, index):
+        """Returns the middle of a bucket in seconds."""
+        half = 1 << (self.significant_bits - 1)
+        if index < 2 * half:
+            return index / 1e6
+        shift = index // half - 1
+        return (((index - shift * half) << shift) + (1 << shift) / 2) / 1e6
+
+    def record(self, seconds):
+        """Counts a latency in seconds."""
+        index = self._index(max(int(seconds * 1e6), 0))
+        self.counts[index] = self.counts.get(index, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+    def merge(self, other):
+        """Adds the counts of another histogram."""
+        for index, count in other.counts.items():
+            self.counts[index] = self.counts.get(index, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def percentile(self, percent):
+        """Returns the latency percent of all latencies are lower than."""
+        if not self.count:
+            return 0.0
+        rank = self.count * percent / 100
+        seen = 0
+        for index in sorted(self.counts):
+            seen += self.counts[index]
+            if seen >= rank:
+                return min(self._value(index), self.maximum)
+        return self.maximum
+
+    def buckets(self):
+        """Yields (seconds, count) of all used buckets in order."""
+        for index in sorted(self.counts):
+            yield self._value(index), self.counts[index]
+
+
+class MetricsSink(object):
+    def __init__(self, interval=10):
+        """Base class of all metrics sinks.
+
+        put() only merges a value into the statistic set [sample count, sum,
+        minimum, maximum] of its metric and record() a latency into the
+        LatencyHistogram of its operation, so threads never wait for the
+        sink. A background thread hands all statistic sets and histograms
+        to send() every interval seconds. Counters (e.g. 1 per error) are
+        read with the sum, gauges (e.g. queue sizes) with maximum or
+        average.
+
+        Everything sent is added to totals of the run as well, see
+        report().
+
+        Pending metrics are flushed when the process exits, also in
+        processes started by multiprocessing.
+
+        Args:
+            interval (int, optional): Defaults to 10. Seconds between
+            flushes.
+        """
+
+        self.interval = interval
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stats = dict()
+        self._latencies = dict()
+        self._run_stats = dict()
+        self._run_latencies = dict()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        util.Finalize(self, self.close, exitpriority=10)
+
+    def put(self, name, value):
+        """Merges a value into the statistic set of a metric."""
+        self.merge(name, [1, value, value, value])
+
+    def merge(self, name, stats):
+        """Merges a statistic set into the statistic set of a metric."""
+        with self._lock:
+            current = self._stats.get(name)
+            if current is None:
+                self._stats[name] = list(stats)
+            else:
+                _merge(current, stats)
+
+    def record(self, operation, seconds):
+        """Counts the latency of an operation."""
+        with self._lock:
+            histogram = self._latencies.get(operation)
+            if histogram is None:
+                histogram = self._latencies[operation] = LatencyHistogram()
+            histogram.record(seconds)
+
+    def merge_latencies(self, operation, histogram):
+        """Merges a LatencyHistogram into the histogram of an operation."""
+        with self._lock:
+            current = self._latencies.get(operation)
+            if current is None:
+                current = self._latencies[operation] = LatencyHistogram()
+            current.merge(histogram)
+
+    def flush(self):
+        """Sends all pending statistic sets and histograms."""
+        with self._lock:
+            stats, self._stats = self._stats, dict()
+            latencies, self._latencies = self._latencies, dict()
+            for name, values in stats.items():
+                if name in self._run_stats:
+                    _merge(self._run_stats[name], values)
+                else:
+                    self._run_stats[name] = list(values)
+            for operation, histogram in latencies.items():
+                self._run_latencies.setdefault(
+                    operation, LatencyHistogram()).merge(histogram)
+        if not stats and not latencies:
+            return
+        try:
+            self.send(stats, latencies)
+        except:
+            logger.exception("")
+
+    def send(self, stats, latencies):
+        """Sends statistic sets and histograms, implemented by each sink.
+
+        Args:
+            stats (dict): Metric name to [sample count, sum, minimum,
+            maximum].
+            latencies (dict): Operation to LatencyHistogram.
+        """
+
+        raise NotImplementedError
+
+    def report(self, elapsed=None):
+        """Logs and returns the totals of the run.
+
+        Counters are reported with their sum and rate per second,
+        latencies with their PERCENTILES and maximum.
+
+        Args:
+            elapsed (float, optional): Defaults to None. Duration of the
+            run in seconds, by default since the sink was created.
+
+        Returns:
+            [dict]: Metric name to total and rate, operation to count,
+            percentiles and maximum in seconds.
+        """
+
+        self.flush()
+        if elapsed is None:
+            elapsed = time.time() - self.started
+        elapsed = max(elapsed, 1e-6)
+        report = dict()
+        with self._lock:
+            for name, (count, total, _, _) in sorted(
+                    self._run_stats.items()):
+                report[name] = {'total': total, 'per_second': total / elapsed}
+                logger.info("{}: {:.0f} in total, {:.1f}/s."
+                            .format(name, total, total / elapsed))
+            for operation, histogram in sorted(self._run_latencies.items()):
+                entry = {'count': histogram.count,
+                         'max': histogram.maximum}
+                for percent in PERCENTILES:
+                    entry['p{}'.format(percent)] = \
+                        histogram.percentile(percent)
+                report[operation] = entry
+                logger.info("{} latency of {} requests: {}, max {:.3f}s."
+                            .format(operation, histogram.count, ", ".join(
+                                "p{} {:.3f}s".format(p, entry['p{}'.format(p)])
+                                for p in PERCENTILES), histogram.maximum))
+        return report
+
+    def close(self):
+        """Stops the background thread and flushes pending metrics."""
+        self._stop.set()
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+
+class NullSink(MetricsSink):
+    """Sink dropping all metrics."""
+
+    def __init__(self):
+        pass
+
+    def put(self, name, value):
+        pass
+
+    def merge(self, name, stats):
+        pass
+
+    def record(self, operation, seconds):
+        pass
+
+    def merge_latencies(self, operation, histogram):
+        pass
+
+    def flush(self):
+        pass
+
+    def report(self, elapsed=None):
+        return dict()
+
+    def close(self):
+        pass
+
+
+class CloudWatchSink(MetricsSink):
+    def __init__(self, config=None, cw_dimension_name=None,
+                 cw_namespace=None, region=None, interval=10):
+        """Sends statistic sets to CloudWatch.
+
+        All metrics of a flush are sent with as few PutMetricData requests
+        as possible and one client for the lifetime of the process.
+
+        Args:
+            config (s3backuprestore.config.Config, optional): Defaults to
+            None. Configuration object to create the client with.
+            cw_dimension_name (str, optional): Defaults to None. Cloudwatch
+            dimension name.
+            cw_namespace (str, optional): Defaults to None. Cloudwatch
+            namespace.
+            region (str, optional): Defaults to None. AWS region.
+            interval (int, optional): Defaults to 10. Seconds between
+            flushes.
+        """
+
+        self.config = config
+        self.cw_dimension_name = cw_dimension_name
+        self.cw_namespace = cw_namespace
+        self.region = region
+        self._client = None
+        super().__init__(interval=interval)
+
+    def send(self, stats, latencies):
+        metric_data = [
+            {
+                'MetricName': name,
+                'Dimensions': [
+                    {
+                        'Name': self.cw_dimension_name,
+                        'Value': name
+                    }
+                ],
+                'StatisticValues': {
+                    'SampleCount': count,
+                    'Sum': total,
+                    'Minimum': minimum,
+                    'Maximum': maximum
+                },
+                'Unit': 'Count',
+                'StorageResolution': 1
+            }
+            for name, (count, total, minimum, maximum) in stats.items()]
+        # Latencies are sent as distributions, CloudWatch computes the
+        # percentiles of them.
+        for operation, histogram in latencies.items():
+            buckets = list(histogram.buckets())
+            for i in range(0, len(buckets), _MAX_VALUES):
+                values, counts = zip(*buckets[i:i + _MAX_VALUES])
+                metric_data.append({
+                    'MetricName': "{}Latency".format(operation),
+                    'Dimensions': [
+                        {
+                            'Name': self.cw_dimension_name,
+                            'Value': "{}Latency".format(operation)
+                        }
+                    ],
+                    'Values': list(values),
+                    'Counts': [float(c) for c in counts],
+                    'Unit': 'Seconds',
+                    'StorageResolution': 1
+                })
+
+        if self._client is None:
+            if self.config:
+                self._client = self.config.client(
+                    'cloudwatch', region_name=self.region)
+            else:
+                self._client = boto3.session.Session().client(
+                    'cloudwatch', region_name=self.region)
+        for i in range(0, len(metric_data), _MAX_DATUMS):
+            self._client.put_metric_data(
+                Namespace=self.cw_namespace,
+                MetricData=metric_data[i:i + _MAX_DATUMS])
+
+
+class JsonLinesSink(MetricsSink):
+    def __init__(self, path, interval=10):
+        """Appends one JSON object per metric and flush to a file.
+
+        Args:
+            path (str): File to append to.
+            interval (int, optional): Defaults to 10. Seconds between
+            flushes.
+        """
+
+        self.path = path
+        super().__init__(interval=interval)
+
+    def send(self, stats, latencies):
+        now = time.time()
+        with open(self.path, 'a') as f:
+            for name, (count, total, minimum, maximum) in stats.items():
+                f.write(json.dumps({
+                    'time': now,
+                    'metric': name,
+                    'count': count,
+                    'sum': total,
+                    'min': minimum,
+                    'max': maximum,
+                }) + '\n')
+            for operation, histogram in latencies.items():
+                line = {
+                    'time': now,
+                    'latency': operation,
+                    'count': histogram.count,
+                    'max': histogram.maximum,
+                }
+                for percent in PERCENTILES:
+                    line['p{}'.format(percent)] = histogram.percentile(percent)
+                f.write(json.dumps(line) + '\n')
+
+    def report(self, elapsed=None):
+        report = super().report(elapsed)
+        with open(self.path, 'a') as f:
+            line = {'time': time.time(), 'report': report}
+            f.write(json.dumps(line) + '\n')
+        return report
+
+
+class PrometheusSink(MetricsSink):
+    def __init__(self, port=9108, address='', interval=1):
+        """Serves metrics in the Prometheus text format.
+
+        Each metric is exposed as summary of all values since the start,
+        s3backuprestore_<name>_count and _sum, and as gauge
+        s3backuprestore_<name>_max of its most recent statistic set.
+        Latencies of all requests since the start are exposed as summary
+        s3backuprestore_request_seconds with the label operation and the
+        quantiles of PERCENTILES.
+
+        Args:
+            port (int, optional): Defaults to 9108. Port to listen on.
+            address (str, optional): Defaults to ''. Address to listen on,
+            all addresses by default.
+            interval (int, optional): Defaults to 1. Seconds between
+            updates of the exposed values.
+        """
+
+        self._last_max = dict()
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = sink.exposition().encode('utf-8')
+                self.send_response(200)
+                self.send_header(
+                    'Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((address, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True).start()
+        logger.info("Serving metrics on port {}.".format(port))
+        super().__init__(interval=interval)
+
+    def send(self, stats, latencies):
+        for name, values in stats.items():
+            self._last_max[name] = values[3]
+
+    def exposition(self):
+        """Returns all metrics in the Prometheus text format."""
+        lines = list()
+        with self._lock:
+            for name, (count, total, _, _) in sorted(
+                    self._run_stats.items()):
+                metric = "s3backuprestore_{}".format(
+                    re.sub(r'(?<!^)(?=[A-Z])', '_', name).lower())
+                metric = re.sub(r'[^a-zA-Z0-9_]', '_', metric)
+                lines.append("# TYPE {} summary".format(metric))
+                lines.append("{}_count {}".format(metric, count))
+                lines.append("{}_sum {}".format(metric, total))
+                lines.append("# TYPE {}_max gauge".format(metric))
+                lines.append("{}_max {}".format(
+                    metric, self._last_max.get(name, 0)))
+
+            metric = "s3backuprestore_request_seconds"
+            if self._run_latencies:
+                lines.append("# TYPE {} summary".format(metric))
+            for operation, histogram in sorted(self._run_latencies.items()):
+                for percent in PERCENTILES:
+                    lines.append(
+                        '{}{{operation="{}",quantile="{}"}} {}'.format(
+                            metric, operation, percent / 100,
+                            histogram.percentile(percent)))
+                lines.append('{}_count{{operation="{}"}} {}'.format(
+                    metric, operation, histogram.count))
+                lines.append('{}_sum{{operation="{}"}} {}'.format(
+                    metric, operation, histogram.total))
+        return '\n'.join(lines) + '\n'
+
+    def close(self):
+        super().close()
+        self._server.shutdown()
+
+
+class QueueSink(MetricsSink):
+    def __init__(self, metrics_queue, interval=5):
+        """Forwards statistic sets and histograms of a process to its parent.
+
+        Worker processes do not touch the network for metrics, the parent
+        merges their statistic sets into its own sink, see
+        collect_metrics().
+
+        Args:
+            metrics_queue (multiprocessing.Queue): Queue read by the
+            parent.
+            interval (int, optional): Defaults to 5. Seconds between
+            flushes.
+        """
+
+        self.metrics_queue = metrics_queue
+        super().__init__(interval=interval)
+
+    def send(self, stats, latencies):
+        try:
+            self.metrics_queue.put_nowait((stats, latencies))
+        except queue.Full:
+            logger.warning("Metrics queue is full, dropping metrics.")
+
+
+class _Collector(threading.Thread):
+    def __init__(self, metrics_queue, sink):
+        """Merges statistic sets of worker processes into a sink.
+
+        Args:
+            metrics_queue (multiprocessing.Queue): Queue of QueueSink.
+            sink (MetricsSink): Sink of the parent process.
+        """
+
+        super().__init__(daemon=True)
+        self.metrics_queue = metrics_queue
+        self.sink = sink
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._merge(self.metrics_queue.get(timeout=1))
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                # The manager holding the queue is gone.
+                return
+
+    def stop(self):
+        """Stops the thread after merging what is left in the queue."""
+        self._stop_event.set()
+        self.join()
+        try:
+            while True:
+                self._merge(self.metrics_queue.get_nowait())
+        except (queue.Empty, EOFError, OSError):
+            pass
+
+    def _merge(self, item):
+        stats, latencies = item
+        for name, values in stats.items():
+            self.sink.merge(name, values)
+        for operation, histogram in latencies.items():
+            self.sink.merge_latencies(operation, histogram)
+
+
+def collect_metrics(metrics_queue, sink):
+    """Starts merging statistic sets of worker processes into a sink.
+
+    The collector is stopped when the process exits, before the sinks are
+    flushed.
+
+    Args:
+        metrics_queue (multiprocessing.Queue): Queue set as metrics_queue of
+        the Config passed to the workers.
+        sink (MetricsSink): Sink of the parent process.
+
+    Returns:
+        [threading.Thread]: The collecting thread.
+    """
+
+    collector = _Collector(metrics_queue, sink)
+    collector.start()
+    util.Finalize(collector, collector.stop, exitpriority=20)
+    return collector
+
+
+def create_sink(name, config=None, port=9108, path=None):
+    """Creates a sink by name.
+
+    Args:
+        name (str): One of SINKS.
+        config (s3backuprestore.config.Config, optional): Defaults to None.
+        Configuration object, used by the cloudwatch sink.
+        port (int, optional): Defaults to 9108. Port of the prometheus
+        sink.
+        path (str, optional): Defaults to None. File of the jsonl sink.
+
+    Raises:
+        ValueError: If name is not one of SINKS or path is missing.
+
+    Returns:
+        [MetricsSink]: The sink.
+    """
+
+    if name == 'cloudwatch':
+        return CloudWatchSink(
+            config=config,
+            cw_dimension_name=config.cw_dimension_name if config else None,
+            cw_namespace=config.cw_namespace if config else None,
+            region=config.region if config else None)
+    if name == 'prometheus':
+        return PrometheusSink(port=port)
+    if name == 'jsonl':
+        if not path:
+            raise ValueError("The jsonl sink needs a path.")
+        return JsonLinesSink(path)
+    if name == 'null':
+        return NullSink()
+    raise ValueError("Sink has to be one of {}.".format(", ".join(SINKS)))
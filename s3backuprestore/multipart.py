@@ -0,0 +1,622 @@
+"""Multipart copies of large objects distributed over all workers."""
+
+import json
+import os
+import queue
+import re
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import util
+
+from botocore.exceptions import ClientError
+
+from .cw import put_metric
+from .log import logger
+from .objects import S3Object
+from .queues import report_copied
+from .stats import OBJECTS, stats_slot
+
+# S3 limits of multipart uploads and CopyObject
+MAX_PARTS = 10000
+MIN_PART_SIZE = 5 * 1024 ** 2
+MAX_COPY_SIZE = 5 * 1024 ** 3
+
+# ETag of an object uploaded in parts, MD5 of the part MD5s and their count
+_MULTIPART_ETAG = re.compile(r'^"?[0-9a-fA-F]{32}-(\d+)"?$')
+
+# Work item to copy a byte range of the object key into part_number of a
+# multipart upload. etag is the ETag of the source object or None.
+PartCopy = namedtuple(
+    'PartCopy',
+    ['key', 'upload_id', 'part_number', 'first_byte', 'last_byte', 'etag'])
+
+
+def part_count(etag):
+    """Returns the number of parts an object was uploaded in.
+
+    Args:
+        etag (str): ETag of the object.
+
+    Returns:
+        [int]: Number of parts or None if the object was uploaded at once
+        or the ETag is unknown.
+    """
+
+    match = _MULTIPART_ETAG.match(etag or '')
+    return int(match.group(1)) if match else None
+
+
+def part_ranges(size, chunksize):
+    """Splits an object into byte ranges of parts.
+
+    The part size is increased if the object would need more than
+    MAX_PARTS parts.
+
+    Args:
+        size (int): Size of the object in bytes.
+        chunksize (int): Size of a part in bytes.
+
+    Returns:
+        [list]: List of tuples (first_byte, last_byte), both inclusive.
+    """
+
+    chunksize = max(chunksize, MIN_PART_SIZE, -(-size // MAX_PARTS))
+    return [(first, min(first + chunksize, size) - 1)
+            for first in range(0, size, chunksize)]
+
+
+def source_part_ranges(client, bucket, obj, chunksize):
+    """Returns the byte ranges of the parts of a source object.
+
+    Copying an object in the same parts as it was uploaded in reproduces
+    its ETag. The number of parts is taken from the ETag, the part size
+    from HeadObject of the first part. If the parts differ in size they are
+    requested with GetObjectAttributes, which only knows them for objects
+    uploaded with checksums.
+
+    Args:
+        client (botocore.client.BaseClient): S3 client.
+        bucket (str): Source bucket.
+        obj (S3Object): Record of the object.
+        chunksize (int): Size of a part in bytes if the layout of the
+        source is unknown, see part_ranges().
+
+    Returns:
+        [list]: List of tuples (first_byte, last_byte), both inclusive.
+    """
+
+    count = part_count(obj.etag)
+    if count is None:
+        return part_ranges(obj.size, chunksize)
+    if count == 1:
+        return [(0, obj.size - 1)]
+
+    kwargs = {'Bucket': bucket, 'Key': obj.key, 'IfMatch': obj.etag}
+    try:
+        part_size = client.head_object(
+            PartNumber=1, **kwargs)['ContentLength']
+        ranges = [(first, min(first + part_size, obj.size) - 1)
+                  for first in range(0, obj.size, part_size)]
+        if len(ranges) == count:
+            return ranges
+
+        ranges = list()
+        first = 0
+        marker = 0
+        while True:
+            parts = client.get_object_attributes(
+                ObjectAttributes=['ObjectParts'],
+                PartNumberMarker=marker,
+                **kwargs).get('ObjectParts', {})
+            for part in parts.get('Parts', []):
+                ranges.append((first, first + part['Size'] - 1))
+                first += part['Size']
+            if not parts.get('IsTruncated'):
+                break
+            marker = parts['NextPartNumberMarker']
+        if len(ranges) == count and first == obj.size:
+            return ranges
+    except ClientError as exc:
+        logger.debug("Part layout of {} unknown: {}".format(obj.key, exc))
+    logger.warning("Part layout of {} unknown, the ETag of its copy will "
+                   "differ.".format(obj.key))
+    return part_ranges(obj.size, chunksize)
+
+
+def copy_part(client, config, part):
+    """Copies a part of a multipart copy and reports it to the coordinator.
+
+    Parts of uploads which were aborted are skipped. If the source object
+    changed since it was listed the upload is aborted and the object is
+    given up, see MultipartCoordinator.
+
+    Args:
+        client (botocore.client.BaseClient): S3 client.
+        config (s3backuprestore.config.Config): Configuration object with
+        the multipart_queue of the coordinator.
+        part (PartCopy): Part to copy.
+
+    Returns:
+        [int]: Number of bytes copied.
+
+    Raises:
+        ClientError: Other errors of UploadPartCopy, the part should be
+        retried.
+    """
+
+    try:
+        response = client.upload_part_copy(**part_copy_args(config, part))
+    except ClientError as exc:
+        if skip_part(config, part, exc):
+            return 0
+        raise
+    config.multipart_queue.put(part_done(part, response))
+    return part.last_byte - part.first_byte + 1
+
+
+def part_copy_args(config, part):
+    """Returns the arguments of UploadPartCopy for a part as dict."""
+    kwargs = {
+        'Bucket': config.dst_bucket,
+        'Key': part.key,
+        'UploadId': part.upload_id,
+        'PartNumber': part.part_number,
+        'CopySource': {'Bucket': config.src_bucket, 'Key': part.key},
+        'CopySourceRange': 'bytes={}-{}'.format(
+            part.first_byte, part.last_byte),
+    }
+    # Parts of different versions of the source must not be mixed.
+    if part.etag:
+        kwargs['CopySourceIfMatch'] = part.etag
+    return kwargs
+
+
+def part_done(part, response):
+    """Returns the message reporting a copied part to the coordinator."""
+    return ('part', part.upload_id, part.part_number,
+            response['CopyPartResult']['ETag'])
+
+
+def skip_part(config, part, exc):
+    """Handles errors of UploadPartCopy which must not be retried.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object with
+        the multipart_queue of the coordinator.
+        part (PartCopy): Part which failed.
+        exc (ClientError): Error of UploadPartCopy.
+
+    Returns:
+        [bool]: True if the part is to be skipped, because its upload is
+        gone or the source changed.
+    """
+
+    error_code = exc.response.get('Error', {}).get('Code', '')
+    if error_code == 'NoSuchUpload':
+        logger.warning("Upload {} of {} is gone, skipping part {}."
+                       .format(part.upload_id, part.key, part.part_number))
+        return True
+    if error_code in ('PreconditionFailed', '412'):
+        logger.warning("{} changed while copying it in parts."
+                       .format(part.key))
+        config.multipart_queue.put(('abort', part.upload_id, exc))
+        return True
+    return False
+
+
+class MultipartJournal(object):
+    def __init__(self, path):
+        """Journal of multipart copies, to resume them in later runs.
+
+        Each line is a JSON object: "start" of an upload with the record and
+        part size, a copied "part" with its ETag and the "end" of a
+        completed or aborted upload. A truncated last line of a killed run
+        is ignored. The journal is rewritten with the open uploads only when
+        it is loaded.
+
+        Args:
+            path (str): Path of the journal file.
+        """
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+        # Open uploads by id: dict with key, size, etag, chunksize,
+        # initiated and the ETags by part number.
+        self.uploads = self._load()
+
+    def _load(self):
+        uploads = dict()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    if record['op'] == 'start':
+                        uploads[record['upload_id']] = dict(
+                            record, parts=dict())
+                    elif record['op'] == 'part':
+                        upload = uploads.get(record['upload_id'])
+                        if upload is not None:
+                            upload['parts'][record['part']] = record['etag']
+                    else:
+                        uploads.pop(record['upload_id'], None)
+        except FileNotFoundError:
+            return uploads
+
+        tmp_path = "{}.tmp".format(self.path)
+        with open(tmp_path, 'w') as f:
+            for upload_id, upload in uploads.items():
+                self._write(f, self._start_record(upload_id, upload))
+                for number, etag in upload['parts'].items():
+                    self._write(f, {'op': 'part', 'upload_id': upload_id,
+                                    'part': number, 'etag': etag})
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        return uploads
+
+    @staticmethod
+    def _start_record(upload_id, upload):
+        return {'op': 'start', 'upload_id': upload_id, 'key': upload['key'],
+                'size': upload['size'], 'etag': upload['etag'],
+                'chunksize': upload['chunksize'],
+                'initiated': upload['initiated']}
+
+    @staticmethod
+    def _write(f, record):
+        f.write(json.dumps(record))
+        f.write('\n')
+
+    def _append(self, record, sync=False):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._write(self._file, record)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+
+    def find(self, key):
+        """Returns the id and state of an open upload of a key or None."""
+        for upload_id, upload in list(self.uploads.items()):
+            if upload['key'] == key:
+                return upload_id, upload
+        return None
+
+    def start(self, upload_id, obj, chunksize):
+        """Records a new upload of a record."""
+        upload = {'key': obj.key, 'size': obj.size, 'etag': obj.etag,
+                  'chunksize': chunksize, 'initiated': time.time(),
+                  'parts': dict()}
+        self.uploads[upload_id] = upload
+        self._append(self._start_record(upload_id, upload), sync=True)
+
+    def part(self, upload_id, part_number, etag):
+        """Records a copied part of an upload."""
+        upload = self.uploads.get(upload_id)
+        if upload is not None:
+            upload['parts'][part_number] = etag
+        self._append({'op': 'part', 'upload_id': upload_id,
+                      'part': part_number, 'etag': etag})
+
+    def end(self, upload_id):
+        """Records that an upload was completed or aborted."""
+        if self.uploads.pop(upload_id, None) is not None:
+            self._append({'op': 'end', 'upload_id': upload_id}, sync=True)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class MultipartCoordinator(threading.Thread):
+    def __init__(self, config, max_attempts=3, journal=None, max_age=None):
+        """Starts and completes multipart copies of large objects.
+
+        split() starts a multipart upload for each large record and returns
+        its parts as PartCopy work items. The parts keep the layout of the
+        source, so the copy gets the same ETag. They are put into the copy
+        queue like any other object, so the parts of one object are copied
+        by many threads and processes at once. Workers report copied parts with
+        copy_part() through the multipart_queue of the config. This thread
+        completes an upload as soon as all its parts are reported.
+
+        If the source object changed or an upload cannot be completed, the
+        upload is aborted and the key is added to the dead letters of the
+        config, so a run with --retry-failed copies it as a whole. The
+        workers may have finished the copy queue by then. Uploads with
+        missing parts are aborted by stop(), so no orphaned parts are left
+        and billed.
+
+        With a journal uploads with missing parts are kept instead. The
+        next run resumes an upload of an unchanged object, it reconciles
+        the journal with ListParts and copies only the missing parts.
+
+        Args:
+            config (s3backuprestore.config.Config): Configuration object,
+            its multipart_queue has to be set.
+            max_attempts (int, optional): Defaults to 3. Attempts to
+            complete an upload.
+            journal (MultipartJournal, optional): Defaults to None. Journal
+            to resume uploads of earlier runs from.
+            max_age (int, optional): Defaults to None. Hours after which
+            uploads of the journal which were not resumed are aborted by
+            stop(). Other uploads to the destination bucket are left alone,
+            they may belong to other writers.
+        """
+
+        threading.Thread.__init__(self)
+        self.config = config
+        self.max_attempts = max_attempts
+        self.journal = journal
+        self.max_age = max_age
+        self.daemon = True
+        transfer_config = config.s3_transfer_manager()
+        self.threshold = transfer_config.multipart_threshold
+        self.chunksize = transfer_config.multipart_chunksize
+        # Uploads by id: [record, number of parts, ETags by part number]
+        self._uploads = dict()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        # Uploads are completed by this thread and by split() in the thread
+        # of its caller, the slot is only written under the lock.
+        self._stats = stats_slot(config)
+
+    def split(self, obj):
+        """Returns the work items to copy an object.
+
+        Args:
+            obj (str, S3Object): Key or record of the object.
+
+        Returns:
+            [list]: PartCopy items of a multipart upload in the part
+            layout of the source if obj is a record of an object uploaded
+            in parts or of an unknown ETag and at least multipart_threshold
+            bytes, else [obj].
+        """
+
+        if not isinstance(obj, S3Object):
+            return [obj]
+        if part_count(obj.etag) is None:
+            # Objects uploaded at once keep their ETag if they are copied
+            # with CopyObject, see s3backuprestore.transfer.copy_object().
+            single = bool(obj.etag) and obj.size <= MAX_COPY_SIZE
+            if single or obj.size < self.threshold:
+                return [obj]
+        if self.journal:
+            found = self.journal.find(obj.key)
+            if found is not None:
+                items = self._resume(obj, *found)
+                if items is not None:
+                    return items
+        response = self.config.client('s3').create_multipart_upload(
+            Bucket=self.config.dst_bucket,
+            Key=obj.key,
+            **(self.config.extra_args or {}))
+        upload_id = response['UploadId']
+        ranges = self._ranges(obj, self.chunksize)
+        if self.journal:
+            self.journal.start(upload_id, obj, self.chunksize)
+        with self._lock:
+            self._uploads[upload_id] = [obj, len(ranges), dict()]
+        logger.info("Copying {} in {} parts with upload {}."
+                    .format(obj.key, len(ranges), upload_id))
+        return [PartCopy(obj.key, upload_id, number, first, last, obj.etag)
+                for number, (first, last) in enumerate(ranges, 1)]
+
+    def _ranges(self, obj, chunksize):
+        return source_part_ranges(
+            self.config.client('s3'), self.config.src_bucket, obj, chunksize)
+
+    def _resume(self, obj, upload_id, upload):
+        """Returns the missing parts of an upload of an earlier run.
+
+        Returns None if the upload cannot be resumed. It is aborted if the
+        object changed since.
+        """
+
+        if upload['size'] != obj.size or upload['etag'] != obj.etag:
+            logger.info("{} changed since upload {}."
+                        .format(obj.key, upload_id))
+            self._abort_upload(obj.key, upload_id)
+            return None
+        # Parts reported by workers of a killed run may be missing in the
+        # journal, S3 knows all of them.
+        etags = dict()
+        try:
+            paginator = self.config.client('s3').get_paginator('list_parts')
+            for page in paginator.paginate(Bucket=self.config.dst_bucket,
+                                           Key=obj.key, UploadId=upload_id):
+                for part in page.get('Parts', []):
+                    etags[part['PartNumber']] = part['ETag']
+        except ClientError as exc:
+            logger.warning("Upload {} of {} cannot be resumed: {}"
+                           .format(upload_id, obj.key, exc))
+            self.journal.end(upload_id)
+            return None
+
+        ranges = self._ranges(obj, upload['chunksize'])
+        etags = {n: e for n, e in etags.items() if n <= len(ranges)}
+        with self._lock:
+            self._uploads[upload_id] = [obj, len(ranges), etags]
+        logger.info("Resuming upload {} of {}, {} of {} parts are copied."
+                    .format(upload_id, obj.key, len(etags), len(ranges)))
+        if len(etags) == len(ranges):
+            with self._lock:
+                del self._uploads[upload_id]
+            self._complete(upload_id, obj, etags)
+            return []
+        return [PartCopy(obj.key, upload_id, number, first, last, obj.etag)
+                for number, (first, last) in enumerate(ranges, 1)
+                if number not in etags]
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self._handle(self.config.multipart_queue.get(timeout=1))
+            except queue.Empty:
+                pass
+            except (EOFError, OSError):
+                # The manager holding the queue is gone.
+                return
+
+    def stop(self):
+        """Stops the thread and aborts all uploads with missing parts.
+
+        With a journal they are kept for the next run. Uploads of the
+        journal older than max_age which were not resumed are aborted.
+        """
+
+        if self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self.join()
+        try:
+            while True:
+                self._handle(self.config.multipart_queue.get_nowait())
+        except (queue.Empty, EOFError, OSError):
+            pass
+        for upload_id in list(self._uploads):
+            obj, count, etags = self._uploads[upload_id]
+            if self.journal:
+                logger.warning("Keeping upload {} of {} with {} missing "
+                               "parts for the next run."
+                               .format(upload_id, obj.key,
+                                       count - len(etags)))
+            else:
+                logger.error("Parts of {} are missing.".format(obj.key))
+                self._abort(upload_id)
+        if self.max_age is not None:
+            self._abort_stale()
+        if self.journal:
+            self.journal.close()
+
+    def _abort_stale(self):
+        """Aborts uploads of the journal older than max_age.
+
+        Only uploads started by this tool are known, uploads to the bucket
+        by other writers are never aborted.
+        """
+
+        if not self.journal:
+            return
+        initiated_before = time.time() - self.max_age * 3600
+        for upload_id, upload in list(self.journal.uploads.items()):
+            if upload_id in self._uploads:
+                continue
+            if upload['initiated'] < initiated_before:
+                self._abort_upload(upload['key'], upload_id)
+
+    def _handle(self, message):
+        if message[0] == 'part':
+            _, upload_id, part_number, etag = message
+            with self._lock:
+                upload = self._uploads.get(upload_id)
+                if upload is None:
+                    return
+                upload[2][part_number] = etag
+                if self.journal:
+                    self.journal.part(upload_id, part_number, etag)
+                if len(upload[2]) < upload[1]:
+                    return
+                del self._uploads[upload_id]
+            self._complete(upload_id, upload[0], upload[2])
+        elif message[0] == 'abort':
+            obj = self._abort(message[1])
+            if obj is not None:
+                self._give_up(obj, message[2])
+
+    def _complete(self, upload_id, obj, etags):
+        parts = [{'PartNumber': number, 'ETag': etags[number]}
+                 for number in sorted(etags)]
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.config.client('s3').complete_multipart_upload(
+                    Bucket=self.config.dst_bucket,
+                    Key=obj.key,
+                    UploadId=upload_id,
+                    MultipartUpload={'Parts': parts})
+            except Exception as exc:
+                error = exc
+                logger.exception("Completing upload {} of {} failed."
+                                 .format(upload_id, obj.key))
+                put_metric('BackupObjectsErrors', 1, self.config)
+                time.sleep(attempt)
+            else:
+                logger.info("Copied {} in {} parts."
+                            .format(obj.key, len(parts)))
+                if self.journal:
+                    self.journal.end(upload_id)
+                put_metric('ObjectsCopied', 1, self.config)
+                with self._lock:
+                    self._stats.add(OBJECTS)
+                report_copied(self.config, obj.key)
+                return
+        with self._lock:
+            self._uploads[upload_id] = [obj, len(parts), etags]
+        self._abort(upload_id)
+        self._give_up(obj, error)
+
+    def _give_up(self, obj, exc):
+        """Adds the key of an aborted upload to the dead letters."""
+        logger.error("Giving up {}, last error: {}".format(obj.key, exc))
+        put_metric('ObjectsFailed', 1, self.config)
+        if self.config.dead_letters is not None:
+            # Copied as a whole, its size and ETag are not known anymore.
+            self.config.dead_letters.add('copy', obj.key, exc, 1)
+
+    def _abort(self, upload_id):
+        with self._lock:
+            upload = self._uploads.pop(upload_id, None)
+        if upload is None:
+            return None
+        self._abort_upload(upload[0].key, upload_id)
+        return upload[0]
+
+    def _abort_upload(self, key, upload_id):
+        try:
+            self.config.client('s3').abort_multipart_upload(
+                Bucket=self.config.dst_bucket,
+                Key=key,
+                UploadId=upload_id)
+        except Exception:
+            logger.exception("Aborting upload {} of {} failed."
+                             .format(upload_id, key))
+            return
+        logger.warning("Aborted upload {} of {}.".format(upload_id, key))
+        if self.journal:
+            self.journal.end(upload_id)
+
+
+def coordinate_multipart(config, journal=None, max_age=None):
+    """Starts the coordinator of multipart copies.
+
+    The coordinator is stopped when the process exits, aborting uploads
+    with missing parts unless there is a journal.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object, its
+        multipart_queue has to be set.
+        journal (str, optional): Defaults to None. Path of the journal to
+        resume multipart copies from, see MultipartJournal.
+        max_age (int, optional): Defaults to None. Hours after which
+        uploads of the journal which were not resumed are aborted.
+
+    Returns:
+        [MultipartCoordinator]: The coordinating thread, split large
+        objects with split().
+    """
+
+    if journal is not None:
+        journal = MultipartJournal(journal)
+    coordinator = MultipartCoordinator(
+        config, journal=journal, max_age=max_age)
+    coordinator.start()
+    util.Finalize(coordinator, coordinator.stop, exitpriority=25)
+    return coordinator
@@ -1,16 +1,164 @@
 """Receiving objects form bucket and returns them"""
 
+import heapq
+import itertools
+import multiprocessing
+import string
+from collections import namedtuple
 import sys as sys
 import time as time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+import boto3
 
-from .config import Config
 from .log import logger
 from .cw import put_metric
 
+# Characters used to split a flat key space into StartAfter ranges if
+# delimiter discovery does not find enough prefixes.
+_RANGE_BOUNDARIES = string.digits + string.ascii_uppercase + \
+    string.ascii_lowercase
+
+
+# Compact record of an S3 object as returned by ListObjectsV2. The ETag is
+# stored without quotes and last_modified as POSIX timestamp.
+S3Object = namedtuple(
+    'S3Object', ['key', 'size', 'etag', 'last_modified', 'storage_class'])
+
+
+def key_of(obj):
+    """Returns the S3 key of a record or of a plain key.
+
+    Args:
+        obj (S3Object, PartCopy, str): Record, work item or S3 key.
+
+    Returns:
+        [str]: S3 key.
+    """
+
+    if isinstance(obj, str):
+        return obj
+    return obj.key
+
+
+def normalize_prefixes(prefixes=None):
+    """Returns sorted prefixes without those covered by a shorter one.
+
+    Listing the returned prefixes one after another yields keys in the same
+    order as listing the bucket, and no key twice.
+
+    Args:
+        prefixes (str, list, optional): Defaults to None. Comma separated
+        prefixes or list of prefixes. None or an empty prefix means the
+        whole bucket.
+
+    Returns:
+        [list]: Prefixes, [''] for the whole bucket.
+    """
+
+    if not prefixes:
+        return ['']
+    if isinstance(prefixes, str):
+        prefixes = prefixes.split(',')
+    result = list()
+    for prefix in sorted(set(prefixes)):
+        if result and prefix.startswith(result[-1]):
+            continue
+        result.append(prefix)
+    return result
+
+
+def parse_shard(value):
+    """Parses a shard given as 'i/N' to the tuple (i, N).
+
+    Args:
+        value (str): Shard index i from 0 to N - 1 and number of shards N.
+        None or an empty string means no sharding.
+
+    Raises:
+        ValueError: If value is not a valid shard.
+
+    Returns:
+        [tuple]: (index, count) or None.
+    """
+
+    if not value:
+        return None
+    try:
+        index, count = (int(v) for v in value.split('/'))
+    except ValueError:
+        raise ValueError("Shard has to be given as i/N, got {}."
+                         .format(value))
+    if not 0 <= index < count:
+        raise ValueError("Shard index has to be between 0 and {}, got {}."
+                         .format(count - 1, index))
+    return index, count
+
+
+def in_shard(key, shard=None):
+    """Checks if a key belongs to a shard.
+
+    Keys are assigned to shards by their CRC32 checksum, so every run and
+    every host assigns a key to the same shard without coordination and
+    the shards of a bucket get about the same number of keys.
+
+    Args:
+        key (str): S3 key.
+        shard (tuple, optional): Defaults to None. (index, count) as
+        returned by parse_shard(). None matches all keys.
 
-def get_objects(bucket, config=None, cw_metric_name=None, objects_count=None):
+    Returns:
+        [bool]: True if the key belongs to the shard.
+    """
+
+    if shard is None:
+        return True
+    index, count = shard
+    return zlib.crc32(key.encode('utf-8')) % count == index
+
+
+def _to_record(obj):
+    """Converts an object of a ListObjectsV2 response to S3Object."""
+    return S3Object(
+        obj['Key'],
+        obj['Size'],
+        obj['ETag'].strip('"'),
+        obj['LastModified'].timestamp(),
+        obj.get('StorageClass', 'STANDARD'))
+
+
+def _from_response(obj, with_metadata):
+    if with_metadata:
+        return _to_record(obj)
+    return obj['Key']
+
+
+def _boto3_session(config=None):
+    if config:
+        return config.boto3_session()
+    else:
+        return boto3.session.Session()
+
+
+def _s3_client(config=None):
+    # Clients of a config are cached per process and shared by threads.
+    if config:
+        return config.client('s3')
+    else:
+        return boto3.session.Session().client('s3')
+
+
+def get_objects(bucket, config=None, cw_metric_name=None, objects_count=None,
+                processes=None, thread_count=None, with_metadata=False,
+                compact=False, manifest=None, refresh='full',
+                inventory=None, prefixes=None, shard=None, checkpoint=None):
     """Returns objects from bucket and returns them as a list
 
+    If processes or thread_count is greater than one or a checkpoint is
+    given the bucket will be listed in parallel, see
+    _get_objects_parallel().
+
     Args:
         bucket (string): S3 bucket.
         config (Config, optional): Defaults to None. Configuration object.
@@ -20,28 +168,101 @@ def get_objects(bucket, config=None, cw_metric_name=None, objects_count=None):
         S3 keys list.
         objects_count (int, optional): Defaults to None. Amount of keys to
         return.
+        processes (int, optional): Defaults to None. Number of processes
+        listing partitions of the bucket at the same time.
+        thread_count (int, optional): Defaults to None. Number of threads
+        listing partitions in each process.
+        with_metadata (bool, optional): Defaults to False. Returns S3Object
+        records with size, ETag, last modified and storage class instead
+        of keys.
+        compact (bool, optional): Defaults to False. Returns a
+        s3backuprestore.keystore.KeyStore instead of a list, which needs a
+        fraction of the memory for very large buckets.
+        manifest (s3backuprestore.manifest.Manifest, optional): Defaults to
+        None. Local manifest of the bucket which is read and refreshed
+        instead of listing the complete bucket, see Manifest.listing().
+        refresh (str, optional): Defaults to 'full'. How to refresh the
+        manifest: 'full', 'verify', 'trust' or 'tail'.
+        inventory (s3backuprestore.inventory.Inventory, optional): Defaults
+        to None. S3 Inventory report of the bucket which is read instead of
+        listing the bucket, see Inventory.listing().
+        prefixes (str, list, optional): Defaults to None. Only objects
+        beginning with one of these prefixes are returned, see
+        normalize_prefixes(). A manifest is scoped by its own prefixes.
+        shard (tuple, optional): Defaults to None. Only objects of this
+        shard are returned, see in_shard(). A manifest is scoped by its own
+        shard.
+        checkpoint (s3backuprestore.checkpoint.ListingCheckpoint, optional):
+        Defaults to None. Checkpoints the listing regularly, a listing
+        interrupted before is resumed. The bucket is listed by partitions
+        like in parallel.
 
     Returns:
-        [list]: List of S3 keys.
+        [list]: List of S3 keys or S3Object records.
     """
 
+    if inventory is not None:
+        return inventory.listing(
+            objects_count=objects_count,
+            processes=processes,
+            with_metadata=with_metadata,
+            compact=compact,
+            prefixes=prefixes,
+            shard=shard)
+
+    if manifest is not None:
+        return manifest.listing(
+            config=config,
+            refresh=refresh,
+            checkpoint=checkpoint,
+            objects_count=objects_count,
+            processes=processes,
+            thread_count=thread_count,
+            with_metadata=with_metadata,
+            compact=compact)
+
+    parallel = (processes or 1) > 1 or (thread_count or 1) > 1
+    if parallel or checkpoint is not None:
+        return _get_objects_parallel(
+            bucket,
+            config=config,
+            objects_count=objects_count,
+            processes=processes or 1,
+            thread_count=thread_count or 1,
+            with_metadata=with_metadata,
+            compact=compact,
+            prefixes=prefixes,
+            shard=shard,
+            checkpoint=checkpoint)
+
     logger.info("Receive objects from {}.".format(bucket))
-    keys = list()
+    keys = _new_listing(with_metadata, compact)
     start = time.time()
     cw_metric_name = "ObjectsIn{}".format(bucket)
     try:
-        if config:
-            session = config.boto3_session()
-        else:
-            session = Config.boto3_session()
-    except Exception as exc:
+        session = _boto3_session(config)
+    except Exception:
         logger.exception("")
         sys.exit(127)
 
     try:
         put_metric(cw_metric_name, 0, config=config)
-        for key in session.resource('s3').Bucket(bucket).objects.all():
-            keys.append(key.key)
+        s3_bucket = session.resource('s3').Bucket(bucket)
+        objects = itertools.chain.from_iterable(
+            s3_bucket.objects.filter(Prefix=p)
+            for p in normalize_prefixes(prefixes))
+        for key in objects:
+            if not in_shard(key.key, shard):
+                continue
+            if with_metadata:
+                keys.append(S3Object(
+                    key.key,
+                    key.size,
+                    key.e_tag.strip('"'),
+                    key.last_modified.timestamp(),
+                    key.storage_class))
+            else:
+                keys.append(key.key)
 
             if time.time() - 30 > start:
                 logger.info("Received {} objects.".format(len(keys)))
@@ -54,19 +275,323 @@ def get_objects(bucket, config=None, cw_metric_name=None, objects_count=None):
             put_metric(cw_metric_name, len(keys), config=config)
 
         logger.info("Summary of received objects {}.".format(len(keys)))
-    except Exception as exc:
+    except Exception:
         logger.exception("")
         sys.exit(127)
     else:
         return keys
 
 
-def delete_objects(bucket, config=None, with_versions=False):
+def iter_objects(bucket, config=None, objects_count=None, page_size=1000,
+                 with_metadata=False, start_after=None, prefixes=None,
+                 shard=None):
+    """Yields objects from bucket page by page.
+
+    Unlike get_objects() this generator does not wait for the complete
+    listing. Each page of ListObjectsV2 is yielded as soon as it is received,
+    so consumers can start working while the bucket is still listed.
+
+    Args:
+        bucket (string): S3 bucket.
+        config (Config, optional): Defaults to None. Configuration object.
+        objects_count (int, optional): Defaults to None. Amount of keys to
+        yield.
+        page_size (int, optional): Defaults to 1000. Maximum number of keys
+        per page.
+        with_metadata (bool, optional): Defaults to False. Yields S3Object
+        records instead of keys.
+        start_after (str, optional): Defaults to None. Only keys greater
+        than this key are listed.
+        prefixes (str, list, optional): Defaults to None. Only keys
+        beginning with one of these prefixes are listed, see
+        normalize_prefixes().
+        shard (tuple, optional): Defaults to None. Only keys of this shard
+        are yielded, see in_shard().
+
+    Yields:
+        [list]: List of S3 keys or S3Object records of one page.
+    """
+
+    logger.info("Receive objects page by page from {}.".format(bucket))
+    count = 0
+    start = time.time()
+    cw_metric_name = "ObjectsIn{}".format(bucket)
     try:
-        if config:
-            session = config.boto3_session()
+        paginator = _s3_client(config).get_paginator(
+            'list_objects_v2')
+        kwargs = {'Bucket': bucket}
+        if start_after:
+            kwargs['StartAfter'] = start_after
+        # Listing the prefixes one after another keeps the key order.
+        pages = itertools.chain.from_iterable(
+            paginator.paginate(
+                Prefix=p, PaginationConfig={'PageSize': page_size}, **kwargs)
+            for p in normalize_prefixes(prefixes))
+        put_metric(cw_metric_name, 0, config=config)
+        for page in pages:
+            keys = [_from_response(o, with_metadata)
+                    for o in page.get('Contents', [])
+                    if in_shard(o['Key'], shard)]
+            if objects_count:
+                keys = keys[:objects_count - count]
+            count += len(keys)
+
+            if time.time() - 30 > start:
+                logger.info("Received {} objects.".format(count))
+                start = time.time()
+                put_metric(cw_metric_name, count, config=config)
+            yield keys
+            # Break condition to escape earlier thant complete bucket listing
+            if objects_count and count >= objects_count:
+                break
+        put_metric(cw_metric_name, count, config=config)
+        logger.info("Summary of received objects {}.".format(count))
+    except Exception:
+        logger.exception("")
+        sys.exit(127)
+
+
+def _discover_partitions(client, bucket, min_partitions,
+                         max_top_level_keys=10000, with_metadata=False,
+                         prefix=''):
+    """Splits the key space of a bucket into disjoint partitions.
+
+    First the top level prefixes are discovered by listing the bucket with
+    delimiter '/'. If there are less prefixes than min_partitions or the
+    top level holds more than max_top_level_keys keys, the key space is
+    split into StartAfter ranges instead.
+
+    A partition is a tuple (prefix, start_after, end_before). Keys of a
+    partition start with prefix, are greater than start_after and lower
+    than end_before. Empty strings mean unbounded.
+
+    Args:
+        client (botocore.client.S3): S3 client.
+        bucket (str): S3 bucket.
+        min_partitions (int): Minimum number of partitions wanted.
+        max_top_level_keys (int, optional): Defaults to 10000. Stops the
+        discovery if a flat bucket would be listed completely.
+        with_metadata (bool, optional): Defaults to False. Returns S3Object
+        records instead of keys.
+        prefix (str, optional): Defaults to ''. Splits only the key space
+        beginning with prefix.
+
+    Returns:
+        [tuple]: (partitions, keys) keys are the top level keys which were
+        already received while discovering prefixes.
+    """
+
+    prefixes = list()
+    keys = list()
+    paginator = client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(
+            Bucket=bucket, Prefix=prefix, Delimiter='/'):
+        prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', []))
+        keys.extend(_from_response(o, with_metadata)
+                    for o in page.get('Contents', []))
+        if len(keys) > max_top_level_keys:
+            break
+
+    enough = len(prefixes) >= min_partitions
+    if enough and len(keys) <= max_top_level_keys:
+        return [(p, '', '') for p in prefixes], keys
+
+    # Not enough prefixes, fall back to ranges between the boundary
+    # characters. The first range lists everything lower than the first
+    # boundary, the last one everything greater than the last boundary.
+    bounds = [''] + [prefix + c for c in _RANGE_BOUNDARIES] + ['']
+    partitions = list()
+    for start_after, end_before in zip(bounds[:-1], bounds[1:]):
+        partitions.append((prefix, start_after, end_before))
+    return partitions, list()
+
+
+def _list_partition(client, bucket, partition, with_metadata=False,
+                    shard=None, checkpoint=None):
+    prefix, start_after, end_before = partition
+    kwargs = {'Bucket': bucket, 'Prefix': prefix}
+    if start_after:
+        # StartAfter is exclusive, start right before the boundary character
+        # so that keys beginning with it are part of this partition.
+        kwargs['StartAfter'] = start_after[:-1] + \
+            chr(ord(start_after[-1]) - 1) + '\U0010ffff'
+    keys = list()
+    last_key = None
+    if checkpoint is not None:
+        records, last_key, done = checkpoint.load(partition, shard)
+        keys = [r if with_metadata else r.key for r in records]
+        if done:
+            return keys
+        if last_key is not None:
+            kwargs['StartAfter'] = last_key
+
+    # Records received since the last checkpoint
+    pending = list()
+    saved = time.time()
+    for page in client.get_paginator('list_objects_v2').paginate(**kwargs):
+        contents = page.get('Contents', [])
+        if end_before:
+            contents = [o for o in contents if o['Key'] < end_before]
+        objs = [o for o in contents if in_shard(o['Key'], shard)]
+        keys.extend(_from_response(o, with_metadata) for o in objs)
+
+        if checkpoint is not None and contents:
+            pending.extend(_to_record(o) for o in objs)
+            last_key = contents[-1]['Key']
+            if time.time() - saved > checkpoint.interval:
+                checkpoint.save(partition, pending, last_key, shard=shard)
+                pending = list()
+                saved = time.time()
+        if len(contents) < len(page.get('Contents', [])):
+            # Reached the end of the partition.
+            break
+
+    if checkpoint is not None:
+        checkpoint.save(partition, pending, last_key, done=True, shard=shard)
+    return keys
+
+
+def _new_listing(with_metadata=False, compact=False, objects=()):
+    if compact:
+        # Imported here, keystore depends on this module.
+        from .keystore import KeyStore
+        return KeyStore(objects, with_metadata=with_metadata)
+    return list(objects)
+
+
+def _list_partitions(args):
+    """Lists partitions of a bucket with a pool of threads.
+
+    This function is executed inside of a worker process, it has to be
+    defined on module level to be pickable.
+
+    Args:
+        args (tuple): (config, bucket, partitions, thread_count,
+        with_metadata, compact, shard, checkpoint)
+
+    Returns:
+        [list]: List of tuples (partition, keys).
+    """
+
+    (config, bucket, partitions, thread_count, with_metadata, compact,
+     shard, checkpoint) = args
+    client = _s3_client(config)
+
+    def list_partition(partition):
+        start = time.time()
+        keys = _new_listing(with_metadata, compact, _list_partition(
+            client, bucket, partition, with_metadata, shard, checkpoint))
+        logger.info("Partition {} received {} objects in {:.0f}s."
+                    .format(partition, len(keys), time.time() - start))
+        return partition, keys
+
+    with ThreadPool(min(thread_count, len(partitions))) as pool:
+        return pool.map(list_partition, partitions)
+
+
+def _get_objects_parallel(bucket, config=None, objects_count=None,
+                          processes=1, thread_count=1, with_metadata=False,
+                          compact=False, prefixes=None, shard=None,
+                          checkpoint=None):
+    """Lists partitions of a bucket in parallel and returns all keys.
+
+    The partitions are distributed among processes, each process lists its
+    partitions with thread_count threads. The result is the same as
+    get_objects() but sorted.
+
+    Args:
+        bucket (str): S3 bucket.
+        config (Config, optional): Defaults to None. Configuration object.
+        objects_count (int, optional): Defaults to None. Amount of keys to
+        return.
+        processes (int, optional): Defaults to 1. Number of processes.
+        thread_count (int, optional): Defaults to 1. Number of threads
+        in each process.
+        with_metadata (bool, optional): Defaults to False. Returns S3Object
+        records instead of keys.
+        compact (bool, optional): Defaults to False. Returns a KeyStore,
+        each partition is stored compactly by its process already.
+        prefixes (str, list, optional): Defaults to None. Only the key space
+        beginning with these prefixes is partitioned and listed.
+        shard (tuple, optional): Defaults to None. Only keys of this shard
+        are returned.
+        checkpoint (s3backuprestore.checkpoint.ListingCheckpoint, optional):
+        Defaults to None. Checkpoints each partition and resumes partitions
+        of an interrupted listing. Removed after the listing is complete.
+
+    Returns:
+        [list]: Sorted list of S3 keys or S3Object records.
+    """
+
+    logger.info("Receive objects from {} with {} processes and {} threads."
+                .format(bucket, processes, thread_count))
+    cw_metric_name = "ObjectsIn{}".format(bucket)
+    start = time.time()
+    try:
+        client = _s3_client(config)
+        put_metric(cw_metric_name, 0, config=config)
+        prefixes = normalize_prefixes(prefixes)
+        partitions = list()
+        keys = list()
+        for prefix in prefixes:
+            prefix_partitions, prefix_keys = _discover_partitions(
+                client, bucket,
+                max(processes * thread_count // len(prefixes), 1),
+                with_metadata=with_metadata,
+                prefix=prefix)
+            partitions.extend(prefix_partitions)
+            keys.extend(k for k in prefix_keys
+                        if in_shard(key_of(k), shard))
+        logger.info("Discovered {} partitions in {}."
+                    .format(len(partitions), bucket))
+
+        chunks = [(config, bucket, partitions[p::processes], thread_count,
+                   with_metadata, compact, shard, checkpoint)
+                  for p in range(processes) if partitions[p::processes]]
+        if processes > 1:
+            pool = multiprocessing.Pool(len(chunks))
+            results = pool.imap_unordered(_list_partitions, chunks)
+        else:
+            pool = None
+            results = map(_list_partitions, chunks)
+
+        # Each partition is a sorted run of keys.
+        runs = [keys]
+        received = len(keys)
+        for result in results:
+            for partition, partition_keys in result:
+                runs.append(partition_keys)
+                received += len(partition_keys)
+                logger.info("{}/{} partitions done, received {} objects."
+                            .format(len(runs) - 1, len(partitions), received))
+            put_metric(cw_metric_name, received, config=config)
+        if pool:
+            pool.close()
+            pool.join()
+        if checkpoint is not None:
+            checkpoint.clear()
+
+        if compact:
+            keys = _new_listing(with_metadata, compact, itertools.islice(
+                heapq.merge(*runs), objects_count))
         else:
-            session = Config.boto3_session()
+            keys = list(itertools.chain.from_iterable(runs))
+            # Partitions are sorted runs, therefore sorting is cheap.
+            keys.sort()
+            if objects_count:
+                keys = keys[:objects_count]
+        logger.info("Summary of received objects {} in {:.0f}s."
+                    .format(len(keys), time.time() - start))
+    except Exception:
+        logger.exception("")
+        sys.exit(127)
+    else:
+        return keys
+
+
+def delete_objects(bucket, config=None, with_versions=False):
+    try:
+        session = _boto3_session(config)
         s3 = session.resource('s3')
     except:
         logger.exception("")
@@ -0,0 +1,58 @@
+"""Helpers for queues shared between processes."""
+
+import queue
+
+
+def drained(q, input_done=None):
+    """Checks if a queue is empty and no more keys will be put into it.
+
+    If input_done is None the queue was filled completely before consuming
+    it, so an empty queue is drained. Otherwise the producer sets
+    input_done after putting its last key. The event has to be checked
+    before the queue, else keys put right before setting it could be missed.
+
+    Args:
+        q (Queue): A consumable queue like Queue.queue()
+        input_done (Event, optional): Defaults to None. Event which is set
+        when the producer of the queue is finished.
+
+    Returns:
+        [bool]: True if the queue is drained.
+    """
+
+    if input_done is not None and not input_done.is_set():
+        return False
+    return q.empty()
+
+
+def report_copied(config, key):
+    """Reports a completely copied object if config asks for it.
+
+    Parts do not count, the multipart coordinator reports their object
+    when its upload is completed.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+        key (str): Key of the copied object.
+    """
+
+    if config.copied_queue is not None:
+        config.copied_queue.put(key)
+
+
+def drain(q):
+    """Returns all items of a queue without waiting for more.
+
+    Args:
+        q (Queue): A consumable queue like Queue.queue()
+
+    Returns:
+        [list]: Items of the queue.
+    """
+
+    items = list()
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except queue.Empty:
+            return items
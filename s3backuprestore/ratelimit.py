@@ -0,0 +1,307 @@
+"""Request limits and scheduling per key prefix, shared by all processes."""
+
+import collections
+import multiprocessing
+import time
+import zlib
+
+from .objects import key_of
+
+# Fields of each slot
+_RATE = 0
+_TOKENS = 1
+_REFILLED = 2
+_DECREASED = 3
+_IN_FLIGHT = 4
+_CAP = 5
+_FIELDS = 6
+
+
+def key_prefix(key, depth=1):
+    """Returns the first depth levels of a key including the delimiter.
+
+    Args:
+        key (str): S3 key, e.g. 'a/b/c'.
+        depth (int, optional): Defaults to 1. Number of levels.
+
+    Returns:
+        [str]: Prefix, e.g. 'a/', or '' for keys without delimiter.
+    """
+
+    parts = key.split('/', depth)
+    if len(parts) == 1:
+        return ''
+    return '/'.join(parts[:-1]) + '/'
+
+
+class _NullLimiter(object):
+    def reserve(self, bucket, key):
+        return 0
+
+    def acquire(self, bucket, key):
+        return 0
+
+    def try_start(self, bucket, key):
+        return True
+
+    def done(self, bucket, key):
+        pass
+
+    def success(self, bucket, key):
+        pass
+
+    def slowdown(self, bucket, key):
+        pass
+
+
+class RateLimiter(object):
+    def __init__(self, slots=1024, initial_rate=500, min_rate=10,
+                 max_rate=3500, increase=50, decrease=0.5, cooldown=1,
+                 depth=1, initial_cap=256, min_cap=4, max_cap=4096):
+        """Token buckets of request rates in shared memory.
+
+        S3 limits the request rate per prefix of a bucket and answers with
+        SlowDown above it. Every worker takes a token of the bucket of its
+        key before each request, so all threads of all processes together
+        stay below the rate. The rate follows the limit of S3 with additive
+        increase and multiplicative decrease: each success adds to it, so
+        it grows by increase requests per second every second, and a
+        SlowDown multiplies it with decrease. SlowDowns within cooldown
+        seconds of the last decrease were caused by the same overload and
+        do not decrease it again.
+
+        The requests in flight of each prefix are capped the same way, see
+        try_start(). A prefix at its cap leaves the workers to the keys of
+        other prefixes.
+
+        Buckets and prefixes are hashed to slots, a few prefixes may share
+        a slot and its rate. The limiter is passed to processes when they
+        are started, like SharedStats.
+
+        Args:
+            slots (int, optional): Defaults to 1024. Number of token buckets.
+            initial_rate (float, optional): Defaults to 500. Requests per
+            second of each prefix until the first feedback.
+            min_rate (float, optional): Defaults to 10. Lowest rate.
+            max_rate (float, optional): Defaults to 3500. Highest rate, the
+            documented limit of PUT and COPY requests per prefix.
+            increase (float, optional): Defaults to 50. Requests per second
+            the rate grows by every second without SlowDown.
+            decrease (float, optional): Defaults to 0.5. Factor the rate is
+            multiplied with on SlowDown.
+            cooldown (float, optional): Defaults to 1. Seconds after a
+            decrease without further decrease.
+            depth (int, optional): Defaults to 1. Levels of the key prefix
+            limited together, see key_prefix().
+            initial_cap (int, optional): Defaults to 256. Requests in flight
+            of each prefix until the first feedback.
+            min_cap (int, optional): Defaults to 4. Lowest cap.
+            max_cap (int, optional): Defaults to 4096. Highest cap.
+        """
+
+        self.slots = slots
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.depth = depth
+        self.min_cap = min_cap
+        self.max_cap = max_cap
+        self._array = multiprocessing.RawArray('d', slots * _FIELDS)
+        for slot in range(slots):
+            self._array[slot * _FIELDS + _RATE] = initial_rate
+            self._array[slot * _FIELDS + _TOKENS] = initial_rate
+            self._array[slot * _FIELDS + _CAP] = initial_cap
+        # Slots are spread over a few locks, so workers of different
+        # prefixes rarely wait for each other.
+        self._locks = [multiprocessing.Lock() for _ in range(16)]
+
+    def _slot(self, bucket, key):
+        name = '{}/{}'.format(bucket, key_prefix(key, self.depth))
+        slot = zlib.crc32(name.encode()) % self.slots
+        return slot * _FIELDS, self._locks[slot % len(self._locks)]
+
+    def reserve(self, bucket, key):
+        """Takes a token for a request and returns the time to wait for it.
+
+        Tokens are refilled with the rate up to a burst of one second. If
+        none is left the token is borrowed from the future, so concurrent
+        callers queue up behind each other.
+
+        Args:
+            bucket (str): Bucket of the request.
+            key (str): Key of the request.
+
+        Returns:
+            [float]: Seconds to wait before sending the request.
+        """
+
+        base, lock = self._slot(bucket, key)
+        array = self._array
+        with lock:
+            now = time.monotonic()
+            rate = array[base + _RATE]
+            tokens = array[base + _TOKENS]
+            elapsed = now - array[base + _REFILLED]
+            tokens = min(rate, tokens + elapsed * rate) - 1
+            array[base + _TOKENS] = tokens
+            array[base + _REFILLED] = now
+        return -tokens / rate if tokens < 0 else 0
+
+    def acquire(self, bucket, key):
+        """Waits until a request may be sent, see reserve().
+
+        Returns:
+            [float]: Seconds waited.
+        """
+
+        wait = self.reserve(bucket, key)
+        if wait:
+            time.sleep(wait)
+        return wait
+
+    def try_start(self, bucket, key):
+        """Starts a request if its prefix is below its cap.
+
+        Args:
+            bucket (str): Bucket of the request.
+            key (str): Key of the request.
+
+        Returns:
+            [bool]: True if the request may be sent, call done() when it is
+            finished. False if the key should be put back for later.
+        """
+
+        base, lock = self._slot(bucket, key)
+        with lock:
+            if self._array[base + _IN_FLIGHT] >= int(self._array[base + _CAP]):
+                return False
+            self._array[base + _IN_FLIGHT] += 1
+        return True
+
+    def done(self, bucket, key):
+        """Finishes a request started with try_start()."""
+        base, lock = self._slot(bucket, key)
+        with lock:
+            self._array[base + _IN_FLIGHT] -= 1
+
+    def success(self, bucket, key):
+        """Increases rate and cap after a successful request."""
+        base, lock = self._slot(bucket, key)
+        with lock:
+            rate = self._array[base + _RATE]
+            self._array[base + _RATE] = min(
+                self.max_rate, rate + self.increase / rate)
+            # The cap grows by one after cap successful requests.
+            cap = self._array[base + _CAP]
+            self._array[base + _CAP] = min(self.max_cap, cap + 1 / cap)
+
+    def slowdown(self, bucket, key):
+        """Decreases rate and cap after a SlowDown of S3."""
+        base, lock = self._slot(bucket, key)
+        with lock:
+            now = time.monotonic()
+            if now - self._array[base + _DECREASED] < self.cooldown:
+                return
+            self._array[base + _DECREASED] = now
+            rate = max(self.min_rate,
+                       self._array[base + _RATE] * self.decrease)
+            self._array[base + _RATE] = rate
+            # Tokens of the old rate must not be spent in a burst.
+            self._array[base + _TOKENS] = min(
+                self._array[base + _TOKENS], 0)
+            self._array[base + _CAP] = max(
+                self.min_cap, self._array[base + _CAP] * self.decrease)
+
+    def rate(self, bucket, key):
+        """Returns the current rate of the prefix of a key."""
+        base, _ = self._slot(bucket, key)
+        return self._array[base + _RATE]
+
+    def cap(self, bucket, key):
+        """Returns the current cap of the prefix of a key."""
+        base, _ = self._slot(bucket, key)
+        return int(self._array[base + _CAP])
+
+
+def get_limiter(config):
+    """Returns the rate limiter of config.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+
+    Returns:
+        [object]: The RateLimiter, or a limiter which never waits if config
+        has none.
+    """
+
+    limiter = getattr(config, 'rate_limiter', None)
+    if limiter is None:
+        return _NullLimiter()
+    return limiter
+
+
+class PrefixScheduler(object):
+    def __init__(self, q, window=10000, depth=1):
+        """Puts keys into a queue alternating between their prefixes.
+
+        Listings are sorted, so keys of one prefix come in long runs which
+        would all hit the same partition of S3. The scheduler buffers up to
+        window keys grouped by prefix and puts them into the queue round
+        robin, one key of each prefix in turn.
+
+        Args:
+            q (Queue): Queue to put the keys into.
+            window (int, optional): Defaults to 10000. Number of keys
+            buffered, None buffers all keys until flush().
+            depth (int, optional): Defaults to 1. Levels of the key prefix,
+            see key_prefix().
+        """
+
+        self.q = q
+        self.window = window
+        self.depth = depth
+        self._groups = collections.OrderedDict()
+        self._buffered = 0
+
+    def put(self, obj):
+        """Buffers a key or record and puts the next keys into the queue."""
+        prefix = key_prefix(key_of(obj), self.depth)
+        self._groups.setdefault(prefix, collections.deque()).append(obj)
+        self._buffered += 1
+        while self.window is not None and self._buffered > self.window:
+            self._put_next()
+
+    def flush(self):
+        """Puts all buffered keys into the queue."""
+        while self._buffered:
+            self._put_next()
+
+    def _put_next(self):
+        prefix, group = self._groups.popitem(last=False)
+        self.q.put(group.popleft())
+        self._buffered -= 1
+        if group:
+            # The prefix waits for its next turn at the end.
+            self._groups[prefix] = group
+
+
+def schedule(q, objects, depth=1, window=10000):
+    """Puts all keys into a queue alternating between their prefixes.
+
+    See PrefixScheduler. Only window keys are buffered, so a compact
+    listing is not expanded into records all at once.
+
+    Args:
+        q (Queue): Queue to put the keys into.
+        objects (iterable): Keys or records.
+        depth (int, optional): Defaults to 1. Levels of the key prefix, see
+        key_prefix().
+        window (int, optional): Defaults to 10000. Number of keys buffered.
+    """
+
+    scheduler = PrefixScheduler(q, window=window, depth=depth)
+    for obj in objects:
+        scheduler.put(obj)
+    scheduler.flush()
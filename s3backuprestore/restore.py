@@ -3,21 +3,32 @@ import queue
 import sys
 import threading
 import time
-from random import randint
 from botocore.exceptions import ClientError, EndpointConnectionError
 
 from .cw import put_metric
 from .log import logger
+from .objects import S3Object, key_of
+from .queues import drained
+from .ratelimit import get_limiter
+from .retry import DelayQueue, RestorePending
+from .stats import (OBJECTS, BYTES, RETRIES, SLOWDOWNS, IN_FLIGHT,
+                    stats_slot)
+from .transfer import copy_object
 
 
 class _Restore(threading.Thread):
     def __init__(self, config, restore_queue, max_wait=300,
-                 cw_metric_name='RestoreObjectsErrors'):
+                 cw_metric_name='RestoreObjectsErrors', input_done=None,
+                 retries=None):
         """This class provides an easy interface of restoring S3 objects.
         It uses the copy method from boto3 to only copy all S3 objects
         server side, to avoid downloading and uploading it and speed
         up transfere time.
 
+        Failed keys and objects whose restore from GLACIER is ongoing wait
+        in a delay queue, see s3backuprestore.retry.DelayQueue, while the
+        thread goes on with other keys.
+
         Inheritance:
             threading.Thread
         """
@@ -30,13 +41,17 @@ class _Restore(threading.Thread):
         self.cw_dimension_name = self.config.cw_dimension_name
         self.cw_metric_name = cw_metric_name
         self.restore_queue = restore_queue
+        self.input_done = input_done
         self.max_wait = max_wait
-        self.waiter = 1
+        if retries is None:
+            retries = DelayQueue(cap=max_wait, kind='restore',
+                                 dead_letters=config.dead_letters)
+        self.retries = retries
         # Sets the thred in daemon mode. See:
         # https://docs.python.org/3/library/threading.html#threading.Thread.daemon
         self.daemon = True
-        self._session = config.boto3_session()
-        self._transfer_mgr = config.s3_transfer_manager()
+        self._stats = stats_slot(config)
+        self._limiter = get_limiter(config)
 
     def run(self):
         """Run method of threading.Thread class.
@@ -49,214 +64,181 @@ class _Restore(threading.Thread):
         """
 
         try:
-            s3 = self._session.resource('s3')
+            s3 = self.config.client('s3')
+            transfer_manager = self.config.transfer_manager()
         except Exception as exc:
             logger.exception("")
             put_metric(self.cw_metric_name, 1, self.config)
             sys.exit(127)
 
-        while not self.restore_queue.empty():
+        while self.retries or not drained(self.restore_queue, self.input_done):
             logger.debug("Restore queue size: "
-                         f"{self.restore_queue.qsize()} keys")
+                         f"{self.restore_queue.qsize()} keys, "
+                         f"{len(self.retries)} retries pending.")
             try:
-                key = self.restore_queue.get(timeout=self.timeout)
+                # Keys due for a retry go first.
+                obj = self.retries.get(self.restore_queue, self.timeout)
+                key = key_of(obj)
                 logger.info(f"Got key {key} from restore queue.")
             except queue.Empty as exc:
-                logger.warning("Restore queue seems empty. Checking again.")
+                if not len(self.retries):
+                    logger.warning("Restore queue seems empty. "
+                                   "Checking again.")
                 continue
 
-            ret = self._get_storage_class(s3, self.src_bucket, key)
+            # Records from listing already know their storage class, only
+            # objects in GLACIER need a request for their restore status.
+            listed = isinstance(obj, S3Object)
+            if listed and 'GLACIER' not in obj.storage_class:
+                ret = {'StorageClass': obj.storage_class}
+            else:
+                ret = self._get_storage_class(s3, self.src_bucket, obj)
+                if ret is None:
+                    # Failed, the key waits for its retry.
+                    continue
             storage_class = ret.get('StorageClass', None)
             ongoing_req = ret.get('OngoingRequest', None)
 
             # Checking objects storage class.
             # If objects storage class equals GLACIER put it into
-            # _glacier_queue to process it later.
+            # the delay queue to process it later.
             logger.info("Checking if object is in GLACIER and "
                         f"ongoing-request is false for {key}.")
             if (storage_class and 'GLACIER' in storage_class and
                (not ongoing_req or 'ongoing-request="true"' in ongoing_req)):
-
-                logger.info(f"Request is ongoing for {key}. "
-                            f"Waiting {self.waiter}s.")
-
-                self.restore_queue.put(key, timeout=self.timeout)
-                # Increasing waiting time
-                time.sleep(self.waiter)
-                self.waiter = randint(1, min(self.max_wait, self.waiter * 4))
-                logger.debug(f"Next waiting time {self.waiter}s.")
+                # Checks count as attempts of their own class.
+                delay = self.retries.fail(obj, RestorePending(key))
+                if delay is None:
+                    put_metric('ObjectsFailed', 1, self.config)
+                else:
+                    logger.info(f"Request is ongoing for {key}. "
+                                f"Checking again in {delay:.0f}s.")
+            elif not self._limiter.try_start(self.dst_bucket, key):
+                # The prefix is at its cap, other prefixes go first.
+                self.retries.defer(obj)
             else:
                 # Preparing copy task
-                dst_obj = s3.Object(self.dst_bucket, key)
-                cp_src = {'Bucket': self.src_bucket, 'Key': key}
+                # Waits for a token of the prefix shared by all processes.
+                self._limiter.acquire(self.dst_bucket, key)
+                self._stats.add(IN_FLIGHT)
                 try:
                     logger.info(f"{self.name} copying {key}")
-                    dst_obj.copy(cp_src, Config=self._transfer_mgr)
+                    # All threads submit to the transfer manager of the
+                    # process.
+                    copy_object(transfer_manager, self.src_bucket,
+                                self.dst_bucket, obj)
                 except ClientError as exc:
                     try:
                         error_code = exc.response['Error']['Code']
                         if 'SlowDown' in error_code:
-                            logger.warning("SlowDown occurs. "
-                                           f"Waiting for {self.waiter:.0f}s"
-                                           )
+                            logger.warning(f"SlowDown occurs for {key}.")
                             logger.debug(f"{exc.response}\n Key {key}")
                             put_metric('SlowDown', 1, self.config)
+                            self._stats.add(SLOWDOWNS)
+                            self._limiter.slowdown(self.dst_bucket, key)
                         elif 'InternalError' in error_code:
-                            logger.warning("InternalError occurs. Waiting for "
-                                           f"{self.waiter:.0f}s")
+                            logger.warning(f"InternalError occurs for {key}.")
                             put_metric(self.cw_metric_name, 1, self.config)
                             logger.debug(f"{exc.response}\n Key {key}")
                         else:
                             logger.error(f"{exc.response}\n Key {key}")
                             put_metric(self.cw_metric_name, 1, self.config)
                     except KeyError:
-                        if "reached max retries" in str(exc.__context__):
+                        if "reached max retries" in str(exc):
                             logger.warning("Max retries reached.")
-                            logger.debug(exc.__context__)
+                            logger.debug(exc)
                         else:
                             logger.exception("No Errcode in "
                                              "exception response.")
-                            logger.debug(exc.__context__)
-                        self.restore_queue.put(key)
+                            logger.debug(exc)
                         put_metric(self.cw_metric_name, 1, self.config)
-                        logger.debug("Error occured sleeping for "
-                                     f"{self.waiter}s.")
-                        time.sleep(self.waiter)
-                        # Increase maximum of waiting time
-                        self.waiter = randint(
-                            1, min(self.max_wait, self.waiter * 4))
-                        logger.debug(f"Next waiting time {self.waiter}s.")
-                    else:
-                        logger.error(f"Put {key} back to queue.")
-                        self.restore_queue.put(key, timeout=self.timeout)
-                        logger.debug("Error occured sleeping for "
-                                     f"{self.waiter}s.")
-                        time.sleep(self.waiter)
-                        # Increase maximum of waiting time
-                        self.waiter = randint(
-                            1, min(self.max_wait, self.waiter * 4))
-                        logger.debug(f"Next waiting time {self.waiter}s.")
+                    self._retry(obj, exc)
                 except ConnectionRefusedError as exc:
-                    logger.exception(f"Waiting for {self.waiter:.0f}s.\n"
-                                     f"Put {key} back to queue.\n"
+                    logger.exception(f"Connection refused for {key}.\n"
                                      "Maybe to many connections?")
                     put_metric(self.cw_metric_name, 1, self.config)
-                    self.restore_queue.put(key, timeout=self.timeout)
-                    logger.debug(f"Error occured sleeping for {self.waiter}s.")
-                    time.sleep(self.waiter)
-                    self.waiter = randint(
-                        1, min(self.max_wait, self.waiter * 4))
-                    logger.debug(f"Next waiting time {self.waiter}s.")
+                    self._retry(obj, exc)
                 except EndpointConnectionError as exc:
-                    logger.warning("EndpointConnectionError.\n"
-                                   f"Waiting for {self.waiter:.0f}s.\n"
-                                   f"Put {key} back to queue.\n")
+                    logger.warning(f"EndpointConnectionError for {key}.")
                     put_metric(self.cw_metric_name, 1, self.config)
-                    self.restore_queue.put(key, timeout=self.timeout)
-                    logger.debug(f"Error occured sleeping for {self.waiter}s.")
-                    time.sleep(self.waiter)
-                    self.waiter = randint(
-                        1, min(self.max_wait, self.waiter * 4))
-                    logger.debug(f"Next waiting time {self.waiter}s.")
+                    self._retry(obj, exc)
                 except Exception as exc:
-                    logger.exception("Unhandeld exception occured.\n "
-                                     f"Put {key} back to queue.")
+                    logger.exception("Unhandeld exception occured for "
+                                     f"{key}.")
                     put_metric(self.cw_metric_name, 1, self.config)
-                    self.restore_queue.put(key, timeout=self.timeout)
-                    logger.debug(f"Error occured sleeping for {self.waiter}s.")
-                    self.waiter = randint(
-                        1, min(self.max_wait, self.waiter * 4))
-                    logger.debug(f"Next waiting time {self.waiter}s.")
+                    self._retry(obj, exc)
                 else:
                     logger.info(f"{self.name} copied {key}")
-                    # Reduce waiting time
-                    self.waiter = max(round(self.waiter * 0.8), 1)
-                    logger.debug(f"Reduced waiting time to {self.waiter}s.")
+                    self._limiter.success(self.dst_bucket, key)
+                    self.retries.done(obj)
+                    put_metric('ObjectsRestored', 1, self.config)
+                    self._stats.add(OBJECTS)
+                    if isinstance(obj, S3Object):
+                        put_metric('BytesRestored', obj.size, self.config)
+                        self._stats.add(BYTES, obj.size)
+                finally:
+                    self._stats.add(IN_FLIGHT, -1)
+                    self._limiter.done(self.dst_bucket, key)
+
+    def _retry(self, obj, exc):
+        """Puts a failed key into the delay queue of the process."""
+        delay = self.retries.fail(obj, exc)
+        if delay is None:
+            put_metric('ObjectsFailed', 1, self.config)
+            return
+        self._stats.add(RETRIES)
+        logger.info(f"Retrying {key_of(obj)} in {delay:.0f}s, "
+                    f"attempt {self.retries.attempts(obj) + 1}.")
 
-    def _get_storage_class(self, s3_client, bucket, key):
+    def _get_storage_class(self, s3_client, bucket, obj):
         """Definition will return StorageClass and OngoingReques
         Args:
             s3_client (client): S3 client object needed to make requests to S3.
             bucket (str): Bucket where the objects are stored.
-            key (str): Key in bucket.
+            obj (str, S3Object): Key in bucket or its record.
         Returns:
-            [dict]: (StorageClasse, OngoingRequest)
+            [dict]: (StorageClasse, OngoingRequest), None if the request
+            failed and obj was put into the delay queue.
         """
+        key = key_of(obj)
         try:
-            obj = s3_client.Object(bucket, key)
-            storage_class = obj.storage_class
-            ongoing_req = obj.restore
+            response = s3_client.head_object(Bucket=bucket, Key=key)
+            storage_class = response.get('StorageClass')
+            ongoing_req = response.get('Restore')
         except ClientError as exc:
             try:
                 error_code = exc.response['Error']['Code']
                 if 'SlowDown' in error_code:
-                    logger.warning("SlowDown occurs. Waiting for"
-                                   f" {self.waiter:.2}s")
-                    time.sleep(self.waiter)
-                    # Increase maximum of waiting time
-                    self.waiter = randint(
-                        1, min(self.max_wait, self.waiter * 4))
+                    logger.warning(f"SlowDown occurs for {key}.")
                     logger.debug(f"{exc.response}\n Key {key}")
                     put_metric('SlowDown', 1, self.config)
+                    self._stats.add(SLOWDOWNS)
                 elif 'InternalError' in error_code:
-                    logger.warning("InternalError occurs. Waiting for "
-                                   f"{self.waiter:.2}s")
-                    time.sleep(self.waiter)
-                    # Increase maximum of waiting time
-                    self.waiter = randint(
-                        1, min(self.max_wait, self.waiter * 4))
+                    logger.warning(f"InternalError occurs for {key}.")
                     logger.debug(f"{exc.response}\n Key {key}")
                     put_metric(self.cw_metric_name, 1, self.config)
                 else:
                     logger.error(f"{exc.response}\n Key {key}")
                     put_metric(self.cw_metric_name, 1, self.config)
-            except KeyError as exc:
-                if "reached max retries" in str(exc.__context__):
+            except KeyError:
+                if "reached max retries" in str(exc):
                     logger.warning("Max retries reached.")
-                    logger.debug(exc.__context__)
+                    logger.debug(exc)
                 else:
                     logger.exception("No Error Code in exception response")
-                    logger.debug(exc.__context__)
-                self.restore_queue.put(key, timeout=self.timeout)
+                    logger.debug(exc)
                 put_metric(self.cw_metric_name, 1, self.config)
-                logger.debug(f"Error occured sleeping for {self.waiter:.2}s.")
-                time.sleep(self.waiter)
-                # Increase maximum of waiting time
-                self.waiter = randint(1, min(self.max_wait, self.waiter * 4))
-                logger.debug(f"Next waiting time {self.waiter}s.")
-            else:
-                logger.error(f"Put {key} back to queue.")
-                self.restore_queue.put(key, timeout=self.timeout)
-                time.sleep(self.waiter)
-                # Increase maximum of waiting time
-                self.waiter = randint(1, min(self.max_wait, self.waiter * 4))
-                logger.debug(f"Next waiting time {self.waiter}s.")
+            self._retry(obj, exc)
         except EndpointConnectionError as exc:
-            logger.warning("EndpointConnectionError.\n"
-                           f"Waiting for {self.waiter}s.\n"
-                           f"Put {key} back to queue.\n")
+            logger.warning(f"EndpointConnectionError for {key}.")
             put_metric(self.cw_metric_name, 1, self.config)
-            self.restore_queue.put(key, timeout=self.timeout)
-            logger.debug(f"Error occured sleeping for {self.waiter}s.")
-            time.sleep(self.waiter)
-            # Increase maximum of waiting time
-            self.waiter = randint(1, min(self.max_wait, self.waiter * 4))
-            logger.debug(f"Next waiting time {self.waiter}s.")
+            self._retry(obj, exc)
         except Exception as exc:
-            logger.exception("Unhandeld exception occured.\n "
-                             f"Put {key} back to queue.")
+            logger.exception(f"Unhandeld exception occured for {key}.")
             put_metric(self.cw_metric_name, 1, self.config)
-            self.restore_queue.put(key, timeout=self.timeout)
-            logger.debug(f"Error occured sleeping for {self.waiter}s.")
-            time.sleep(self.waiter)
-            # Increase maximum of waiting time
-            self.waiter = randint(1, min(self.max_wait, self.waiter * 4))
-            logger.debug(f"Next waiting time {self.waiter}s.")
+            self._retry(obj, exc)
         else:
             logger.info(f"Object {key} has storage class {storage_class}")
-            # Reduce waiting time
-            self.waiter = max(round(self.waiter * 0.8), 1)
-            logger.debug(f"Reduced waiting time to {self.waiter}s.")
             return {
                 'StorageClass': storage_class,
                 'OngoingRequest': ongoing_req
@@ -265,35 +247,46 @@ class _Restore(threading.Thread):
 
 class MpRestore(multiprocessing.Process):
     def __init__(self, config, restore_queue, thread_count=10,
-                 cw_metric_name='ObjectsToRestore'):
+                 cw_metric_name='ObjectsToRestore', input_done=None):
         multiprocessing.Process.__init__(self)
         self.config = config
         self.restore_queue = restore_queue
         self.timeout = self.config.timeout
         self.thread_count = thread_count
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
 
     def run(self):
         restore_queue_size = self.restore_queue.qsize()
         logger.debug(f"{self.name} restore queue size {restore_queue_size}")
-        if restore_queue_size:
-            thread_count = min(self.thread_count, restore_queue_size)
+        if restore_queue_size or self.input_done:
+            if self.input_done:
+                thread_count = self.thread_count
+            else:
+                thread_count = min(self.thread_count, restore_queue_size)
 
             # Start copying S3 objects to destiantion bucket
             # Consume restore_queue until it is empty
             th_lst = list()
+            # Failed keys wait for their retry in a queue of this process.
+            retries = DelayQueue(kind='restore',
+                                 dead_letters=self.config.dead_letters)
+            # All threads share the client of this process.
+            self.config.warm_up(thread_count)
             logger.info(f"{self.name} starting {thread_count} threads.")
             for t in range(thread_count):
                 th_lst.append(_Restore(
                     self.config,
-                    self.restore_queue))
+                    self.restore_queue,
+                    input_done=self.input_done,
+                    retries=retries))
                 logger.debug(f"{self.name} {th_lst[t].name} generated.")
                 th_lst[t].start()
                 logger.debug(f"{self.name} {th_lst[t].name} started.")
 
             try:
                 logger.debug("Checking restore queue size if empty.")
-                while not self.restore_queue.empty():
+                while not drained(self.restore_queue, self.input_done):
                     logger.info("Restore queue not empty "
                                 f"{self.restore_queue.qsize()} keys. "
                                 "Waiting for 60s.")
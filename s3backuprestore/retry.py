@@ -0,0 +1,441 @@
+"""Delayed retries of failed keys without blocking the workers."""
+
+import collections
+import heapq
+import itertools
+import json
+import os
+import queue
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from botocore.exceptions import (ClientError, ConnectionError,
+                                 HTTPClientError)
+
+from .log import logger
+from .objects import S3Object, key_of
+
+# Attempts of a key per class of its error before it is given up
+MAX_ATTEMPTS = {
+    'throttle': 20,
+    'transient': 10,
+    'permanent': 1,
+    'unknown': 5,
+    # Checks of objects in GLACIER whose restore is ongoing, about two days
+    # with the default cap of 300 seconds
+    'pending': 600,
+}
+_THROTTLE_CODES = ('SlowDown', 'Throttling', 'ThrottlingException',
+                   'RequestLimitExceeded', '503')
+_PERMANENT_CODES = ('AccessDenied', 'AllAccessDisabled', 'InvalidArgument',
+                    'InvalidObjectState', 'InvalidRequest', 'KeyTooLongError',
+                    'MethodNotAllowed', 'NoSuchBucket', 'NoSuchKey',
+                    'NoSuchVersion')
+
+
+class RestorePending(Exception):
+    """The object can not be copied yet, its restore is ongoing."""
+
+
+def error_class(exc):
+    """Returns the class of an error, which decides how often to retry.
+
+    Args:
+        exc (Exception): Error of a request.
+
+    Returns:
+        [str]: 'throttle' for SlowDown, 'transient' for server and connection
+        errors, 'permanent' for errors a retry does not fix, like
+        AccessDenied, 'pending' for an ongoing restore, else 'unknown'. See
+        MAX_ATTEMPTS.
+    """
+
+    if isinstance(exc, ClientError):
+        code = exc.response.get('Error', {}).get('Code', '')
+        status = exc.response.get('ResponseMetadata', {}).get(
+            'HTTPStatusCode', 0)
+        if code in _THROTTLE_CODES or status == 503:
+            return 'throttle'
+        if code in _PERMANENT_CODES:
+            return 'permanent'
+        if code == 'InternalError' or status >= 500:
+            return 'transient'
+        if 400 <= status < 500:
+            return 'permanent'
+        return 'unknown'
+    if isinstance(exc, RestorePending):
+        return 'pending'
+    if isinstance(exc, (ConnectionError, HTTPClientError,
+                        ConnectionRefusedError, TimeoutError)):
+        return 'transient'
+    return 'unknown'
+
+
+class Backoff(object):
+    def __init__(self, base=1, cap=300):
+        """Attempts and waiting times of failed keys.
+
+        Waiting times follow decorrelated jitter: each one is drawn between
+        base and three times the previous one, at most cap. Keys failing
+        together are spread out instead of being retried at once.
+
+        Args:
+            base (float, optional): Defaults to 1. Shortest waiting time in
+            seconds.
+            cap (float, optional): Defaults to 300. Longest waiting time in
+            seconds.
+        """
+
+        self.base = base
+        self.cap = cap
+        self._attempts = dict()
+        self._delays = dict()
+        self._lock = threading.Lock()
+
+    def failed(self, obj):
+        """Counts a failed attempt of obj and returns its waiting time."""
+        with self._lock:
+            delay = min(self.cap, random.uniform(
+                self.base, self._delays.get(obj, self.base) * 3))
+            self._delays[obj] = delay
+            self._attempts[obj] = self._attempts.get(obj, 0) + 1
+        return delay
+
+    def attempts(self, obj):
+        """Returns the number of failed attempts of obj."""
+        return self._attempts.get(obj, 0)
+
+    def reset(self, obj):
+        """Forgets the attempts of obj, e.g. after it succeeded."""
+        with self._lock:
+            self._attempts.pop(obj, None)
+            self._delays.pop(obj, None)
+
+
+class DeadLetters(object):
+    def __init__(self, path):
+        """Keys given up after their last attempt, in a local JSONL file.
+
+        Each line is a JSON object with the kind of work, the key, its
+        record if known, the last error, its class and the number of
+        attempts. Lines are appended with a single write, so all threads of
+        all processes can add to the same file.
+
+        Args:
+            path (str): Path of the file.
+        """
+
+        self.path = path
+
+    def add(self, kind, obj, exc, attempts):
+        """Adds a key given up.
+
+        Args:
+            kind (str): Kind of work, e.g. 'copy' or 'tag'.
+            obj (object): Key, record or part. Parts are added as the key
+            of their object.
+            exc (Exception): Last error.
+            attempts (int): Number of attempts.
+        """
+
+        record = obj._asdict() if isinstance(obj, S3Object) else None
+        line = json.dumps({
+            'kind': kind,
+            'key': key_of(obj),
+            'record': record,
+            'error': str(exc),
+            'error_class': error_class(exc),
+            'attempts': attempts,
+            'time': datetime.now(timezone.utc).isoformat(),
+        }) + '\n'
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+    def read(self, kind=None):
+        """Returns the keys of the file, records where they are known.
+
+        Args:
+            kind (str, optional): Defaults to None. Only keys of this kind
+            of work, else all.
+
+        Returns:
+            [list]: S3 keys and S3Object records, each key once.
+        """
+
+        objects = dict()
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue
+                    if kind is not None and entry['kind'] != kind:
+                        continue
+                    if entry['record']:
+                        objects[entry['key']] = S3Object(**entry['record'])
+                    else:
+                        objects.setdefault(entry['key'], entry['key'])
+        except FileNotFoundError:
+            pass
+        return list(objects.values())
+
+    def take(self):
+        """Moves the file aside for a run retrying its keys.
+
+        Keys failing again are added to a new file. The old one is kept as
+        path.old until the run calls remove() on it. If path.old is left
+        by a retry run which did not finish, the lines of the file are
+        appended to it instead of replacing it, so no key is lost.
+
+        Returns:
+            [DeadLetters]: The moved file, None if there is none.
+        """
+
+        old_path = "{}.old".format(self.path)
+        if not os.path.exists(old_path):
+            try:
+                os.rename(self.path, old_path)
+            except FileNotFoundError:
+                return None
+            return DeadLetters(old_path)
+
+        logger.warning("Merging {} into {} left by an unfinished run."
+                       .format(self.path, old_path))
+        try:
+            with open(self.path, 'rb') as f:
+                lines = f.read()
+        except FileNotFoundError:
+            lines = b''
+        if lines:
+            if not lines.endswith(b'\n'):
+                lines += b'\n'
+            with open(old_path, 'ab') as f:
+                f.write(lines)
+            os.remove(self.path)
+        return DeadLetters(old_path)
+
+    def remove(self):
+        """Removes the file, e.g. after a run retried all its keys."""
+
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class DelayQueue(object):
+    def __init__(self, base=1, cap=300, max_attempts=None, kind='copy',
+                 dead_letters=None, max_defer=2, max_deferred=100):
+        """Keys waiting for their retry, ordered by the time they are due.
+
+        Failed keys are put into this queue with a waiting time instead of
+        letting the worker sleep, so the worker goes on with other keys and
+        takes the failed one again when it is due. The queue is a min-heap
+        of due times shared by the threads of a process.
+
+        Keys failing more often than allowed for the class of their error
+        are given up, see fail(), so a run ends in bounded time. Keys of a
+        prefix at its cap of requests in flight are deferred, see defer().
+
+        Args:
+            base (float, optional): Defaults to 1. Shortest waiting time in
+            seconds, see Backoff.
+            cap (float, optional): Defaults to 300. Longest waiting time in
+            seconds.
+            max_attempts (dict, optional): Defaults to None. Attempts per
+            error class, see error_class(). Defaults to MAX_ATTEMPTS.
+            kind (str, optional): Defaults to 'copy'. Kind of work of the
+            keys, recorded in the dead letters.
+            dead_letters (DeadLetters, optional): Defaults to None. Store of
+            keys given up, else they are only logged.
+            max_defer (float, optional): Defaults to 2. Longest waiting time
+            of a deferred key in seconds.
+            max_deferred (int, optional): Defaults to 100. Number of deferred
+            keys from which on get() takes no new keys from the queue.
+        """
+
+        self.backoff = Backoff(base, cap)
+        self.max_attempts = dict(MAX_ATTEMPTS, **(max_attempts or {}))
+        self.kind = kind
+        self.dead_letters = dead_letters
+        self.max_defer = max_defer
+        self.max_deferred = max_deferred
+        # Failed attempts by key and error class
+        self._failures = collections.Counter()
+        # Deferrals by key and the number of deferred keys in the heap
+        self._deferrals = collections.Counter()
+        self._deferred = 0
+        self._heap = list()
+        # Keeps the order of keys due at the same time.
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def put(self, obj, delay=None):
+        """Puts a key or record back for a later attempt.
+
+        Args:
+            obj (object): Key, record or part to retry.
+            delay (float, optional): Defaults to None. Seconds to wait.
+            If None the key failed and waits according to its backoff,
+            otherwise it is only deferred and no attempt is counted.
+
+        Returns:
+            [float]: Seconds until the key is due.
+        """
+
+        if delay is None:
+            delay = self.backoff.failed(obj)
+        with self._lock:
+            heapq.heappush(self._heap, (
+                time.monotonic() + delay, next(self._counter), obj, False))
+        return delay
+
+    def deferral(self, obj):
+        """Counts a deferral of obj and returns its waiting time.
+
+        The waiting time starts at 0.1 seconds and doubles with each
+        deferral of the key up to max_defer, so the workers do not poll a
+        prefix at its cap every few milliseconds.
+        """
+
+        with self._lock:
+            count = self._deferrals[obj]
+            self._deferrals[obj] = count + 1
+        return min(self.max_defer, 0.1 * 2 ** min(count, 16))
+
+    def defer(self, obj):
+        """Puts a key back whose prefix is at its cap of requests in flight.
+
+        No attempt is counted, see deferral() for the waiting time. While
+        max_deferred keys are deferred, get() waits for them instead of
+        taking new keys from the shared queue, which are left to other
+        processes.
+
+        Args:
+            obj (object): Key, record or part to start later.
+
+        Returns:
+            [float]: Seconds until the key is due.
+        """
+
+        delay = self.deferral(obj)
+        with self._lock:
+            heapq.heappush(self._heap, (
+                time.monotonic() + delay, next(self._counter), obj, True))
+            self._deferred += 1
+        return delay
+
+    def get_ready(self):
+        """Returns the next due key or None if no key is due."""
+        with self._lock:
+            if self._heap and self._heap[0][0] <= time.monotonic():
+                _, _, obj, deferred = heapq.heappop(self._heap)
+                if deferred:
+                    self._deferred -= 1
+                return obj
+        return None
+
+    def wait_time(self):
+        """Returns the seconds until the next key is due or None."""
+        with self._lock:
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - time.monotonic(), 0)
+
+    def attempts(self, obj):
+        """Returns the number of failed attempts of obj."""
+        return self.backoff.attempts(obj)
+
+    def done(self, obj):
+        """Forgets the attempts of obj after it succeeded."""
+        self.backoff.reset(obj)
+        with self._lock:
+            self._deferrals.pop(obj, None)
+            for name in self.max_attempts:
+                self._failures.pop((obj, name), None)
+
+    def fail(self, obj, exc):
+        """Puts a failed key back, unless it used up its attempts.
+
+        Args:
+            obj (object): Key, record or part which failed.
+            exc (Exception): Error of the attempt.
+
+        Returns:
+            [float]: Seconds until the key is due, None if it was given up
+            and added to the dead letters.
+        """
+
+        if not self.should_retry(obj, exc):
+            return None
+        return self.put(obj)
+
+    def should_retry(self, obj, exc):
+        """Counts a failed attempt and gives up keys without attempts left.
+
+        Keys given up are logged, added to the dead letters and forgotten.
+
+        Args:
+            obj (object): Key, record or part which failed.
+            exc (Exception): Error of the attempt.
+
+        Returns:
+            [bool]: True if obj has attempts left.
+        """
+
+        name = error_class(exc)
+        with self._lock:
+            self._failures[(obj, name)] += 1
+            failures = self._failures[(obj, name)]
+        if failures < self.max_attempts[name]:
+            return True
+
+        attempts = self.backoff.attempts(obj) + 1
+        logger.error("Giving up {} after {} attempts, last error ({}): {}"
+                     .format(key_of(obj), attempts, name, exc))
+        if self.dead_letters is not None:
+            self.dead_letters.add(self.kind, obj, exc, attempts)
+        self.done(obj)
+        return False
+
+    def get(self, q, timeout):
+        """Returns the next due key, else the next key of a queue.
+
+        Waits on the queue at most until the next key of this queue is due.
+        While max_deferred keys are deferred, only keys of this queue are
+        returned, see defer().
+
+        Args:
+            q (Queue): Queue of new keys.
+            timeout (float): Seconds to wait for a key.
+
+        Raises:
+            queue.Empty: If no key was received.
+
+        Returns:
+            [object]: Key, record or part.
+        """
+
+        obj = self.get_ready()
+        if obj is not None:
+            return obj
+        wait = self.wait_time()
+        if wait is not None:
+            if self._deferred >= self.max_deferred:
+                # Capped prefixes hold enough keys of this process.
+                time.sleep(min(timeout, wait))
+                obj = self.get_ready()
+                if obj is None:
+                    raise queue.Empty
+                return obj
+            timeout = min(timeout, max(wait, 0.01))
+        return q.get(timeout=timeout)
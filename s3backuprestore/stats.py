@@ -0,0 +1,181 @@
+"""Counters shared by all worker threads of all processes."""
+
+import multiprocessing
+import threading
+import time
+
+from .cw import put_metric
+from .log import logger
+
+# Fields of each slot
+OBJECTS = 0
+BYTES = 1
+RETRIES = 2
+SLOWDOWNS = 3
+IN_FLIGHT = 4
+FIELDS = ('objects', 'bytes', 'retries', 'slowdowns', 'in_flight')
+
+
+class _Slot(object):
+    def __init__(self, array, base, lock=None):
+        self._array = array
+        self._base = base
+        self._lock = lock
+
+    def add(self, field, value=1):
+        """Adds value to a field of the slot."""
+        if self._lock is None:
+            # Only the thread owning the slot writes it, no lock needed.
+            self._array[self._base + field] += value
+        else:
+            with self._lock:
+                self._array[self._base + field] += value
+
+
+class _NullSlot(object):
+    def add(self, field, value=1):
+        pass
+
+
+class SharedStats(object):
+    def __init__(self, slots=4096):
+        """Block of counters in shared memory.
+
+        Every worker thread claims a slot of its own with slot() and adds to
+        its fields without a lock or any IPC, since it is the only writer.
+        The parent reads all slots with totals(), which costs no more than
+        summing an array, so it can be polled at a high frequency. If all
+        slots are claimed, further threads share the last slot with a lock.
+
+        The block is passed to processes when they are started, like
+        RawArray. Config leaves it out when it is pickled otherwise.
+
+        Args:
+            slots (int, optional): Defaults to 4096. Number of slots, at
+            least the number of threads of all processes.
+        """
+
+        self.slots = slots
+        self._array = multiprocessing.RawArray('q', slots * len(FIELDS))
+        self._claimed = multiprocessing.RawValue('i', 0)
+        self._lock = multiprocessing.Lock()
+
+    def slot(self):
+        """Claims a slot for the calling thread."""
+        with self._lock:
+            index = self._claimed.value
+            if index < self.slots - 1:
+                self._claimed.value += 1
+                return _Slot(self._array, index * len(FIELDS))
+        return _Slot(self._array, (self.slots - 1) * len(FIELDS), self._lock)
+
+    def totals(self):
+        """Returns the sum of each field over all slots as dict."""
+        used = min(self._claimed.value + 1, self.slots) * len(FIELDS)
+        values = self._array[:used]
+        return {name: sum(values[field::len(FIELDS)])
+                for field, name in enumerate(FIELDS)}
+
+
+def stats_slot(config):
+    """Returns a slot of the shared stats of config.
+
+    Args:
+        config (s3backuprestore.config.Config): Configuration object.
+
+    Returns:
+        [object]: Slot with add(field, value), which does nothing if config
+        has no stats.
+    """
+
+    stats = getattr(config, 'stats', None)
+    if stats is None:
+        return _NullSlot()
+    return stats.slot()
+
+
+class _Progress(threading.Thread):
+    def __init__(self, stats, total=None, interval=5, config=None,
+                 log_interval=60):
+        """Reports progress and ETA from shared stats.
+
+        Args:
+            stats (SharedStats): Stats updated by the workers.
+            total (int, optional): Defaults to None. Number of objects to
+            process, needed for the ETA.
+            interval (int, optional): Defaults to 5. Seconds between
+            metrics.
+            config (s3backuprestore.config.Config, optional): Defaults to
+            None. Configuration object to put metrics with.
+            log_interval (int, optional): Defaults to 60. Seconds between
+            log messages.
+        """
+
+        threading.Thread.__init__(self)
+        self.stats = stats
+        self.total = total
+        self.interval = interval
+        self.config = config
+        self.log_interval = log_interval
+        self.daemon = True
+        self._stop_event = threading.Event()
+        # Counters of earlier phases are not part of the progress.
+        self._offset = stats.totals()
+
+    def delta(self):
+        """Returns the totals since the reporting started as dict."""
+        totals = self.stats.totals()
+        return {name: totals[name] - self._offset[name] for name in FIELDS}
+
+    def run(self):
+        start = time.time()
+        logged = start
+        while not self._stop_event.wait(self.interval):
+            totals = self.delta()
+            rate = totals['objects'] / (time.time() - start)
+            eta = None
+            if self.total:
+                remaining = max(self.total - totals['objects'], 0)
+                eta = remaining / rate if rate else None
+            if self.config:
+                put_metric('InFlight', totals['in_flight'], self.config)
+                if eta is not None:
+                    put_metric('SecondsRemaining', eta, self.config)
+            if time.time() - logged < self.log_interval:
+                continue
+            logged = time.time()
+            message = ("{objects} objects, {bytes} bytes done, {in_flight} "
+                       "in flight, {retries} retries, {slowdowns} SlowDowns."
+                       .format(**totals))
+            message += " {:.1f} objects/s.".format(rate)
+            if self.total:
+                message += " {:.1f}% done.".format(
+                    100 * totals['objects'] / self.total)
+            if eta is not None:
+                message += " ETA {:.0f}s.".format(eta)
+            logger.info(message)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+def report_progress(stats, total=None, interval=5, config=None):
+    """Starts a thread reporting progress and ETA from shared stats.
+
+    Args:
+        stats (SharedStats): Stats updated by the workers.
+        total (int, optional): Defaults to None. Number of objects to
+        process, needed for the ETA.
+        interval (int, optional): Defaults to 5. Seconds between metrics.
+        config (s3backuprestore.config.Config, optional): Defaults to None.
+        Configuration object to put metrics with.
+
+    Returns:
+        [threading.Thread]: The reporting thread, stop it with stop(). Its
+        delta() returns the totals since it was started.
+    """
+
+    progress = _Progress(stats, total=total, interval=interval, config=config)
+    progress.start()
+    return progress
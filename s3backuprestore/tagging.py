@@ -3,16 +3,41 @@ import queue
 import sys
 import threading
 import time
-from random import randint
 from datetime import datetime
+from botocore.exceptions import ClientError
 
 from .cw import put_metric
 from .log import logger
+from .objects import key_of
+from .queues import drained
+from .ratelimit import get_limiter
+from .retry import DelayQueue
+
+
+def _retry(retries, obj, exc, config):
+    """Puts a failed key into the delay queue of the process."""
+    delay = retries.fail(obj, exc)
+    if delay is None:
+        put_metric('ObjectsFailed', 1, config)
+        return
+    logger.info("Retrying {} in {:.0f}s, attempt {}.".format(
+        key_of(obj), delay, retries.attempts(obj) + 1))
+
+
+def _slowdown(limiter, bucket, key, exc, config):
+    """Decreases the request rate of the prefix of key after a SlowDown."""
+    if not isinstance(exc, ClientError):
+        return
+    if 'SlowDown' in exc.response.get('Error', {}).get('Code', ''):
+        logger.warning("SlowDown occurs for {}.".format(key))
+        put_metric('SlowDown', 1, config)
+        limiter.slowdown(bucket, key)
 
 
 class _CheckDeletedTag(threading.Thread):
     def __init__(self, config, check_deleted_tag_queue, restore_queue,
-                 cw_metric_name='CheckDeletedTaggsErrors'):
+                 cw_metric_name='CheckDeletedTaggsErrors', input_done=None,
+                 retries=None):
         """Checks if S3 objects are tagged as Deleted.
 
         If objects are tagged as Key: Deleted, Value: True, it would not
@@ -24,6 +49,9 @@ class _CheckDeletedTag(threading.Thread):
             cw_namespace (str): CloudWatch namespace to push metrics to.
             cw_dimension_name (str): CloudWatch dimension name to create.
             thread_name (str): Unique name of thread.
+            retries (s3backuprestore.retry.DelayQueue, optional): Defaults
+            to None. Delay queue failed keys wait in, shared by the threads
+            of a process.
         """
         threading.Thread.__init__(self)
         self.config = config
@@ -34,11 +62,16 @@ class _CheckDeletedTag(threading.Thread):
         self.check_deleted_tag_queue = check_deleted_tag_queue
         self.restore_queue = restore_queue
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
+        if retries is None:
+            retries = DelayQueue(kind='check',
+                                 dead_letters=config.dead_letters)
+        self.retries = retries
         # Sets the thred in daemon mode. See:
         # https://docs.python.org/3/library/threading.html#threading.Thread.daemon
         self.daemon = True
-        self._session = config.boto3_session()
         self._transfer_mgr = config.s3_transfer_manager()
+        self._limiter = get_limiter(config)
 
     def run(self):
         """Run method of threading.Thread class.
@@ -47,58 +80,63 @@ class _CheckDeletedTag(threading.Thread):
         if not method will put objects back into other queue that will be
         consumed by restore process.
         """
-        waiter = 1
         try:
-            s3 = self._session.resource('s3')
+            s3 = self.config.client('s3')
         except:
             logger.exception("")
             put_metric(self.cw_metric_name, 1, self.config)
             sys.exit(127)
 
-        while not self.check_deleted_tag_queue.empty():
+        while self.retries or not drained(
+                self.check_deleted_tag_queue, self.input_done):
             logger.debug("Check deleted tag queue size: {} keys"
                          .format(self.check_deleted_tag_queue.qsize()))
             deleted = False
             try:
-                key = self.check_deleted_tag_queue.get(timeout=self.timeout)
+                # Keys due for a retry go first.
+                obj = self.retries.get(
+                    self.check_deleted_tag_queue, self.timeout)
+                key = key_of(obj)
                 logger.info("Got key {} from check deleted tag queue."
                             .format(key))
             except queue.Empty as exc:
-                logger.warning("Check deleted tag queue seems empty."
-                               " Checking again.")
+                if not len(self.retries):
+                    logger.warning("Check deleted tag queue seems empty."
+                                   " Checking again.")
+                continue
+
+            if not self._limiter.try_start(self.src_bucket, key):
+                # The prefix is at its cap, other prefixes go first.
+                self.retries.defer(obj)
                 continue
 
             # Getting Tag of object
             try:
-                response = s3.meta.client.get_object_tagging(
+                # Waits for a token of the prefix shared by all processes.
+                self._limiter.acquire(self.src_bucket, key)
+                response = s3.get_object_tagging(
                     Bucket=self.src_bucket,
                     Key=key
                 )
 
                 tag_sets = response['TagSet']
                 logger.debug("TagSet for key {}\n{}".format(key, tag_sets))
+                put_metric('ObjectsChecked', 1, self.config)
             except ConnectionRefusedError as exc:
-                logger.exception("Waiting for {:.0f}s.\n"
-                                 "Put {} back to queue.\n"
-                                 "Maybe to many connections?"
-                                 .format(waiter, key))
+                logger.exception("Connection refused for {}.\n"
+                                 "Maybe to many connections?".format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.check_deleted_tag_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s."
-                             .format(waiter))
-                time.sleep(waiter)
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
-            except:
-                logger.exception("Unhandeld exception occured.\n "
-                                 "Put {} back to queue.".format(key))
+                _retry(self.retries, obj, exc, self.config)
+            except Exception as exc:
+                logger.exception("Unhandeld exception occured for {}."
+                                 .format(key))
                 put_metric(self.cw_metric_name, 1, self.config)
-                self.check_deleted_tag_queue.put(key, timeout=self.timeout)
-                logger.exception("Error occured sleeping for {}s."
-                                 .format(waiter))
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
+                _slowdown(self._limiter, self.src_bucket, key, exc,
+                          self.config)
+                _retry(self.retries, obj, exc, self.config)
             else:
+                self._limiter.success(self.src_bucket, key)
+                self.retries.done(obj)
                 # Check if object is marked as deleted.
                 # If so object won't be added to restore_queue
                 for tag_set in tag_sets:
@@ -112,26 +150,22 @@ class _CheckDeletedTag(threading.Thread):
 
                 if not deleted:
                     try:
-                        self.restore_queue.put(key, timeout=self.timeout)
+                        self.restore_queue.put(obj, timeout=self.timeout)
                         logger.info("{} added to restore queue.".format(key))
-                        # Reduce waiting time
-                        waiter = max(round(waiter * 0.8), 1)
-                    except:
-                        self.check_deleted_taggs_queue.put(
-                            key, timeout=self.timeout)
-                        logger.exception("Error occured sleeping for {}s."
-                                         .format(waiter))
-                        waiter = randint(1, min(self.max_wait, waiter * 4))
-                        logger.debug("Next waiting time {}s.".format(waiter))
+                    except Exception as exc:
+                        logger.exception("Adding {} to restore queue failed."
+                                         .format(key))
+                        _retry(self.retries, obj, exc, self.config)
                 else:
                     logger.info("{} marked as deleted.".format(key))
-                    # Reduce waiting time
-                    waiter = max(round(waiter * 0.8), 1)
+            finally:
+                self._limiter.done(self.src_bucket, key)
 
 
 class MpCheckDeletedTag(multiprocessing.Process):
     def __init__(self, config, check_deleted_tag_queue, restore_queue,
-                 thread_count=10, cw_metric_name='CheckDeletedTagError'):
+                 thread_count=10, cw_metric_name='CheckDeletedTagError',
+                 input_done=None):
         """Class which will start _CheckDeletedTagg threads.
 
         This class will start processes with _CheckDeletedTag() threads so
@@ -146,6 +180,10 @@ class MpCheckDeletedTag(multiprocessing.Process):
             which will be spawned in each process.
             cw_metric_name (str, optional): Defaults to 'ObjectsToCompare'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the check deleted tag queue.
+            If it is given the threads are started even if the queue is
+            still empty.
         """
 
         multiprocessing.Process.__init__(self)
@@ -155,25 +193,37 @@ class MpCheckDeletedTag(multiprocessing.Process):
         self.timeout = self.config.timeout
         self.thread_count = thread_count
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
 
     def run(self):
         check_deleted_tag_queue_size = self.check_deleted_tag_queue.qsize()
         logger.debug("{} check deleted tag queue size {}"
                      .format(self.name, check_deleted_tag_queue_size))
 
-        if check_deleted_tag_queue_size:
-            thread_count = min(self.thread_count, check_deleted_tag_queue_size)
+        if check_deleted_tag_queue_size or self.input_done:
+            if self.input_done:
+                thread_count = self.thread_count
+            else:
+                thread_count = min(self.thread_count,
+                                   check_deleted_tag_queue_size)
 
             # Start check deleted tag S3 objects in destiantion bucket
             # Consume tag_queue until it is empty
             th_lst = list()
+            # Failed keys wait for their retry in a queue of this process.
+            retries = DelayQueue(kind='check',
+                                 dead_letters=self.config.dead_letters)
+            # All threads share the client of this process.
+            self.config.warm_up(thread_count)
             logger.info("{} starting {} threads."
                         .format(self.name, thread_count))
             for t in range(thread_count):
                 th_lst.append(_CheckDeletedTag(
                     self.config,
                     self.check_deleted_tag_queue,
-                    self.restore_queue))
+                    self.restore_queue,
+                    input_done=self.input_done,
+                    retries=retries))
                 logger.debug("{} {} generated."
                              .format(self.name, th_lst[t].name))
                 th_lst[t].start()
@@ -185,7 +235,8 @@ class MpCheckDeletedTag(multiprocessing.Process):
             try:
                 logger.debug("{} checking check deleted tag queue "
                              "size if empty.".format(self.name))
-                while not self.check_deleted_tag_queue.empty():
+                while not drained(self.check_deleted_tag_queue,
+                                  self.input_done):
                     logger.info("{} check deleted tag queue not empty {} keys."
                                 " Waiting for 60s.".format(
                                     self.name,
@@ -223,7 +274,8 @@ class MpCheckDeletedTag(multiprocessing.Process):
 
 class _TagDeletedObjects(threading.Thread):
     def __init__(self, config, tag_queue,
-                 cw_metric_name='TagDeletedObjectsErrors'):
+                 cw_metric_name='TagDeletedObjectsErrors', input_done=None,
+                 retries=None):
         """Class which will tag objects as deleted.
 
         This class is inherited from threading.Thread. It tags s3 objects as
@@ -242,6 +294,12 @@ class _TagDeletedObjects(threading.Thread):
             cw_metric_name (str, optional): Defaults to
             'TagDeletedObjectsErrors'. Cloudwatch metric name where datapoint
             will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the tag queue. Until then the
+            thread keeps waiting for keys even if the queue is empty.
+            retries (s3backuprestore.retry.DelayQueue, optional): Defaults
+            to None. Delay queue failed keys wait in, shared by the threads
+            of a process.
         """
 
         threading.Thread.__init__(self)
@@ -252,114 +310,123 @@ class _TagDeletedObjects(threading.Thread):
         self.cw_dimension_name = self.config.cw_dimension_name
         self.cw_metric_name = cw_metric_name
         self.tag_queue = tag_queue
+        self.input_done = input_done
+        if retries is None:
+            retries = DelayQueue(kind='tag',
+                                 dead_letters=config.dead_letters)
+        self.retries = retries
         self.daemon = True
-        self._session = config.boto3_session()
+        self._limiter = get_limiter(config)
 
     def run(self):
-        waiter = 1
         try:
-            s3 = self._session.resource('s3')
+            s3 = self.config.client('s3')
         except:
             logger.exception("")
             put_metric(self.cw_metric_name, 1, self.config)
             sys.exit(127)
 
-        while not self.tag_queue.empty():
+        while self.retries or not drained(self.tag_queue, self.input_done):
             logger.debug("Tag queue size: {} keys"
                          .format(self.tag_queue.qsize()))
             try:
-                key = self.tag_queue.get(timeout=self.timeout)
+                # Keys due for a retry go first.
+                obj = self.retries.get(self.tag_queue, self.timeout)
+                key = key_of(obj)
                 logger.info("Got key {} from tag queue.".format(key))
             except queue.Empty as exc:
                 continue
-            deleted_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-            deleted = True
-            deleted_at = True
-
+            if not self._limiter.try_start(self.dst_bucket, key):
+                # The prefix is at its cap, other prefixes go first.
+                self.retries.defer(obj)
+                continue
             try:
-                logger.debug("Getting tagging information from {}".format(key))
-                response = s3.meta.client.get_object_tagging(
-                    Bucket=self.dst_bucket,
-                    Key=key
-                )
-                waiter = max(round(waiter * 0.8), 1)
-                logger.debug("Reduced waiting time to {}s.".format(waiter))
-            except ConnectionRefusedError as exc:
-                logger.error("Put {} back to queue.".format(key))
-                logger.debug("", exc_info=True)
-                put_metric(self.cw_metric_name, 1, self.config)
-                self.tag_queue.put(key, timeout=self.timeout)
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-
-                # Set next waiting time
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
-            except:
-                logger.exception("Unhandeld exception occured.\n "
-                                 "Put {} back to queue.".format(key))
-                put_metric(self.cw_metric_name, 1, self.config)
-                self.tag_queue.put(key, timeout=self.timeout)
+                self._tag(s3, obj, key)
+            finally:
+                self._limiter.done(self.dst_bucket, key)
 
-                logger.debug("Error occured sleeping for {}s.".format(waiter))
-                time.sleep(waiter)
-                # Set next waiting time
-                waiter = randint(1, min(self.max_wait, waiter * 4))
-                logger.debug("Next waiting time {}s.".format(waiter))
-            else:
-                for tag_key in response['TagSet']:
-                    logger.debug("TagSet for key {}:\n{}"
-                                 .format(key, tag_key))
-                    try:
-                        if tag_key['Key'] == 'Deleted':
-                            deleted = False
-                            logger.debug("Tag 'Deleted' exists for {}."
-                                         .format(key))
-                        if tag_key['Key'] == 'DeletedAt':
-                            deleted_at = False
-                            logger.debug("Tag 'DeletedAt' exists for {}."
-                                         .format(key))
-                    except KeyError:
-                        logger.info("{} has no tags.".format(key))
-
-                if deleted or deleted_at:
-                    logger.info("Tagging object {}".format(key))
-                    kwargs = {
-                        'Bucket': self.dst_bucket,
-                        'Key': key,
-                        'Tagging': {
-                            'TagSet': [
-                                {
-                                    'Key': 'Deleted',
-                                    'Value': 'True'
-                                },
-                                {
-                                    'Key': 'DeletedAt',
-                                    'Value': deleted_time
-                                }
-                            ]
-                        }
+    def _tag(self, s3, obj, key):
+        """Tags obj as deleted unless it is tagged already."""
+        deleted_time = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
+        deleted = True
+        deleted_at = True
+
+        try:
+            logger.debug("Getting tagging information from {}".format(key))
+            # Waits for a token of the prefix shared by all processes.
+            self._limiter.acquire(self.dst_bucket, key)
+            response = s3.get_object_tagging(
+                Bucket=self.dst_bucket,
+                Key=key
+            )
+        except ConnectionRefusedError as exc:
+            logger.error("Connection refused for {}.".format(key))
+            logger.debug("", exc_info=True)
+            put_metric(self.cw_metric_name, 1, self.config)
+            _retry(self.retries, obj, exc, self.config)
+        except Exception as exc:
+            logger.exception("Unhandeld exception occured for {}."
+                             .format(key))
+            put_metric(self.cw_metric_name, 1, self.config)
+            _slowdown(self._limiter, self.dst_bucket, key, exc,
+                      self.config)
+            _retry(self.retries, obj, exc, self.config)
+        else:
+            self._limiter.success(self.dst_bucket, key)
+            for tag_key in response['TagSet']:
+                logger.debug("TagSet for key {}:\n{}"
+                             .format(key, tag_key))
+                try:
+                    if tag_key['Key'] == 'Deleted':
+                        deleted = False
+                        logger.debug("Tag 'Deleted' exists for {}."
+                                     .format(key))
+                    if tag_key['Key'] == 'DeletedAt':
+                        deleted_at = False
+                        logger.debug("Tag 'DeletedAt' exists for {}."
+                                     .format(key))
+                except KeyError:
+                    logger.info("{} has no tags.".format(key))
+
+            if deleted or deleted_at:
+                logger.info("Tagging object {}".format(key))
+                kwargs = {
+                    'Bucket': self.dst_bucket,
+                    'Key': key,
+                    'Tagging': {
+                        'TagSet': [
+                            {
+                                'Key': 'Deleted',
+                                'Value': 'True'
+                            },
+                            {
+                                'Key': 'DeletedAt',
+                                'Value': deleted_time
+                            }
+                        ]
                     }
-                    try:
-                        response = s3.meta.client.put_object_tagging(**kwargs)
-                        logger.info("{} tagged as deleted.".format(key))
-                    except:
-                        logger.exception("Unhandeld exception occured.\n "
-                                         "Put {} back to queue.".format(key))
-                        put_metric(self.cw_metric_name, 1, self.config)
-                        self.tag_queue.put(key, timeout=self.timeout)
-
-                        logger.debug("Error occured sleeping for {}s."
-                                     .format(waiter))
-                        time.sleep(waiter)
-                        # Set next waiting time
-                        waiter = randint(1, min(self.max_wait, waiter * 4))
-                        logger.debug("Next waiting time {}s.".format(waiter))
+                }
+                try:
+                    self._limiter.acquire(self.dst_bucket, key)
+                    response = s3.put_object_tagging(**kwargs)
+                    logger.info("{} tagged as deleted.".format(key))
+                    put_metric('ObjectsTagged', 1, self.config)
+                    self._limiter.success(self.dst_bucket, key)
+                    self.retries.done(obj)
+                except Exception as exc:
+                    logger.exception("Unhandeld exception occured for {}."
+                                     .format(key))
+                    put_metric(self.cw_metric_name, 1, self.config)
+                    _slowdown(self._limiter, self.dst_bucket, key, exc,
+                              self.config)
+                    _retry(self.retries, obj, exc, self.config)
+            else:
+                self.retries.done(obj)
 
 
 class MpTagDeletedObjects(multiprocessing.Process):
     def __init__(self, config, tag_queue, thread_count=10,
-                 cw_metric_name='TagDeletedObjectsErrors'):
+                 cw_metric_name='TagDeletedObjectsErrors', input_done=None):
         """Class which will start _TagDeletedObjects threads.
 
         This class will start processes with _TagDeletedObjects() threads so
@@ -374,6 +441,9 @@ class MpTagDeletedObjects(multiprocessing.Process):
             which will be spawned in each process.
             cw_metric_name (str, optional): Defaults to 'ObjectsToCompare'.
             Cloudwatch metric name where datapoint will be pushed to.
+            input_done (Event, optional): Defaults to None. Event which is set
+            when no more keys will be put into the tag queue. If it is given
+            the threads are started even if the queue is still empty.
         """
 
         multiprocessing.Process.__init__(self)
@@ -382,24 +452,35 @@ class MpTagDeletedObjects(multiprocessing.Process):
         self.timeout = self.config.timeout
         self.thread_count = thread_count
         self.cw_metric_name = cw_metric_name
+        self.input_done = input_done
 
     def run(self):
         tag_queue_size = self.tag_queue.qsize()
         logger.debug("{} compare queue size {}"
                      .format(self.name, tag_queue_size))
 
-        if tag_queue_size:
-            thread_count = min(self.thread_count, tag_queue_size)
+        if tag_queue_size or self.input_done:
+            if self.input_done:
+                thread_count = self.thread_count
+            else:
+                thread_count = min(self.thread_count, tag_queue_size)
 
             # Start tagging S3 objects in destiantion bucket
             # Consume tag_queue until it is empty
             th_lst = list()
+            # Failed keys wait for their retry in a queue of this process.
+            retries = DelayQueue(kind='tag',
+                                 dead_letters=self.config.dead_letters)
+            # All threads share the client of this process.
+            self.config.warm_up(thread_count)
             logger.info("{} starting {} threads."
                         .format(self.name, thread_count))
             for t in range(thread_count):
                 th_lst.append(_TagDeletedObjects(
                     self.config,
-                    self.tag_queue))
+                    self.tag_queue,
+                    input_done=self.input_done,
+                    retries=retries))
                 logger.debug("{} {} generated."
                              .format(self.name, th_lst[t].name))
                 th_lst[t].start()
@@ -411,7 +492,7 @@ class MpTagDeletedObjects(multiprocessing.Process):
             try:
                 logger.debug("{} checking tag queue size if empty."
                              .format(self.name))
-                while not self.tag_queue.empty():
+                while not drained(self.tag_queue, self.input_done):
                     logger.info("{} compare queue not empty {} keys. "
                                 "Waiting for 60s."
                                 .format(self.name, self.tag_queue.qsize()))
@@ -0,0 +1,91 @@
+"""Server side copies of S3 objects."""
+
+from s3transfer.subscribers import BaseSubscriber
+
+from .multipart import MAX_COPY_SIZE, part_count
+from .objects import S3Object, key_of
+
+
+class _ProvideSize(BaseSubscriber):
+    def __init__(self, size):
+        self._size = size
+
+    def on_queued(self, future, **kwargs):
+        # The transfer manager does not need to request the size.
+        future.meta.provide_transfer_size(self._size)
+
+
+def submit_copy(transfer_manager, src_bucket, dst_bucket, obj,
+                extra_args=None):
+    """Submits a server side copy from source to destination bucket.
+
+    If obj is a record from listing its size is passed to the transfer
+    manager, which then copies objects smaller than the multipart threshold
+    with a single CopyObject request and large objects in parts, without
+    requesting the size with HeadObject first.
+
+    Args:
+        transfer_manager (s3transfer.manager.TransferManager): Manager of
+        this process, see s3backuprestore.config.Config.transfer_manager().
+        src_bucket (str): Source bucket.
+        dst_bucket (str): Destination bucket, the key stays the same.
+        obj (str, S3Object): Key or record of the object.
+        extra_args (dict, optional): Defaults to None. Extra arguments of
+        the copy, e.g. StorageClass.
+
+    Returns:
+        [s3transfer.futures.TransferFuture]: Future of the copy.
+    """
+
+    key = key_of(obj)
+    subscribers = None
+    if isinstance(obj, S3Object) and obj.size is not None:
+        subscribers = [_ProvideSize(obj.size)]
+    return transfer_manager.copy(
+        copy_source={'Bucket': src_bucket, 'Key': key},
+        bucket=dst_bucket,
+        key=key,
+        extra_args=extra_args or None,
+        subscribers=subscribers)
+
+
+def _single_copy(transfer_manager, obj):
+    """Returns True if obj is copied with CopyObject despite its size."""
+    if not isinstance(obj, S3Object) or not obj.etag:
+        return False
+    if part_count(obj.etag) is not None:
+        return False
+    threshold = transfer_manager.config.multipart_threshold
+    return threshold <= obj.size <= MAX_COPY_SIZE
+
+
+def copy_object(transfer_manager, src_bucket, dst_bucket, obj,
+                extra_args=None):
+    """Copies an object server side and waits until it is copied.
+
+    See submit_copy(). Records of objects which were uploaded at once are
+    copied with a single CopyObject up to its limit of 5 GB, even above the
+    multipart threshold, so the copy keeps the ETag of the source.
+
+    Args:
+        transfer_manager (s3transfer.manager.TransferManager): Manager of
+        this process.
+        src_bucket (str): Source bucket.
+        dst_bucket (str): Destination bucket, the key stays the same.
+        obj (str, S3Object): Key or record of the object.
+        extra_args (dict, optional): Defaults to None. Extra arguments of
+        the copy, e.g. StorageClass.
+
+    Raises:
+        Exception: The exception of the copy, e.g. ClientError.
+    """
+
+    if _single_copy(transfer_manager, obj):
+        transfer_manager.client.copy_object(
+            CopySource={'Bucket': src_bucket, 'Key': obj.key},
+            Bucket=dst_bucket,
+            Key=obj.key,
+            **(extra_args or {}))
+        return
+    submit_copy(transfer_manager, src_bucket, dst_bucket, obj,
+                extra_args).result()
@@ -0,0 +1,88 @@
+import csv
+import gzip
+import io
+import json
+import os
+
+import pytest
+
+from s3backuprestore import Inventory, S3Object
+
+_MODIFIED = '2024-01-02T03:04:05.000Z'
+_TIMESTAMP = 1704164645.0
+
+
+def _write_manifest(tmp_path, file_format, names, schema=None):
+    manifest = {
+        'sourceBucket': 'src',
+        'destinationBucket': 'arn:aws:s3:::inventory',
+        'fileFormat': file_format,
+        'files': [{'key': 'src/inventory/data/{}'.format(name)}
+                  for name in names],
+    }
+    if schema is not None:
+        manifest['fileSchema'] = schema
+    path = tmp_path / 'manifest.json'
+    path.write_text(json.dumps(manifest))
+    return str(path)
+
+
+def _write_csv(path, rows):
+    text = io.StringIO()
+    csv.writer(text).writerows(rows)
+    with gzip.open(path, 'wt', newline='') as f:
+        f.write(text.getvalue())
+
+
+def test_csv_report_is_merged_filtered_and_sorted(tmp_path):
+    os.mkdir(tmp_path / 'data')
+    _write_csv(tmp_path / 'data' / 'a.csv.gz', [
+        ['src', 'logs/b+c', '3', _MODIFIED, '"etag-b"', 'STANDARD_IA',
+         'true', 'false'],
+        ['src', 'data/x', '1', _MODIFIED, 'etag-x', 'STANDARD',
+         'true', 'false'],
+        ['src', 'logs/old', '1', _MODIFIED, 'etag-o', 'STANDARD',
+         'false', 'false'],
+    ])
+    _write_csv(tmp_path / 'data' / 'b.csv.gz', [
+        ['src', 'logs/a', '2', _MODIFIED, 'etag-a', '', 'true', 'false'],
+        ['src', 'logs/deleted', '', '', '', '', 'true', 'true'],
+    ])
+    location = _write_manifest(
+        tmp_path, 'CSV', ['a.csv.gz', 'b.csv.gz'],
+        'Bucket, Key, Size, LastModifiedDate, ETag, StorageClass, '
+        'IsLatest, IsDeleteMarker')
+
+    records = list(Inventory(location).records(processes=1,
+                                               prefixes='logs/'))
+
+    assert records == [
+        S3Object('logs/a', 2, 'etag-a', _TIMESTAMP, 'STANDARD'),
+        S3Object('logs/b c', 3, 'etag-b', _TIMESTAMP, 'STANDARD_IA'),
+    ]
+
+
+def test_parquet_report_uses_columnar_names(tmp_path):
+    pyarrow = pytest.importorskip('pyarrow')
+    import pyarrow.parquet
+
+    os.mkdir(tmp_path / 'data')
+    table = pyarrow.table({
+        'bucket': ['src', 'src', 'src'],
+        'key': ['b', 'a', 'old'],
+        'size': [2, 1, 1],
+        'last_modified_date': [_MODIFIED] * 3,
+        'e_tag': ['etag-b', 'etag-a', 'etag-o'],
+        'storage_class': ['GLACIER', 'STANDARD', 'STANDARD'],
+        'is_latest': [True, True, False],
+        'is_delete_marker': [False, False, False],
+    })
+    pyarrow.parquet.write_table(table, str(tmp_path / 'data' / 'a.parquet'))
+    location = _write_manifest(tmp_path, 'Parquet', ['a.parquet'])
+
+    records = list(Inventory(location).records(processes=1))
+
+    assert records == [
+        S3Object('a', 1, 'etag-a', _TIMESTAMP, 'STANDARD'),
+        S3Object('b', 2, 'etag-b', _TIMESTAMP, 'GLACIER'),
+    ]
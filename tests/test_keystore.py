@@ -0,0 +1,39 @@
+from s3backuprestore import KeyStore, S3Object, compare_listings
+
+DIGEST = 'd41d8cd98f00b204e9800998ecf8427e'
+
+
+def _record(key, etag):
+    return S3Object(key, 1, etag, 0.0, 'STANDARD')
+
+
+def test_etags_round_trip():
+    etags = [
+        DIGEST,
+        DIGEST + '-2',
+        DIGEST + '-0',
+        DIGEST.upper(),
+        DIGEST.upper() + '-3',
+        DIGEST + '-007',
+        DIGEST + '-',
+        'not-an-md5',
+        '',
+    ]
+    records = [_record('key{}'.format(i), etag)
+               for i, etag in enumerate(etags)]
+
+    store = KeyStore(records)
+
+    assert [o.etag for o in store] == etags
+    assert list(store) == records
+
+
+def test_compare_etag_ignores_case():
+    src = [_record('a', DIGEST.upper()), _record('b', DIGEST + '-2')]
+    dst = KeyStore([_record('a', DIGEST), _record('b', DIGEST + '-3')])
+
+    copy_obj, stats = compare_listings(
+        src, dst, last_modified=0, compare_etag=True)
+
+    assert [o.key for o in copy_obj] == ['b']
+    assert stats['etag_differs'] == 1
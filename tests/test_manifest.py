@@ -0,0 +1,56 @@
+import queue
+
+from botocore.exceptions import ClientError
+
+from s3backuprestore import (Config, DelayQueue, Manifest, S3Object, drain,
+                             backup)
+
+
+def _record(key):
+    return S3Object(key, 1, 'd41d8cd98f00b204e9800998ecf8427e', 0.0,
+                    'STANDARD')
+
+
+def test_failed_key_is_not_in_manifest(tmp_path, monkeypatch):
+    def copy_object(transfer_manager, src_bucket, dst_bucket, obj,
+                    extra_args=None):
+        if obj.key == 'denied':
+            raise ClientError(
+                {'Error': {'Code': 'AccessDenied'},
+                 'ResponseMetadata': {'HTTPStatusCode': 403}},
+                'CopyObject')
+
+    monkeypatch.setattr(backup, 'copy_object', copy_object)
+    monkeypatch.setattr(backup, 'put_metric', lambda *args, **kwargs: None)
+    config = Config('src', 'dst', timeout=1, copied_queue=queue.Queue())
+    monkeypatch.setattr(config, 'client', lambda *args: None)
+    monkeypatch.setattr(config, 'transfer_manager', lambda: None)
+
+    cp_obj = [_record('copied'), _record('denied')]
+    copy_queue = queue.Queue()
+    for obj in cp_obj:
+        copy_queue.put(obj)
+    thread = backup._Backup(config, copy_queue, retries=DelayQueue())
+    thread.start()
+    thread.join()
+
+    manifest = Manifest(str(tmp_path), 'dst')
+    manifest.save([_record('existing')], listed=0)
+    copied = set(drain(config.copied_queue))
+    manifest.update(o for o in cp_obj if o.key in copied)
+
+    assert [o.key for o in manifest.load()] == ['copied', 'existing']
+
+
+def test_compact_keys_listing_is_a_keystore(tmp_path, monkeypatch):
+    from s3backuprestore import KeyStore, manifest as manifest_module
+
+    records = KeyStore([_record('a'), _record('b')])
+    monkeypatch.setattr(manifest_module, 'get_objects',
+                        lambda *args, **kwargs: records)
+    manifest = Manifest(str(tmp_path), 'src')
+
+    listing = manifest.listing(with_metadata=False, compact=True)
+
+    assert isinstance(listing, KeyStore)
+    assert list(listing) == ['a', 'b']
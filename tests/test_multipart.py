@@ -0,0 +1,45 @@
+import types
+
+from s3backuprestore import (Config, MultipartCoordinator, MultipartJournal,
+                             S3Object, SharedStats, multipart)
+
+_MB = 1024 ** 2
+
+
+class _Client(object):
+    def __init__(self):
+        self.completed = list()
+
+    def head_object(self, **kwargs):
+        return {'ContentLength': 8 * _MB}
+
+    def get_paginator(self, name):
+        parts = [{'PartNumber': n, 'ETag': '"part-{}"'.format(n)}
+                 for n in (1, 2)]
+        return types.SimpleNamespace(
+            paginate=lambda **kwargs: [{'Parts': parts}])
+
+    def complete_multipart_upload(self, **kwargs):
+        self.completed.append(kwargs['UploadId'])
+
+
+def test_resumed_upload_is_completed_before_run(tmp_path, monkeypatch):
+    monkeypatch.setattr(multipart, 'put_metric', lambda *args, **kwargs: None)
+    client = _Client()
+    config = Config('src', 'dst', stats=SharedStats(slots=4))
+    monkeypatch.setattr(config, 'client', lambda *args: client)
+    monkeypatch.setattr(config, 's3_transfer_manager',
+                        lambda: types.SimpleNamespace(
+                            multipart_threshold=8 * _MB,
+                            multipart_chunksize=8 * _MB))
+    obj = S3Object('big', 12 * _MB, '0123456789abcdef0123456789abcdef-2',
+                   0.0, 'STANDARD')
+    journal = MultipartJournal(str(tmp_path / 'journal.jsonl'))
+    journal.start('upload', obj, 8 * _MB)
+    coordinator = MultipartCoordinator(
+        config, journal=MultipartJournal(journal.path))
+
+    # The coordinator thread is not started, split() completes the upload.
+    assert coordinator.split(obj) == []
+    assert client.completed == ['upload']
+    assert config.stats.totals()['objects'] == 1
@@ -0,0 +1,18 @@
+import queue
+
+from s3backuprestore import schedule
+
+
+def test_schedule_buffers_only_its_window():
+    q = queue.Queue()
+    queued = list()
+
+    def keys():
+        for key in ('a/1', 'a/2', 'a/3', 'b/1'):
+            queued.append(q.qsize())
+            yield key
+
+    schedule(q, keys(), window=2)
+
+    assert queued == [0, 0, 0, 1]
+    assert list(q.queue) == ['a/1', 'a/2', 'b/1', 'a/3']
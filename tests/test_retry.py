@@ -0,0 +1,50 @@
+import queue
+
+from botocore.exceptions import ClientError
+
+from s3backuprestore import DeadLetters, DelayQueue, RestorePending
+
+
+def _error(code):
+    return ClientError({'Error': {'Code': code}}, 'CopyObject')
+
+
+def test_take_keeps_keys_of_unfinished_run(tmp_path):
+    dead_letters = DeadLetters(str(tmp_path / 'dead-letters.jsonl'))
+    dead_letters.add('copy', 'a', _error('InternalError'), 10)
+    dead_letters.take()
+    # The retry run is interrupted after 'b' failed.
+    dead_letters.add('copy', 'b', _error('InternalError'), 10)
+
+    failed = dead_letters.take()
+
+    assert sorted(failed.read('copy')) == ['a', 'b']
+    assert dead_letters.read() == []
+    failed.remove()
+    assert dead_letters.take() is None
+
+
+def test_ongoing_restore_is_given_up_at_its_cap(tmp_path):
+    dead_letters = DeadLetters(str(tmp_path / 'dead-letters.jsonl'))
+    retries = DelayQueue(base=0, cap=0, max_attempts={'pending': 3},
+                         kind='restore', dead_letters=dead_letters)
+
+    delays = [retries.fail('a', RestorePending('a')) for _ in range(3)]
+
+    assert delays == [0, 0, None]
+    assert dead_letters.read('restore') == ['a']
+
+
+def test_deferred_keys_wait_longer_and_stop_new_keys():
+    retries = DelayQueue(max_defer=0.4, max_deferred=1)
+    new_keys = queue.Queue()
+    new_keys.put('new')
+
+    delays = [retries.defer('a') for _ in range(4)]
+
+    assert delays == [0.1, 0.2, 0.4, 0.4]
+    # The process holds deferred keys, new keys are left in the queue.
+    assert retries.get(new_keys, timeout=1) == 'a'
+    assert new_keys.qsize() == 1
+    retries.done('a')
+    assert retries.deferral('a') == 0.1